@@ -5,4 +5,4 @@ app = Flask(__name__)
 # Load configuration environment
 app.config.from_object("config.ProductionConfig")
 
-from app import views
\ No newline at end of file
+from app import views, commands
\ No newline at end of file
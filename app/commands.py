@@ -0,0 +1,27 @@
+import click
+
+from app import app
+from app.database import init_db, seed_db
+
+# Schema and seed data are created by these commands before starting the workers (they do not touch the
+# database when they start): flask --app run init-db
+
+@app.cli.command('init-db')
+@click.option('--admin-password', default='admin', help='Password of the admin user created in an empty database.')
+def init_db_command(admin_password):
+    """Create the schema, migrate it and seed an empty database."""
+    for change in init_db() + seed_db(admin_password) or ['Database already up to date']:
+        click.echo(change)
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Create the missing tables, columns and indexes."""
+    for change in init_db() or ['Database already up to date']:
+        click.echo(change)
+
+@app.cli.command('seed-db')
+@click.option('--admin-password', default='admin', help='Password of the admin user created in an empty database.')
+def seed_db_command(admin_password):
+    """Create the roles and the admin user if there are none."""
+    for created in seed_db(admin_password) or ['Nothing to seed']:
+        click.echo(created)
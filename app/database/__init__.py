@@ -1 +1 @@
-from .database import db_session, init_db, Base, engine
\ No newline at end of file
+from .database import db_session, init_db, seed_db, check_db, Base, engine, replica_engines, engines, RoutingSession, primary_reads, fresh_reads, primary_lsn, require_lsn, lsn_value
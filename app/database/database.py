@@ -1,19 +1,160 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+from contextlib import contextmanager
+from flask import g, has_request_context
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import scoped_session, sessionmaker, Session
 from sqlalchemy.ext.declarative import declarative_base
+from werkzeug.security import generate_password_hash
 from app import app
 
 engine = create_engine(app.config.get('SQLALCHEMY_DATABASE_URI'), client_encoding='utf8', pool_size=5, max_overflow=10, pool_timeout=30)
-db_session = scoped_session(sessionmaker(autocommit=False,
+# Read-only replicas of the database, used by the GET requests of the routes marked read_only (see app/utils/replicas.py)
+replica_engines = [create_engine(uri, client_encoding='utf8', pool_size=5, max_overflow=10, pool_timeout=30, pool_pre_ping=True)
+                   for uri in app.config.get('SQLALCHEMY_REPLICA_URIS') or []]
+engines = [engine] + replica_engines
+
+class RoutingSession(Session):
+    """
+    Session that runs the statements of a request on the replica chosen for it (g.db_replica), if any,
+    and on the primary otherwise. Flushes and INSERT/UPDATE/DELETE statements always go to the primary.
+    """
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if replica_engines and not self._flushing and not getattr(clause, 'is_dml', False) and has_request_context():
+            replica = g.get('db_replica')
+            if replica is not None:
+                return replica
+        return engine
+
+def lsn_value(lsn):
+    """
+    Number of a WAL position in its text form ('16/B374D848'), to compare positions.
+    """
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) | int(low, 16)
+
+def primary_lsn():
+    """
+    Current WAL position of the primary, as text. None without replicas or if it cannot be read.
+    In a request it is read once after each commit (the after_commit listener of app/utils/replicas.py forgets it).
+    """
+    if not replica_engines:
+        return None
+    if has_request_context() and g.get('db_primary_lsn'):
+        return g.db_primary_lsn
+    try:
+        with engine.connect() as connection:
+            lsn = connection.scalar(text('SELECT pg_current_wal_lsn()::text'))
+    except SQLAlchemyError:
+        return None
+    if has_request_context():
+        g.db_primary_lsn = lsn
+    return lsn
+
+def replayed_lsn(replica):
+    """
+    WAL position the replica has replayed, as a number, read once per request. 0 if it cannot be read.
+    Later statements of the request see at least this position.
+    """
+    if g.get('db_replayed_lsn') is None:
+        try:
+            with replica.connect() as connection:
+                lsn = connection.scalar(text('SELECT pg_last_wal_replay_lsn()::text'))
+        except SQLAlchemyError:
+            lsn = None
+        g.db_replayed_lsn = lsn_value(lsn) if lsn else 0
+    return g.db_replayed_lsn
+
+def require_lsn(lsn):
+    """
+    Record that data read in this request must include the writes up to lsn (the position saved with a version
+    stamp of the calendar cache), see fresh_reads.
+    """
+    if lsn and has_request_context():
+        g.db_required_lsn = max(g.get('db_required_lsn') or 0, lsn_value(lsn))
+
+@contextmanager
+def primary_reads():
+    """
+    Run the statements of the block on the primary, also in a request answered by a replica.
+    """
+    replica = g.get('db_replica') if has_request_context() else None
+    if replica is None:
+        yield
+        return
+    g.db_replica = None
+    try:
+        yield
+    finally:
+        g.db_replica = replica
+
+@contextmanager
+def fresh_reads(lsn=None):
+    """
+    Run the statements of the block on the replica of the request if it has replayed lsn and every position given
+    to require_lsn, on the primary otherwise. Used to fill the caches and build the responses with ETags: their
+    version stamps are bumped after writing to the primary, so data read from a replica that has not replayed
+    the write yet would be kept under the new stamp.
+    """
+    replica = g.get('db_replica') if has_request_context() else None
+    required = max(g.get('db_required_lsn') or 0, lsn_value(lsn) if lsn else 0) if replica is not None else None
+    if not required or replayed_lsn(replica) >= required:
+        yield
+        return
+    with primary_reads():
+        yield
+
+db_session = scoped_session(sessionmaker(class_=RoutingSession,
+                                         autocommit=False,
                                          autoflush=False,
                                          bind=engine))
 Base = declarative_base()
 Base.query = db_session.query_property()
 
 def init_db():
+    """
+    Create the missing tables, and the columns and indexes added to existing ones.
+    Run by `flask init-db` / `flask migrate-db`, not when the application starts.
+    Returns the list of changes applied.
+    """
     # import all modules here that might define models so that
     # they will be registered properly on the metadata.  Otherwise
     # you will have to import them first before calling init_db()
     from app.models import models
-    Base.metadata.create_all(bind=engine)
-    engine.dispose()
\ No newline at end of file
+    from .migrations import migrate_db
+    return migrate_db()
+
+def seed_db(admin_password='admin'):
+    """
+    Create the roles and the first admin user if the database has none. Returns the list of rows created.
+    """
+    from app.models import Roles, Users
+    created = []
+    if db_session.scalar(select(Roles.id).limit(1)) is None:
+        db_session.add_all([Roles(role=role) for role in ['admin', 'user']])
+        db_session.commit()
+        created.append('roles admin and user created')
+    if db_session.scalar(select(Users.id).limit(1)) is None:
+        db_session.add(Users(name="admin", surname="admin", username="admin", hash=generate_password_hash(admin_password), role_id=1))
+        db_session.commit()
+        created.append('user admin created')
+    return created
+
+_pool_warmed = False
+
+def check_db():
+    """
+    Readiness check: the first call of the process opens the connections of the pools (pool_size) of the
+    primary and the replicas at the same time, so the first requests do not pay for them; later calls check
+    one connection of each. Raises SQLAlchemyError if a database is not reachable.
+    """
+    global _pool_warmed
+    connections = []
+    try:
+        for database_engine in engines:
+            for _ in range(1 if _pool_warmed else database_engine.pool.size()):
+                connections.append(database_engine.connect())
+                connections[-1].execute(text('SELECT 1'))
+    finally:
+        for connection in connections:
+            connection.close()
+    _pool_warmed = True
@@ -0,0 +1,141 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.schema import CreateIndex
+
+from .database import Base, engine
+
+# Duplicated rows of the join tables, removed before creating their unique indexes (the oldest row is kept)
+DUPLICATES = {
+    'userevents': ('user_id', 'event_id'),
+    'usergroups': ('user_id', 'group_id'),
+}
+
+# Columns added to existing tables: table, column, definition and statements to fill it
+NEW_COLUMNS = [
+    ('events', 'seats_taken', 'INTEGER NOT NULL DEFAULT 0',
+     ["UPDATE events SET seats_taken = (SELECT count(userevents.user_id) FROM userevents WHERE userevents.event_id = events.id)"]),
+    ('events', 'series_id', 'INTEGER REFERENCES series (id) ON DELETE CASCADE', []),
+    ('events', 'batch_id', 'VARCHAR(32)', []),
+    ('jobs', 'heartbeat_at', 'TIMESTAMP WITHOUT TIME ZONE', []),
+]
+
+# Indexes that need a PostgreSQL extension, created only where the extension can be installed
+# (they are not declared in the models, so create_all works without it): extension, name, table, definition
+EXTENSION_INDEXES = [
+    # substring search of users, see USER_SEARCH_TEXT in app/utils/roster.py
+    ('pg_trgm', 'ix_users_search_trgm', 'users', "USING gin (lower(name || ' ' || surname || ' ' || username) gin_trgm_ops)"),
+]
+
+def add_columns(connection):
+    """
+    Add the columns of the models missing in existing tables (create_all does not add them).
+    """
+    applied = []
+    inspector = inspect(connection)
+    for table, column, definition, fill_statements in NEW_COLUMNS:
+        if column not in [existing['name'] for existing in inspector.get_columns(table)]:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+            for statement in fill_statements:
+                connection.execute(text(statement))
+            applied.append(f'{table}.{column} added')
+    return applied
+
+def remove_duplicates(connection, existing_indexes):
+    """
+    Delete the repeated rows of the join tables whose unique index does not exist yet.
+    Seat counters are recomputed for the events that had repeated sign-ups.
+    """
+    applied = []
+    for table, columns in DUPLICATES.items():
+        index_name = f"ux_{table}_{'_'.join(columns)}"
+        if index_name in existing_indexes.get(table, set()):
+            continue
+        same_row = ' AND '.join(f'newer.{column} = older.{column}' for column in columns)
+        deleted = connection.execute(text(
+            f"DELETE FROM {table} AS newer USING {table} AS older WHERE {same_row} AND newer.id > older.id RETURNING newer.{columns[-1]}"
+        )).scalars().all()
+        if deleted:
+            applied.append(f'{len(deleted)} duplicated rows deleted from {table}')
+            if table == 'userevents':
+                connection.execute(text(
+                    "UPDATE events SET seats_taken = (SELECT count(userevents.user_id) FROM userevents WHERE userevents.event_id = events.id) "
+                    "WHERE events.id = ANY(:event_ids)"
+                ), {'event_ids': list(set(deleted))})
+    return applied
+
+def model_indexes():
+    return [index for table in Base.metadata.sorted_tables for index in table.indexes]
+
+def existing_index_names(connection):
+    """
+    Indexes of the database by table. Invalid ones (left by an interrupted concurrent build) are dropped,
+    so they are built again.
+    """
+    invalid = connection.execute(text(
+        "SELECT index_class.relname FROM pg_index JOIN pg_class AS index_class ON index_class.oid = pg_index.indexrelid "
+        "WHERE NOT pg_index.indisvalid AND index_class.relname = ANY(:names)"
+    ), {'names': [index.name for index in model_indexes()] + [name for _, name, _, _ in EXTENSION_INDEXES]}).scalars().all()
+    for index_name in invalid:
+        connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index_name}"'))
+
+    inspector = inspect(connection)
+    return {table.name: {index['name'] for index in inspector.get_indexes(table.name)} for table in Base.metadata.sorted_tables}
+
+def create_indexes(connection, existing_indexes):
+    """
+    Create the indexes declared in the models that the database does not have yet.
+    CONCURRENTLY does not lock the writes to the table while the index is built.
+    """
+    applied = []
+    for index in model_indexes():
+        if index.name in existing_indexes.get(index.table.name, set()):
+            continue
+        statement = str(CreateIndex(index, if_not_exists=True).compile(dialect=connection.dialect))
+        connection.execute(text(statement.replace('INDEX IF NOT EXISTS', 'INDEX CONCURRENTLY IF NOT EXISTS', 1)))
+        applied.append(f'index {index.name} created')
+    return applied
+
+def create_extension_indexes(connection, existing_indexes):
+    """
+    Create the indexes of EXTENSION_INDEXES whose extension is installed or can be installed.
+    """
+    applied = []
+    for extension, name, table, definition in EXTENSION_INDEXES:
+        if name in existing_indexes.get(table, set()):
+            continue
+        try:
+            connection.execute(text(f'CREATE EXTENSION IF NOT EXISTS {extension}'))
+        except SQLAlchemyError:
+            applied.append(f'index {name} skipped: extension {extension} not available')
+            continue
+        connection.execute(text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {definition}'))
+        applied.append(f'index {name} created')
+    return applied
+
+def migrate_db():
+    """
+    Bring an existing database up to the models: create_all only creates missing tables, this adds the
+    new columns and indexes. Every step checks the current schema first, so it can run at every start.
+    Returns the list of changes applied.
+    """
+    from app.models import models
+    Base.metadata.create_all(bind=engine)
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        existing_indexes = existing_index_names(connection)
+
+    applied = []
+    with engine.begin() as connection:
+        applied += add_columns(connection)
+        applied += remove_duplicates(connection, existing_indexes)
+
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        applied += create_indexes(connection, existing_indexes)
+        applied += create_extension_indexes(connection, existing_indexes)
+    return applied
+
+if __name__ == '__main__':
+    # python -m app.database.migrations
+    for change in migrate_db() or ['Database already up to date']:
+        print(change)
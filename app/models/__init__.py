@@ -1 +1 @@
-from .models import Users, Roles, Groups, Events, UserEvents, UserGroups
+from .models import Users, Roles, Groups, Events, UserEvents, UserGroups, Jobs, Series, SeriesExceptions
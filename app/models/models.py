@@ -1,7 +1,8 @@
-from sqlalchemy import Boolean, Column, Integer, String, ForeignKey, Date, Time
+from sqlalchemy import Boolean, Column, Integer, String, Text, ForeignKey, Date, Time, DateTime, Index, func
 from sqlalchemy.orm import relationship, backref
 from app.database import Base
 from flask_login import UserMixin
+from datetime import datetime
 
 class Roles(Base):
     __tablename__ = "roles"
@@ -17,14 +18,33 @@ class Users(Base, UserMixin):
     hash = Column(String(255), nullable=False)
     role_id = Column(Integer, ForeignKey('roles.id'))
     role = relationship('Roles', backref=backref('users', lazy=True))
+    __table_args__ = (
+        # user listing sorted by surname or name (keyset pagination, see app/utils/roster.py)
+        Index('ix_users_surname_name_id', 'surname', 'name', 'id'),
+        Index('ix_users_name_surname_id', 'name', 'surname', 'id'),
+        # prefix search, lower(column) LIKE 'text%'
+        Index('ix_users_name_prefix', func.lower(name).label('name_lower'), postgresql_ops={'name_lower': 'text_pattern_ops'}),
+        Index('ix_users_surname_prefix', func.lower(surname).label('surname_lower'), postgresql_ops={'surname_lower': 'text_pattern_ops'}),
+        Index('ix_users_username_prefix', func.lower(username).label('username_lower'), postgresql_ops={'username_lower': 'text_pattern_ops'}),
+    )
 
 class Groups(Base):
     __tablename__ = "groups"
+    __table_args__ = (
+        Index('ix_groups_name', 'name'), # groups are looked up by name when adding users
+    )
     id = Column(Integer, primary_key=True)
     name = Column(String(255), nullable=False)
 
 class Events(Base):
     __tablename__ = "events"
+    __table_args__ = (
+        Index('ix_events_group_id_date', 'group_id', 'date'), # calendar feed and status of the groups of a user
+        Index('ix_events_date', 'date'), # calendar feed of admins and exports by date
+        Index('ix_events_title', 'title'), # exports by title and list of titles
+        Index('ux_events_series_id_date', 'series_id', 'date', unique=True), # stored occurrences of a series
+        Index('ix_events_batch_id', 'batch_id'), # time slots edited together
+    )
     id = Column(Integer, primary_key=True)
     title = Column(String(255), nullable=False)
     description = Column(String(255), nullable=True) 
@@ -32,13 +52,49 @@ class Events(Base):
     start_time = Column(Time, nullable=False) 
     end_time = Column(Time, nullable=False)
     n_assistants = Column(Integer, nullable=False) # max asistants to event
+    seats_taken = Column(Integer, nullable=False, default=0, server_default='0') # assistants signed up, kept by the sign-up routes
     color = Column(String(7), nullable=True) # Hexadecimal color code
     group_id = Column(Integer, ForeignKey('groups.id', ondelete='CASCADE'))
+    series_id = Column(Integer, ForeignKey('series.id', ondelete='CASCADE'), nullable=True) # occurrence of a series, stored when it gets participants or is edited
+    batch_id = Column(String(32), nullable=True) # same for the time slots created together, see app/utils/slots.py
     group = relationship('Groups', backref=backref('events', lazy=True))
 
+# Recurring events: a rule expanded into occurrences when the calendar is loaded, see app/utils/series.py
+class Series(Base):
+    __tablename__ = "series"
+    __table_args__ = (
+        Index('ix_series_group_id_dates', 'group_id', 'start_date', 'end_date'),
+    )
+    id = Column(Integer, primary_key=True)
+    title = Column(String(255), nullable=False)
+    description = Column(String(255), nullable=True)
+    start_date = Column(Date, nullable=False) # first occurrence, weekly series repeat on its weekday
+    end_date = Column(Date, nullable=False) # last possible occurrence
+    frequency = Column(String(10), nullable=False) # daily or weekly
+    interval = Column(Integer, nullable=False, default=1) # every n days or weeks
+    start_time = Column(Time, nullable=False)
+    end_time = Column(Time, nullable=False)
+    n_assistants = Column(Integer, nullable=False)
+    color = Column(String(7), nullable=True)
+    group_id = Column(Integer, ForeignKey('groups.id', ondelete='CASCADE'))
+
+# Dates removed from a series
+class SeriesExceptions(Base):
+    __tablename__ = "seriesexceptions"
+    __table_args__ = (
+        Index('ux_seriesexceptions_series_id_date', 'series_id', 'date', unique=True),
+    )
+    id = Column(Integer, primary_key=True)
+    series_id = Column(Integer, ForeignKey('series.id', ondelete='CASCADE'), nullable=False)
+    date = Column(Date, nullable=False)
+
 # Many to many relation table
 class UserEvents(Base):
     __tablename__ = "userevents"
+    __table_args__ = (
+        Index('ux_userevents_user_id_event_id', 'user_id', 'event_id', unique=True), # a user signs up once, events of a user
+        Index('ix_userevents_event_id', 'event_id'), # participants of an event
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'))
     event_id = Column(Integer, ForeignKey('events.id', ondelete='CASCADE'))
@@ -48,8 +104,31 @@ class UserEvents(Base):
 # Many to many relation table
 class UserGroups(Base):
     __tablename__ = "usergroups"
+    __table_args__ = (
+        Index('ux_usergroups_user_id_group_id', 'user_id', 'group_id', unique=True), # a user is once in a group, groups of a user
+        Index('ix_usergroups_group_id', 'group_id'), # members of a group
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'))
     group_id = Column(Integer, ForeignKey('groups.id', ondelete='CASCADE'))
     user = relationship('Users', backref=backref('usergroups', lazy=True))
     event = relationship('Groups', backref=backref('usergroups', lazy=True))
+
+# Background jobs (excel imports and exports), see app/utils/jobs.py
+class Jobs(Base):
+    __tablename__ = "jobs"
+    __table_args__ = (
+        Index('ix_jobs_user_id', 'user_id'),
+    )
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(50), nullable=False)
+    status = Column(String(20), nullable=False, default='queued') # queued, running, done or failed
+    progress = Column(Integer, nullable=False, default=0) # percentage
+    message = Column(String(255), nullable=True) # summary shown to the user
+    report = Column(Text, nullable=True) # JSON with details of the result (e.g. rejected rows of an import)
+    result_path = Column(String(255), nullable=True) # file to download when done
+    result_name = Column(String(255), nullable=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'))
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+    finished_at = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True) # updated while the worker process running the job is alive
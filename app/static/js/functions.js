@@ -1,21 +1,194 @@
 // FUNCTIONS FOR INDEX
 
-// Function to get the number of registered participants
-function getNumberOfParticipants(event_id) {
-    return fetch(`/get_participants/${event_id}`)
+// Seat counts and participation of the events in the calendar, by event id
+var eventStatus = {};
+// Calendar of the page, event shown in the modal and stream of seat changes of the visible window
+var calendar = null;
+var modalEventId = null;
+var seatStream = null;
+// Timer of the next attempt to open the stream while the server refuses it
+var seatRetry = null;
+
+// Function to load in one request the status of all the events of a date window
+function loadEventStatus(start, end) {
+    return fetch(`/api/events/status?start=${encodeURIComponent(start)}&end=${encodeURIComponent(end)}`)
         .then(response => response.json())
-        .then(participants => participants.length)
+        .then(status => Object.assign(eventStatus, status))
         .catch(error => console.error('Error:', error));
 }
 
-// Function to check if the user is registered for the event
-function getParticipationStatus(event_id, user_id) {
-    return fetch(`/get_participation_status/${event_id}/${user_id}`)
+// Function to show or hide the add/delete buttons of the event modal
+function updateButtonState(event_id) {
+    const status = eventStatus[event_id];
+    if (!status) {
+        return;
+    }
+    if (status.participates) {
+        $('#add_me').hide();
+        $('#delete_me').show();
+    } else {
+        $('#delete_me').hide();
+        if (status.remaining > 0) {
+            $('#add_me').show();
+        } else {
+            $('#add_me').hide();
+        }
+    }
+}
+
+// Function to update the participant list of the event modal
+function updateParticipantList(event_id) {
+    fetch(`/get_participants/${event_id}`)
         .then(response => response.json())
-        .then(data => data.participates)
+        .then(participants => {
+            const participantList = document.getElementById('participant-list');
+            const participantsHtml = participants.map(participant => `<li>${participant.name} ${participant.surname}</li>`).join('');
+            participantList.innerHTML = participantsHtml;
+        })
         .catch(error => console.error('Error:', error));
 }
 
+// Function to find the calendar events with an id (of a stored event or of an occurrence of a series)
+function calendarEvents(event_id) {
+    if (!calendar) {
+        return [];
+    }
+    return calendar.getEvents().filter(event => String(event.extendedProps.modalId) === String(event_id));
+}
+
+// Function to refresh the modal if it shows one of the events
+function refreshModal(event_ids, n_assistants) {
+    if (modalEventId === null || !event_ids.some(event_id => String(event_id) === String(modalEventId))) {
+        return;
+    }
+    $('#eventModalAssistants').text(n_assistants);
+    updateButtonState(modalEventId);
+    updateParticipantList(modalEventId);
+}
+
+// Function to apply the status returned by a sign-up or withdrawal of the user, without reloading the calendar.
+// key is the id the page knows the event by: an occurrence of a series is stored with a new id at its first sign-up
+function applyEventStatus(key, status) {
+    // events already updated to the stored id are found by it
+    const events = calendarEvents(key).concat(String(key) === String(status.id) ? [] : calendarEvents(status.id));
+    events.forEach(event => {
+        const color = event.extendedProps.color;
+        event.setExtendedProp('modalId', status.id);
+        // same colors as the calendar feed
+        event.setProp('backgroundColor', status.participates ? color : 'white');
+        event.setProp('borderColor', status.participates ? color : 'lightgrey');
+        event.setProp('textColor', status.participates ? 'black' : color);
+    });
+    eventStatus[key] = eventStatus[status.id] = status;
+    if (String(modalEventId) === String(key)) {
+        modalEventId = status.id;
+        $('#edit_event').attr('href', `create-event?event_id=${modalEventId}`);
+    }
+    refreshModal([status.id], status.n_assistants);
+}
+
+// Function to apply a change sent by the seat stream: seat counts of an event, or an event or series deleted
+function applySeatChange(change) {
+    const event_ids = [change.id, change.occurrence_id].filter(event_id => event_id !== null && event_id !== undefined);
+    if (change.deleted) {
+        const removed = change.series_id
+            ? calendar.getEvents().filter(event => String(event.extendedProps.seriesId) === String(change.series_id))
+            : event_ids.flatMap(event_id => calendarEvents(event_id));
+        removeCalendarEvents(removed);
+        return;
+    }
+    event_ids.forEach(event_id => {
+        // the participation of the user is not part of the change
+        eventStatus[event_id] = Object.assign({}, eventStatus[event_id], {
+            seats_taken: change.seats_taken,
+            n_assistants: change.n_assistants,
+            remaining: change.remaining
+        });
+    });
+    refreshModal(event_ids, change.n_assistants);
+}
+
+// Function to remove events from the calendar, closing the modal if it shows one of them
+function removeCalendarEvents(events) {
+    events.forEach(event => {
+        if (String(event.extendedProps.modalId) === String(modalEventId)) {
+            bootstrap.Modal.getOrCreateInstance(document.getElementById('eventModal')).hide();
+        }
+        event.remove();
+    });
+}
+
+// Function to follow the seat changes of the events of the visible date window.
+// Changes missed while the stream reconnects are recovered loading the status of the window again.
+// When the server refuses the stream (all its stream threads are busy), the status is loaded every
+// pollSeconds instead, trying to open the stream again each time
+function watchSeats(start, end, pollSeconds) {
+    const url = `/api/events/stream?start=${encodeURIComponent(start)}&end=${encodeURIComponent(end)}`;
+    if (seatStream && seatStream.url.endsWith(url)) {
+        return;
+    }
+    if (seatStream) {
+        seatStream.close();
+    }
+    clearTimeout(seatRetry);
+    const resync = () => loadEventStatus(start, end).then(() => {
+        if (modalEventId !== null) {
+            updateButtonState(modalEventId);
+        }
+    });
+    let opened = false;
+    const stream = new EventSource(url);
+    seatStream = stream;
+    stream.onopen = () => {
+        if (opened) {
+            resync();
+        }
+        opened = true;
+    };
+    stream.onerror = () => {
+        // a stream that was open reconnects by itself, a refused one is closed
+        if (stream.readyState === EventSource.CLOSED && seatStream === stream) {
+            seatRetry = setTimeout(() => {
+                seatStream = null;
+                resync();
+                watchSeats(start, end, pollSeconds);
+            }, pollSeconds * 1000);
+        }
+    };
+    stream.onmessage = message => applySeatChange(JSON.parse(message.data));
+    stream.addEventListener('resync', resync);
+}
+
+// Function to fill the event modal with the clicked calendar event and show it
+function showEventModal(event, user_id) {
+    const props = event.extendedProps;
+    const event_id = props.modalId;
+    modalEventId = event_id;
+
+    $('#eventModalLabel').text(event.title);
+    $('#eventModalDescription').text(props.description || '');
+    $('#eventModalGroup').text(props.groupName || '');
+    $('#eventModalAssistants').text(props.n_assistants);
+    $('#participant-list').empty();
+    $('#add_me, #delete_me').hide();
+
+    // the handlers read modalEventId when clicked: an occurrence gets a stored id at its first sign-up
+    $('#add_me').off('click').on('click', () => addUserEvent(modalEventId, user_id));
+    $('#delete_me').off('click').on('click', () => deleteUserEvent(modalEventId, user_id));
+    $('#export_event').off('click').on('click', () => exportParticipants(modalEventId));
+    $('#edit_event').attr('href', `create-event?event_id=${event_id}`);
+    $('#delete_whole_event').off('click').on('click', () => deleteEvent(modalEventId));
+    // Occurrences of a series can also edit or delete the whole series
+    $('.series-action').toggle(Boolean(props.seriesId));
+    $('#edit_series').attr('href', `create-event?series_id=${props.seriesId}`);
+    $('#delete_series').off('click').on('click', () => deleteSeries(props.seriesId));
+
+    updateButtonState(event_id);
+    updateParticipantList(event_id);
+
+    bootstrap.Modal.getOrCreateInstance(document.getElementById('eventModal')).show();
+}
+
 function exportParticipants(event_id) {
     var url = "/export_participants/" + event_id;
 
@@ -35,7 +208,7 @@ function exportParticipants(event_id) {
 }
 
 function deleteUserEvent(event_id, user_id) {
-    // Send a DELETE request
+    // Send a DELETE request, the server answers with the new status of the event
     fetch('/delete_user_event', {
         method: 'DELETE',
         headers: {
@@ -49,39 +222,42 @@ function deleteUserEvent(event_id, user_id) {
     .then(response => response.json())
     .then(data => {
         console.log('Server response:', data);
-        location.reload();
+        if (data.event) {
+            applyEventStatus(event_id, data.event);
+        }
     })
     .catch((error) => {
         console.error('Error:', error);
     });
 }
 
-function addUserEvent(event_id, user_id, max_participants) {
-    getNumberOfParticipants(event_id)
-    .then(number_of_participants => {
-        if (number_of_participants < max_participants) {
-            // Send a POST request
-            fetch('/add_user_event', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    user_id: user_id,
-                    event_id: event_id,
-                }),
-            })
-            .then(response => response.json())
-            .then(data => {
-                console.log('Server response:', data);
-                location.reload();
-            })
-            .catch((error) => {
-                console.error('Error:', error);
-            });
-        } else {
+function addUserEvent(event_id, user_id) {
+    // Send a POST request, the server rejects it with 409 if the event is full.
+    // It answers with the new status of the event
+    fetch('/add_user_event', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+            user_id: user_id,
+            event_id: event_id,
+        }),
+    })
+    .then(response => {
+        if (response.status === 409) {
             alert('The event has reached the maximum number of participants');
         }
+        return response.json();
+    })
+    .then(data => {
+        console.log('Server response:', data);
+        if (data.event) {
+            applyEventStatus(event_id, data.event);
+        }
+    })
+    .catch((error) => {
+        console.error('Error:', error);
     });
 }
 
@@ -100,7 +276,34 @@ function deleteEvent(event_id) {
         .then(response => response.json())
         .then(data => {
             console.log('Server response:', data);
-            location.reload();
+            if (data.deleted !== undefined) {
+                removeCalendarEvents(calendarEvents(data.deleted));
+            }
+        })
+        .catch((error) => {
+            console.error('Error:', error);
+        });
+    }
+}
+
+function deleteSeries(series_id) {
+    if (confirm('Are you sure you want to delete all the events of this series?')) {
+        // Send a DELETE request
+        fetch('/delete_series', {
+            method: 'DELETE',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({
+                series_id: series_id,
+            }),
+        })
+        .then(response => response.json())
+        .then(data => {
+            console.log('Server response:', data);
+            if (data.deleted_series !== undefined) {
+                removeCalendarEvents(calendar.getEvents().filter(event => String(event.extendedProps.seriesId) === String(series_id)));
+            }
         })
         .catch((error) => {
             console.error('Error:', error);
@@ -168,26 +371,105 @@ function isButtonChecked(buttonId) {
     return false; // Return false if the button with the given ID doesn't exist
   }
 
-function updateGroupTable(selected) {
-    var words = $(selected).val();
-    if (!words || words.length === 0) {
-        $('tbody tr').show();
-    } else {
-        $('tbody tr').each(function() {
-            var row = $(this);
-            var showRow = false;
-            words.forEach(function(word) {
-                if (row.find('td:first-child').text().includes(word)) {
-                    showRow = true;
-                }
-            });
-            if (showRow) {
-                row.show();
-            } else {
-                row.hide();
+// Next page of groups to load, and the search it belongs to
+var groupPage = 1;
+var groupSearch = '';
+
+// Function to load a page of groups (with their number of members) from the server.
+// reset starts again from the first page, with the text of the search box
+function loadGroups(reset) {
+    if (reset) {
+        groupPage = 1;
+        groupSearch = $('#searchGroup').val() || '';
+        $('#groupRows').empty();
+    }
+    const search = groupSearch;
+    fetch(`/api/groups?page=${groupPage}&q=${encodeURIComponent(search)}`)
+        .then(response => response.json())
+        .then(data => {
+            if (search !== groupSearch) {
+                return; // an older search answered late
             }
-        });
+            data.groups.forEach(group => $('#groupRows').append(groupRow(group)));
+            groupPage = data.page + 1;
+            $('#loadMoreGroups').toggle(data.page * data.per_page < data.total);
+        })
+        .catch(error => console.error('Error:', error));
+}
+
+// Function to create the table row of a group. Members are loaded when the row is opened
+function groupRow(group) {
+    const row = $('<tr>').attr('id', `group_${group.id}`);
+    row.append($('<td>').text(group.name));
+    const members = $('<td>');
+    members.append($('<button type="button" class="btn btn-link p-0">')
+        .text(`${group.members} user(s)`)
+        .on('click', () => toggleMembers(group.id)));
+    members.append($('<ul class="list-unstyled group-members">').hide());
+    members.append($('<button type="button" class="btn btn-outline-secondary btn-sm load-more-members">')
+        .text('Load more').hide()
+        .on('click', () => loadMembers(group.id)));
+    row.append(members);
+    const actions = $('<td style="width: 30%;">');
+    actions.append($('<a class="btn btn-secondary" type="button">').text('Add Users').on('click', () => openAddUsers(group)));
+    actions.append(' ');
+    actions.append($('<a class="btn btn-danger" type="button">').text('Delete Group').on('click', () => deleteGroup(group.id)));
+    row.append(actions);
+    return row;
+}
+
+// Function to show or hide the members of a group, loading the first page the first time
+function toggleMembers(group_id) {
+    const list = $(`#group_${group_id} .group-members`);
+    if (list.data('page') === undefined) {
+        list.data('page', 1);
+        loadMembers(group_id);
     }
+    list.toggle();
+    $(`#group_${group_id} .load-more-members`).toggle(list.is(':visible') && list.data('has_more') === true);
+}
+
+// Function to load the next page of members of a group
+function loadMembers(group_id) {
+    const list = $(`#group_${group_id} .group-members`);
+    const page = list.data('page');
+    fetch(`/api/groups/${group_id}/members?page=${page}`)
+        .then(response => response.json())
+        .then(data => {
+            data.members.forEach(user => {
+                const item = $('<li style="text-align: justify; margin-left: 20px;">').text(`${user.name} ${user.surname} (${user.username}) `);
+                item.append($('<button class="btn btn-danger btn-sm delete-x">').text('X').on('click', () => deleteUserGroup(user.id, group_id)));
+                list.append(item);
+            });
+            list.data('page', page + 1);
+            list.data('has_more', data.has_more);
+            $(`#group_${group_id} .load-more-members`).toggle(list.is(':visible') && data.has_more);
+        })
+        .catch(error => console.error('Error:', error));
+}
+
+// Function to open the modal to add users to a group
+function openAddUsers(group) {
+    $('#addUsersGroupName').val(group.name);
+    $('#addUsersFile').val('');
+    $('#selectUsers').val(null).trigger('change');
+    bootstrap.Modal.getOrCreateInstance(document.getElementById('addUsersModal')).show();
+}
+
+// Function to turn a select into a picker of users searched by the server
+function initUserPicker(selector, modal) {
+    $(selector).select2({
+        placeholder: 'Search for users...',
+        width: '100%',
+        dropdownParent: $(modal),
+        minimumInputLength: 1,
+        ajax: {
+            url: '/api/users/options',
+            dataType: 'json',
+            delay: 250,
+            data: params => ({q: params.term, page: params.page || 1})
+        }
+    });
 }
 
 
@@ -217,24 +499,96 @@ function deleteUser(user_id, group_id) {
     }
 }
 
-function updateUserTable(selected) {
-    var words = $(selected).val();
-    if (!words || words.length === 0) {
-        $('tbody tr').show();
-    } else {
-        $('tbody tr').each(function() {
-            var row = $(this);
-            var showRow = false;
-            words.forEach(function(word) {
-                if (row.find('td:nth-child(2)').text().includes(word)) {
-                    showRow = true;
+// Cursor of the next page of users (null when there are no more), the query it belongs to and
+// whether a page is being loaded
+var userCursor = null;
+var userQuery = '';
+var loadingUsers = false;
+
+// Function to load a page of users from the server, with the search, mode and order of the page.
+// reset starts again from the first page
+function loadUsers(reset) {
+    if (reset) {
+        const [sort, order] = $('#sortUsers').val().split(' ');
+        userQuery = `q=${encodeURIComponent($('#searchUser').val() || '')}&mode=${$('#searchMode').val()}&sort=${sort}&order=${order || 'asc'}`;
+        userCursor = null;
+        loadingUsers = false;
+        $('#userRows').empty();
+    } else if (loadingUsers || userCursor === null) {
+        return;
+    }
+    loadingUsers = true;
+    const query = userQuery;
+    const after = userCursor ? `&after=${userCursor}` : '';
+    fetch(`/api/users?${query}${after}`)
+        .then(response => response.json())
+        .then(data => {
+            if (query !== userQuery) {
+                return; // an older search answered late
+            }
+            data.users.forEach(user => $('#userRows').append(userRow(user)));
+            userCursor = data.next;
+            loadingUsers = false;
+            $('#moreUsers').toggle(userCursor !== null);
+            // the observer only fires on changes, a page shorter than the screen keeps it visible
+            if (userCursor !== null && document.getElementById('moreUsers').getBoundingClientRect().top < window.innerHeight) {
+                loadUsers(false);
+            }
+        })
+        .catch(error => console.error('Error:', error));
+}
+
+// Function to create the table row of a user
+function userRow(user) {
+    const row = $('<tr>');
+    row.append($('<td>').text(`${user.name} ${user.surname}`));
+    row.append($('<td>').text(user.username));
+    row.append($('<td>').text(user.role_id == 1 ? 'Admin' : 'User'));
+    const actions = $('<td style="width: 30%;">');
+    actions.append($('<a class="btn btn-secondary" type="button">').text('Edit').on('click', () => openEditUser(user)));
+    if (user.role_id == 2) {
+        actions.append(' ');
+        actions.append($('<a class="btn btn-danger" type="button">').text('Delete').on('click', () => deleteUser(user.id)));
+    }
+    row.append(actions);
+    return row;
+}
+
+// Function to open the modal to edit a user
+function openEditUser(user) {
+    $('#editUserId').val(user.id);
+    $('#editUserName').val(user.name);
+    $('#editUserSurname').val(user.surname);
+    $('#editUserUsername').val(user.username);
+    $('#editUserRole').val(String(user.role_id));
+    bootstrap.Modal.getOrCreateInstance(document.getElementById('editUserModal')).show();
+}
+
+
+// FUNCTIONS FOR BACKGROUND JOBS
+
+// Function to show the progress of a job until it finishes, and download its file if it has one
+function pollJob(job_id) {
+    fetch(`/jobs/${job_id}`)
+        .then(response => response.json())
+        .then(job => {
+            $('#job-progress').css('width', `${job.progress}%`);
+            if (job.message) {
+                $('#job-message').text(job.message);
+            }
+            if (job.status === 'done') {
+                $('#job-status').removeClass('alert-info').addClass('alert-success');
+                (job.report || []).forEach(row => {
+                    $('#job-report').append($('<li>').text(`Row ${row.row} (${row.username}): ${row.detail}`));
+                });
+                if (job.result) {
+                    window.location.href = job.result;
                 }
-            });
-            if (showRow) {
-                row.show();
+            } else if (job.status === 'failed') {
+                $('#job-status').removeClass('alert-info').addClass('alert-danger');
             } else {
-                row.hide();
+                setTimeout(() => pollJob(job_id), 1000);
             }
-        });
-    }
-}
\ No newline at end of file
+        })
+        .catch(error => console.error('Error:', error));
+}
@@ -1 +1,13 @@
-from .helpers import permission_admin, log_error_to_csv
\ No newline at end of file
+from .helpers import permission_admin, conditional_response
+from .errorlog import log_error
+from .imports import read_users_file, import_users, add_users_to_group, summarize_import_report
+from .jobs import register_job, submit_job, job_status, fail_orphaned_jobs
+from .exports import participant_rows, bulk_participant_rows, write_xlsx, write_bulk_xlsx, write_csv, stream_csv, PARTICIPANTS_HEADER, XLSX_MIMETYPE, CSV_MIMETYPE
+from .identity import load_identity, invalidate_identity
+from .cache import calendar_cache, ALL_GROUPS, NO_GROUP
+from .series import load_occurrences, load_occurrences_by_id, get_occurrence, resolve_event_id, parse_occurrence_id, add_series_exception, update_series, parse_recurrence, FREQUENCIES
+from .slots import parse_event_fields, parse_slots, slot_values, create_events, create_series, update_event_batch, batch_slots, SlotsWithParticipants
+from .metrics import metrics_text
+from .roster import page_args, group_page, member_page, user_options, user_page
+from .replicas import read_only
+from .seat_stream import notify_seats, notify_deleted, seat_events, seat_bus
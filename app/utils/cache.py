@@ -0,0 +1,162 @@
+import time
+from cachelib import SimpleCache, FileSystemCache, NullCache
+
+from app import app
+from app.database import fresh_reads, primary_lsn, require_lsn
+from app.utils.metrics import request_metrics
+
+# Key of the events payload shown to admins (all the groups) and of the events without group
+ALL_GROUPS = 'all'
+NO_GROUP = 'none'
+
+def make_cache():
+    """
+    Cache backend of the configuration: 'filesystem' is shared by all the worker processes of the server,
+    'simple' is kept in the memory of each process and 'null' disables the cache.
+    Both keep at most CALENDAR_CACHE_THRESHOLD entries, evicting the oldest ones.
+    """
+    cache_type = app.config.get('CALENDAR_CACHE_TYPE', 'simple')
+    threshold = app.config.get('CALENDAR_CACHE_THRESHOLD', 5000)
+    timeout = app.config.get('CALENDAR_CACHE_TIMEOUT', 3600)
+    if cache_type == 'filesystem':
+        return FileSystemCache(app.config['CALENDAR_CACHE_DIR'], threshold=threshold, default_timeout=timeout)
+    if cache_type == 'null':
+        return NullCache()
+    return SimpleCache(threshold=threshold, default_timeout=timeout)
+
+class CalendarCache():
+    """
+    Cache of the calendar payloads:
+    - events of a group (or of all groups, or without group) in a date window, shared by all the users of the group
+    - events of a date window the user is signed up to
+    - groups of a user
+    Every group and user has a version stamp in the key of its entries. Mutations bump the stamp, which makes
+    all the entries of that group or user unreachable at once, whatever their window. Stamps are timestamps
+    instead of counters, so a stamp evicted and created again never matches an old entry.
+    Stamps keep the WAL position of the primary after the write that bumped them. Entries are loaded from the
+    replica of the request only if it has replayed the positions of the stamps read, from the primary otherwise.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def count(self, hits, misses):
+        """
+        Hits and misses are counted in the metrics of the worker, added up across workers by /metrics.
+        """
+        if hits:
+            request_metrics.add('simradar_calendar_cache_hits_total', hits)
+        if misses:
+            request_metrics.add('simradar_calendar_cache_misses_total', misses)
+
+    def get_or_load(self, key, loader):
+        value = self.cache.get(key)
+        if value is not None:
+            self.count(1, 0)
+            return value
+        self.count(0, 1)
+        with fresh_reads():
+            value = loader()
+        self.cache.set(key, value)
+        return value
+
+    def version(self, name):
+        key = f'version:{name}'
+        stamp = self.cache.get(key)
+        # stamps are (timestamp, WAL position of the primary or None). A stamp created again after being
+        # evicted may follow a recent write too, so it gets the current position
+        if not isinstance(stamp, tuple):
+            stamp = (time.time_ns(), primary_lsn())
+            self.cache.set(key, stamp, timeout=0)
+        version, lsn = stamp
+        require_lsn(lsn)
+        return version
+
+    def bump(self, *names):
+        """
+        Called after committing the change, so the position of the primary includes it.
+        """
+        stamp = (time.time_ns(), primary_lsn())
+        for name in names:
+            self.cache.set(f'version:{name}', stamp, timeout=0)
+
+    def versions(self, *names):
+        """
+        Current stamps of the names, used to build ETags.
+        """
+        return [self.version(name) for name in names]
+
+    def group_events(self, group_keys, start, end, loader):
+        """
+        Events of each group in the window, as a dict group key: list of events.
+        loader receives the group keys not cached and returns the same kind of dict for them.
+        """
+        keys = {group_key: f'events:{group_key}:{self.version(f"group:{group_key}")}:{start}:{end}' for group_key in group_keys}
+        events = {}
+        missing = []
+        for group_key, key in keys.items():
+            value = self.cache.get(key)
+            if value is None:
+                missing.append(group_key)
+            else:
+                events[group_key] = value
+        self.count(len(events), len(missing))
+        if missing:
+            with fresh_reads():
+                loaded = loader(missing)
+            for group_key in missing:
+                events[group_key] = loaded.get(group_key, [])
+                self.cache.set(keys[group_key], events[group_key])
+        return events
+
+    def user_signups(self, user_id, start, end, loader):
+        key = f'signups:{user_id}:{self.version(f"user:{user_id}")}:{start}:{end}'
+        return self.get_or_load(key, loader)
+
+    def user_groups(self, user_id, loader):
+        key = f'groups:{user_id}:{self.version(f"groups:{user_id}")}'
+        return self.get_or_load(key, loader)
+
+    def invalidate_events(self, *group_ids):
+        """
+        After creating, editing or deleting events of the groups (None for events without group).
+        """
+        group_keys = {ALL_GROUPS} | {NO_GROUP if group_id is None else int(group_id) for group_id in group_ids}
+        self.bump(*[f'group:{group_key}' for group_key in group_keys])
+
+    def invalidate_signups(self, *user_ids):
+        """
+        After the users sign up to or withdraw from an event.
+        """
+        self.bump(*{f'user:{int(user_id)}' for user_id in user_ids})
+
+    def invalidate_seats(self, event_id, group_id):
+        """
+        After a change in the participants or seats of an event: bumps the stamps of the event and of the
+        seat counts of its group, used by the ETags of the participant lists and of the status endpoint.
+        """
+        group_key = NO_GROUP if group_id is None else int(group_id)
+        self.bump(f'event:{int(event_id)}', f'seats:{group_key}', f'seats:{ALL_GROUPS}')
+
+    def invalidate_participants(self, *event_ids):
+        """
+        After a change in the data of participants (e.g. their names) of the events.
+        """
+        self.bump(*{f'event:{int(event_id)}' for event_id in event_ids})
+
+    def invalidate_user_groups(self, *user_ids):
+        """
+        After adding or removing the users from a group.
+        """
+        self.bump(*{f'groups:{int(user_id)}' for user_id in user_ids})
+
+    def stats(self):
+        """
+        Hits and misses of all the workers of the server.
+        """
+        counters = request_metrics.collect()[1]
+        hits = counters.get(('simradar_calendar_cache_hits_total',), 0)
+        misses = counters.get(('simradar_calendar_cache_misses_total',), 0)
+        total = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_ratio': hits / total if total else None}
+
+calendar_cache = CalendarCache(make_cache())
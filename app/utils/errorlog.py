@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import threading
+from datetime import datetime
+from flask import has_request_context, request, session
+
+from app import app
+
+try:
+    import fcntl
+except ImportError: # Windows (development server, single process)
+    fcntl = None
+
+class ErrorLog():
+    """
+    Error log written by a background thread, so the request that fails does not wait for the disk.
+    log() only puts the record in a queue (dropped, and counted, if the queue is full during an outage).
+    The writer appends the records in batches as JSON lines. It rotates the file by size: error_log.jsonl is
+    renamed to error_log.jsonl.1, .1 to .2... and the oldest one is deleted.
+    Batches and rotations hold an exclusive lock on <file>.lock, so the worker processes of the server can
+    share the file. Each process starts its own writer on its first error (gunicorn workers are forked).
+    """
+    def __init__(self, path, max_bytes, backups, batch_size, flush_seconds, queue_size):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.queue_size = queue_size
+        self.pid = None
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=self.queue_size)
+            self.dropped = 0
+            self.writer = threading.Thread(target=self.run, name='error-log-writer', daemon=True)
+            self.writer.start()
+            self.pid = os.getpid()
+
+    def log(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            batch = [record]
+            # wait a little for the errors that come together (an outage fails many requests at once)
+            try:
+                while len(batch) < self.batch_size:
+                    record = self.queue.get(timeout=self.flush_seconds)
+                    if record is None:
+                        self.write(batch)
+                        return
+                    batch.append(record)
+            except queue.Empty:
+                pass
+            if self.dropped:
+                batch.append({'time': datetime.now().isoformat(), 'pid': os.getpid(), 'message': f'{self.dropped} errors not logged, queue full'})
+                self.dropped = 0
+            self.write(batch)
+
+    def write(self, batch):
+        data = ''.join(json.dumps(record, default=str) + '\n' for record in batch)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(f'{self.path}.lock', 'a') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    if os.path.exists(self.path) and os.path.getsize(self.path) + len(data) > self.max_bytes:
+                        self.rotate()
+                    with open(self.path, 'a', encoding='utf-8') as file:
+                        file.write(data)
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        except OSError as e:
+            # last resort, the log itself cannot fail a request
+            print(f'Error log not written ({e}): {data}', file=sys.stderr)
+
+    def rotate(self):
+        for number in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{number}'):
+                os.replace(f'{self.path}.{number}', f'{self.path}.{number + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+    def stop(self):
+        """
+        Write the records still in the queue. Called when the process exits.
+        """
+        if self.pid == os.getpid():
+            self.queue.put(None)
+            self.writer.join(timeout=5)
+            self.pid = None
+
+error_log = ErrorLog(
+    app.config.get('ERROR_LOG_FILE', 'error_log.jsonl'),
+    app.config.get('ERROR_LOG_MAX_BYTES', 5 * 1024 * 1024),
+    app.config.get('ERROR_LOG_BACKUPS', 5),
+    app.config.get('ERROR_LOG_BATCH_SIZE', 100),
+    app.config.get('ERROR_LOG_FLUSH_SECONDS', 1.0),
+    app.config.get('ERROR_LOG_QUEUE_SIZE', 10000),
+)
+atexit.register(error_log.stop)
+
+def log_error(message, exception=None):
+    """
+    Log an error with the route and user of the request, if any, and the type of the exception
+    (the one being handled if not given). Does not block.
+    """
+    exception = exception or sys.exc_info()[1]
+    record = {
+        'time': datetime.now().isoformat(),
+        'pid': os.getpid(),
+        'message': message,
+        'exception': f'{type(exception).__module__}.{type(exception).__qualname__}' if exception else None,
+    }
+    if has_request_context():
+        record['method'] = request.method
+        record['route'] = request.url_rule.rule if request.url_rule else request.path
+        # id saved in the session by Flask-Login, current_user could need the database that just failed
+        record['user_id'] = session.get('_user_id')
+    error_log.log(record)
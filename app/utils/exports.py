@@ -0,0 +1,139 @@
+import csv
+import io
+
+from app.database import db_session
+from app.models import Users, Groups, Events, UserEvents
+
+PARTICIPANTS_HEADER = ['Date', 'Time', 'Name', 'Surname']
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+CSV_MIMETYPE = 'text/csv'
+
+SUMMARY_HEADER = ['Title', 'Group', 'Date', 'Time', 'Participants', 'Maximum']
+
+# Rows fetched from the database at a time
+FETCH_SIZE = 1000
+
+# Characters not allowed by excel in sheet names, and their maximum length
+INVALID_SHEET_CHARACTERS = str.maketrans({character: ' ' for character in '[]:*?/\\'})
+MAX_SHEET_TITLE = 31
+
+def participant_rows(*filters):
+    """
+    Participants of the events matching the filters, with a single join query ordered by event and name.
+    Rows are fetched by chunks and yielded as lists ready to write: date, time, name, surname.
+    """
+    query = db_session.query(Events.date, Events.start_time, Events.end_time, Users.name, Users.surname) \
+        .join(UserEvents, UserEvents.event_id == Events.id) \
+        .join(Users, Users.id == UserEvents.user_id) \
+        .filter(*filters) \
+        .order_by(Events.date, Events.start_time, Events.id, Users.surname, Users.name) \
+        .yield_per(FETCH_SIZE)
+    for date, start_time, end_time, name, surname in query:
+        yield [date.strftime('%d-%m-%Y'), f"{start_time.strftime('%H:%M')} - {end_time.strftime('%H:%M')}", name, surname]
+
+def write_xlsx(rows, header, file):
+    """
+    Write the rows to an excel file (path or file object) with openpyxl write-only mode,
+    which does not keep the rows in memory.
+    """
+    # openpyxl is imported by the first export, not when the workers start
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Participants')
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(file)
+
+def write_csv(rows, header, file):
+    """
+    Write the rows to a csv text file object.
+    """
+    writer = csv.writer(file)
+    writer.writerow(header)
+    writer.writerows(rows)
+
+def stream_csv(rows, header, chunk_size=64 * 1024):
+    """
+    Generator of csv text by chunks, to send the rows while they are being read from the database.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def bulk_participant_rows(*filters):
+    """
+    Events matching the filters with their participants, with a single query ordered by title, date and event.
+    Events without participants are included once, with name and surname None.
+    """
+    return db_session.query(Events.id, Events.title, Events.date, Events.start_time, Events.end_time, Events.n_assistants,
+                            Groups.name, Users.name, Users.surname) \
+        .outerjoin(Groups, Groups.id == Events.group_id) \
+        .outerjoin(UserEvents, UserEvents.event_id == Events.id) \
+        .outerjoin(Users, Users.id == UserEvents.user_id) \
+        .filter(*filters) \
+        .order_by(Events.title, Events.date, Events.start_time, Events.id, Users.surname, Users.name) \
+        .yield_per(FETCH_SIZE)
+
+def sheet_title(name, used_titles):
+    """
+    Valid and unique excel sheet name.
+    """
+    title = name.translate(INVALID_SHEET_CHARACTERS).strip()[:MAX_SHEET_TITLE] or 'Sheet'
+    number = 2
+    while title.lower() in used_titles:
+        suffix = f' ({number})'
+        title = title[:MAX_SHEET_TITLE - len(suffix)] + suffix
+        number += 1
+    used_titles.add(title.lower())
+    return title
+
+def write_bulk_xlsx(rows, file, sheet_per='title'):
+    """
+    Write the rows of bulk_participant_rows to an excel file with a summary sheet (one row per event) and
+    a sheet of participants per title (sheet_per='title') or per event (sheet_per='event').
+    Uses openpyxl write-only mode, every sheet is written as the rows arrive.
+    Returns the number of events written.
+    """
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    summary = workbook.create_sheet('Summary')
+    summary.append(SUMMARY_HEADER)
+    used_titles = {'summary'}
+
+    sheet, sheet_key = None, None
+    current_event, summary_row = None, None
+    number_of_events = 0
+    for event_id, title, date, start_time, end_time, n_assistants, group_name, name, surname in rows:
+        event_date = date.strftime('%d-%m-%Y')
+        event_time = f"{start_time.strftime('%H:%M')} - {end_time.strftime('%H:%M')}"
+        if event_id != current_event:
+            if summary_row:
+                summary.append(summary_row)
+            current_event = event_id
+            summary_row = [title, group_name, event_date, event_time, 0, n_assistants]
+            number_of_events += 1
+
+            key = title if sheet_per == 'title' else event_id
+            if key != sheet_key:
+                name_of_sheet = title if sheet_per == 'title' else f"{date.strftime('%d-%m')} {start_time.strftime('%H%M')} {title}"
+                sheet = workbook.create_sheet(sheet_title(name_of_sheet, used_titles))
+                sheet.append(PARTICIPANTS_HEADER)
+                sheet_key = key
+
+        if name is not None:
+            sheet.append([event_date, event_time, name, surname])
+            summary_row[4] += 1
+    if summary_row:
+        summary.append(summary_row)
+
+    workbook.save(file)
+    return number_of_events
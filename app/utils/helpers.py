@@ -1,26 +1,37 @@
-from flask import redirect, flash
-from app.models import Users
+from flask import redirect, flash, request, Response
 from functools import wraps
+import hashlib
 from flask_login import current_user
 
+from app.database import fresh_reads
+
 def permission_admin(f):
     """
     Decorator for routes that only admins can access.
+    Uses the role of current_user, already loaded for the request.
     """
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        user = Users.query.filter_by(id=current_user.id).first()
-        if user.role_id != 1:
+        if current_user.role_id != 1:
             flash("Access denied.", "danger")
             return redirect("/")
         return f(*args, **kwargs)
     return decorated_function
 
-# function to log errors into csv file
-import csv
-from datetime import datetime
-
-def log_error_to_csv(error_message):
-    with open('error_log.csv', mode='a', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow([error_message, datetime.now()])
+def conditional_response(etag_parts, build_response):
+    """
+    Response with an ETag built from etag_parts (version stamps that change when the data changes).
+    If the browser already has that version, answers 304 without calling build_response.
+    build_response reads from a replica only if it has replayed the writes of the stamps (see fresh_reads),
+    so the ETag of the new stamps is never given to data older than them.
+    """
+    etag = hashlib.sha1(repr(etag_parts).encode()).hexdigest()
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        with fresh_reads():
+            response = build_response()
+    response.set_etag(etag)
+    # the browser must revalidate every time, the ETag makes it cheap
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
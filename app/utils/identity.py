@@ -0,0 +1,54 @@
+from flask_login import UserMixin
+
+from app import app
+from app.database import db_session, fresh_reads, primary_lsn
+from app.models import Users
+from app.utils.cache import calendar_cache
+
+# Identities of the logged users are kept in the backend of the calendar cache ('filesystem' by default), shared
+# by all the worker processes: invalidate_identity is seen at once by every worker, not after USER_CACHE_TTL
+_identities = calendar_cache.cache
+
+def identity_key(user_id):
+    return f'identity:{int(user_id)}'
+
+class CachedUser(UserMixin):
+    """
+    Logged user built from the cache, with the columns of Users used by the views and templates.
+    """
+    def __init__(self, id, name, surname, username, role_id):
+        self.id = id
+        self.name = name
+        self.surname = surname
+        self.username = username
+        self.role_id = role_id
+
+def load_identity(user_id):
+    """
+    User with the id, or None. Read from the cache when USER_CACHE_TTL is set, from the database otherwise.
+    Flask-Login calls it once per request and keeps the result as current_user for the rest of the request.
+    """
+    ttl = app.config.get('USER_CACHE_TTL', 0)
+    identity = _identities.get(identity_key(user_id)) if ttl else None
+    if identity is not None and 'lsn' not in identity:
+        return CachedUser(**identity)
+
+    # after invalidate_identity, a replica that has not replayed the change yet is not read (it would be cached)
+    with fresh_reads(identity and identity['lsn']):
+        user = db_session.get(Users, user_id)
+    if user is None or not ttl:
+        return user
+    identity = {'id': user.id, 'name': user.name, 'surname': user.surname, 'username': user.username, 'role_id': user.role_id}
+    _identities.set(identity_key(user_id), identity, timeout=ttl)
+    return CachedUser(**identity)
+
+def invalidate_identity(user_id):
+    """
+    Forget the cached identity of a user, after committing a change or its deletion. With replicas, it is replaced
+    by the WAL position of the primary, which the replica must have replayed to load the identity again.
+    """
+    lsn = primary_lsn()
+    if lsn is None:
+        _identities.delete(identity_key(user_id))
+    else:
+        _identities.set(identity_key(user_id), {'lsn': lsn})
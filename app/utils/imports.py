@@ -0,0 +1,166 @@
+import io
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from werkzeug.security import generate_password_hash
+
+from app import app
+from app.database import db_session
+from app.models import Users, UserGroups
+
+# Columns of the excel file with users (see upload_users_template.xlsx)
+USERS_FILE_COLUMNS = ['Nom', 'Primer cognom', 'Segon cognom', 'Correu', 'Nif']
+
+# Below this number of passwords the pool is not worth it
+MIN_PARALLEL_HASHES = 8
+
+_hash_pool = None
+
+def hash_workers():
+    """
+    Hashing processes of this worker: its share of IMPORT_HASH_WORKERS among the SERVER_WORKERS workers.
+    """
+    return max(1, app.config.get('IMPORT_HASH_WORKERS', 1) // max(1, app.config.get('SERVER_WORKERS', 1)))
+
+def get_hash_pool():
+    """
+    Process pool used to hash passwords, created on first use and shared by all the imports of the worker.
+    Its processes are started by a forkserver: forking the worker itself could copy locks held by its other
+    threads (jobs, error log writer, seat notifications, request threads) and deadlock.
+    """
+    global _hash_pool
+    if _hash_pool is None:
+        _hash_pool = ProcessPoolExecutor(max_workers=hash_workers(), mp_context=multiprocessing.get_context('forkserver'))
+        atexit.register(_hash_pool.shutdown, wait=False, cancel_futures=True)
+    return _hash_pool
+
+def hash_passwords(passwords):
+    """
+    Hash the initial passwords with the method of the configuration. Returns an iterator with the hashes in order.
+    All the passwords are submitted to the pool at once, so they keep being hashed while the caller consumes the first ones.
+    """
+    hasher = partial(generate_password_hash, method=app.config.get('IMPORT_PASSWORD_METHOD', 'scrypt'),
+                     salt_length=app.config.get('IMPORT_PASSWORD_SALT_LENGTH', 16))
+    workers = hash_workers()
+    if workers <= 1 or len(passwords) < MIN_PARALLEL_HASHES:
+        return map(hasher, passwords)
+    return get_hash_pool().map(hasher, passwords, chunksize=max(1, len(passwords) // (workers * 4)))
+
+def insert_users(new_users):
+    """
+    Bulk insert users, skipping the usernames that already exist. Returns a dict username: id of the users created.
+    """
+    result = db_session.execute(
+        insert(Users).on_conflict_do_nothing(index_elements=['username']).returning(Users.username, Users.id),
+        new_users
+    )
+    return dict(result.all())
+
+def read_users_file(excel_data):
+    """
+    Read and normalize the excel file with users. Raises ValueError if it is not an excel file or the columns are not the expected ones.
+    Returns a DataFrame with the columns row, name, surname, username, password and error
+    (reason to reject the row, empty if valid).
+    """
+    # pandas (and numpy) are imported the first time a file is read, not when the workers start
+    import pandas as pd
+    try:
+        users_df = pd.read_excel(io.BytesIO(excel_data), dtype=str)
+    except Exception as e: # not an excel file, or a damaged one
+        raise ValueError(f"Invalid excel file: {e}")
+    if any(column not in users_df.columns for column in USERS_FILE_COLUMNS):
+        raise ValueError("Invalid excel file format. Please check the column names.")
+
+    users_df = users_df[USERS_FILE_COLUMNS].fillna('').apply(lambda column: column.str.strip())
+    users_df = pd.DataFrame({
+        'row': users_df.index + 2, # row number in excel (row 1 is the header)
+        'name': users_df['Nom'],
+        'surname': (users_df['Primer cognom'] + ' ' + users_df['Segon cognom']).str.strip(),
+        'username': users_df['Correu'],
+        'password': users_df['Nif'],
+        'error': '',
+    })
+
+    missing = (users_df['name'] == '') | (users_df['username'] == '') | (users_df['password'] == '')
+    users_df.loc[missing, 'error'] = 'Missing name, email or NIF.'
+    duplicated = ~missing & users_df['username'].duplicated()
+    users_df.loc[duplicated, 'error'] = 'Email repeated in the file.'
+    return users_df
+
+def add_users_to_group(user_ids, group_id):
+    """
+    Add the users to the group, skipping the ones already in it (unique index on user_id, group_id). Does not commit.
+    Returns the set of user ids added.
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return set()
+    return set(db_session.scalars(
+        insert(UserGroups).values([{'user_id': user_id, 'group_id': group_id} for user_id in user_ids])
+        .on_conflict_do_nothing(index_elements=['user_id', 'group_id'])
+        .returning(UserGroups.user_id)
+    ))
+
+def import_users(users_df, group_id=None, progress=None):
+    """
+    Import the users of an excel file read by read_users_file, and add them to the group if group_id is given.
+    New users get role user and their NIF as password. Existing users (same email) are not modified.
+    All the rows are written with bulk inserts in the current transaction, the caller commits.
+    progress is an optional function called with the percentage done.
+    Returns a report with one dict per row: row, username, status (created, added, skipped or rejected) and detail.
+    """
+    valid_df = users_df[users_df['error'] == '']
+
+    # One query for all the users of the file that already exist
+    existing = dict(db_session.execute(select(Users.username, Users.id).where(Users.username.in_(valid_df['username'].tolist()))).all())
+
+    new_df = valid_df[~valid_df['username'].isin(list(existing))]
+    created = {}
+    batch_size = app.config.get('IMPORT_BATCH_SIZE', 200)
+    hashes = hash_passwords(new_df['password'].tolist())
+    new_users = []
+    # Users are inserted by batches as their hashes are ready, while the pool hashes the next ones
+    for (name, surname, username), password_hash in zip(new_df[['name', 'surname', 'username']].itertuples(index=False), hashes):
+        new_users.append({'name': name, 'surname': surname, 'username': username, 'hash': password_hash, 'role_id': 2})
+        if len(new_users) == batch_size:
+            created.update(insert_users(new_users))
+            new_users = []
+            if progress:
+                progress(90 * len(created) / len(new_df))
+    if new_users:
+        created.update(insert_users(new_users))
+
+    # Users created by someone else while importing were skipped by the inserts: they are existing users
+    conflicts = new_df['username'][~new_df['username'].isin(list(created))].tolist()
+    if conflicts:
+        existing.update(db_session.execute(select(Users.username, Users.id).where(Users.username.in_(conflicts))).all())
+
+    added = set()
+    if group_id is not None:
+        added = add_users_to_group(list(existing.values()) + list(created.values()), group_id)
+
+    report = []
+    for row, username, error in users_df[['row', 'username', 'error']].itertuples(index=False):
+        row = int(row)
+        if error:
+            report.append({'row': row, 'username': username, 'status': 'rejected', 'detail': error})
+        elif username in created:
+            report.append({'row': row, 'username': username, 'status': 'created', 'detail': 'User created.', 'user_id': created[username]})
+        elif username in existing and existing[username] in added:
+            report.append({'row': row, 'username': username, 'status': 'added', 'detail': 'Existing user added to the group.', 'user_id': existing[username]})
+        elif username in existing and group_id is not None:
+            report.append({'row': row, 'username': username, 'status': 'skipped', 'detail': 'User is already in the group.'})
+        else:
+            report.append({'row': row, 'username': username, 'status': 'skipped', 'detail': 'User already exists.'})
+    return report
+
+def summarize_import_report(report):
+    """
+    Summary message of the report returned by import_users.
+    """
+    counts = {status: sum(1 for row in report if row['status'] == status) for status in ('created', 'added', 'skipped', 'rejected')}
+    return (f"Excel imported: {counts['created']} users created, {counts['added']} existing users added to group, "
+            f"{counts['skipped']} skipped, {counts['rejected']} rejected.")
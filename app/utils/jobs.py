@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import update, func
+
+from app import app
+from app.database import db_session, engine
+from app.models import Jobs
+from .errorlog import log_error
+
+# Functions that can run as a job, by kind. Registered with the register_job decorator
+JOB_FUNCTIONS = {}
+
+_executor = None
+# Ids of the queued and running jobs of this worker process, kept alive by its heartbeat thread
+_active_jobs = set()
+
+def register_job(kind):
+    """
+    Decorator to register a function as a job. The function receives a JobContext and the
+    arguments given to submit_job, and may return a dict with message and report.
+    """
+    def decorator(f):
+        JOB_FUNCTIONS[kind] = f
+        return f
+    return decorator
+
+def get_executor():
+    """
+    Threads of this worker process that run the jobs, created on first use.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=app.config.get('JOB_WORKERS', 2), thread_name_prefix='job')
+        threading.Thread(target=heartbeat, name='job-heartbeat', daemon=True).start()
+    return _executor
+
+def heartbeat():
+    """
+    Mark the queued and running jobs of this process as alive every JOB_HEARTBEAT_SECONDS. When the process
+    dies its jobs stop being marked, and fail_orphaned_jobs fails them.
+    """
+    while True:
+        time.sleep(app.config.get('JOB_HEARTBEAT_SECONDS', 10))
+        job_ids = list(_active_jobs)
+        if not job_ids:
+            continue
+        try:
+            with engine.begin() as connection:
+                connection.execute(update(Jobs).where(Jobs.id.in_(job_ids)).values(heartbeat_at=datetime.now()))
+        except Exception as e:
+            log_error(f'Job heartbeat error: {e}', e)
+
+def fail_orphaned_jobs(job_id=None):
+    """
+    Fail the queued and running jobs (only job_id if given) without heartbeat for JOB_ORPHAN_SECONDS: their worker
+    process was restarted or recycled, and their arguments were only in its memory. Returns the number of jobs failed.
+    """
+    cutoff = datetime.now() - timedelta(seconds=app.config.get('JOB_ORPHAN_SECONDS', 120))
+    query = update(Jobs).where(Jobs.status.in_(('queued', 'running')), func.coalesce(Jobs.heartbeat_at, Jobs.created_at) < cutoff)
+    if job_id is not None:
+        query = query.where(Jobs.id == job_id)
+    with engine.begin() as connection:
+        return connection.execute(query.values(status='failed', finished_at=datetime.now(),
+                                               message='Error: the server restarted before the job finished, try again')).rowcount
+
+class JobContext():
+    """
+    Handle given to the job functions to report progress and create the result file.
+    """
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.result_path = None
+        self.result_name = None
+
+    def progress(self, percent, message=None):
+        # Own connection, so the progress is visible while the job transaction is still open
+        values = {'progress': int(percent)}
+        if message is not None:
+            values['message'] = message
+        with engine.begin() as connection:
+            connection.execute(update(Jobs).where(Jobs.id == self.job_id).values(**values))
+
+    def result_file(self, name):
+        """
+        Path where the job writes the file to download, name is the file name given to the user.
+        """
+        directory = os.path.join(app.config['JOBS_DIR'], str(self.job_id))
+        os.makedirs(directory, exist_ok=True)
+        self.result_path = os.path.join(directory, 'result' + os.path.splitext(name)[1])
+        self.result_name = name
+        return self.result_path
+
+def set_job(job_id, **values):
+    with engine.begin() as connection:
+        connection.execute(update(Jobs).where(Jobs.id == job_id).values(**values))
+
+def run_job(job_id, kind, kwargs):
+    """
+    Run a job in a thread of the executor, saving its status in the jobs table.
+    """
+    context = JobContext(job_id)
+    with app.app_context():
+        try:
+            set_job(job_id, status='running')
+            result = JOB_FUNCTIONS[kind](context, **kwargs) or {}
+            set_job(job_id, status='done', progress=100, finished_at=datetime.now(),
+                    message=result.get('message'), report=json.dumps(result.get('report')) if result.get('report') else None,
+                    result_path=context.result_path, result_name=context.result_name)
+        except Exception as e:
+            db_session.rollback()
+            log_error(f'Job {job_id} ({kind}) error: {e}')
+            set_job(job_id, status='failed', finished_at=datetime.now(), message=f'Error: {e}'[:255])
+        finally:
+            _active_jobs.discard(job_id)
+            db_session.remove()
+
+def submit_job(kind, user_id, **kwargs):
+    """
+    Save a new job and queue it. Returns the job id.
+    """
+    new_job = Jobs(kind=kind, user_id=user_id, status='queued', progress=0, heartbeat_at=datetime.now())
+    db_session.add(new_job)
+    db_session.commit()
+    executor = get_executor()
+    _active_jobs.add(new_job.id)
+    executor.submit(run_job, new_job.id, kind, kwargs)
+    return new_job.id
+
+def job_status(job):
+    """
+    Dict with the status of a job, used by the polling endpoint.
+    """
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'message': job.message,
+        'report': json.loads(job.report) if job.report else None,
+        'result': f'/jobs/{job.id}/result' if job.status == 'done' and job.result_path else None,
+    }
@@ -0,0 +1,286 @@
+import os
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+
+from app import app
+from app.database import engines
+
+try:
+    import fcntl
+except ImportError: # Windows (development server, single process)
+    fcntl = None
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# name: (help, buckets) of the histograms recorded per route and method
+HISTOGRAMS = {
+    'simradar_request_duration_seconds': ('Wall time of the requests', SECONDS_BUCKETS),
+    'simradar_request_queries': ('SQL statements executed by the requests', QUERIES_BUCKETS),
+    'simradar_request_sql_seconds': ('Time spent by the requests waiting for SQL statements', SECONDS_BUCKETS),
+}
+# File of METRICS_DIR with the metrics of the worker processes that exited
+RETIRED_FILE = 'retired.json'
+
+REQUEST_LABELS = ('route', 'method', 'status')
+# name: (help, labels) of the counters
+COUNTERS = {
+    'simradar_requests_total': ('Requests answered', REQUEST_LABELS),
+    'simradar_query_budget_exceeded_total': ('Requests that executed more SQL statements than METRICS_QUERY_BUDGET', REQUEST_LABELS),
+    'simradar_calendar_cache_hits_total': ('Calendar cache entries found in the cache', ()),
+    'simradar_calendar_cache_misses_total': ('Calendar cache entries loaded from the database', ()),
+}
+
+class RequestMetrics():
+    """
+    Histograms and counters of the requests of this worker process. Every METRICS_FLUSH_SECONDS they are saved
+    to METRICS_DIR/<pid>.json, and the metrics endpoint adds up the files of all the workers (the request
+    that reads them is answered by only one of them).
+    The files of the workers that exited are added to RETIRED_FILE and removed: by the worker itself when it
+    exits, or by the first save of a later worker if it was killed. So restarts and recycled workers do not
+    leave files behind, and a new worker with the pid of an old one does not overwrite its counts: the sums
+    served never go down.
+    """
+    def __init__(self, directory, flush_seconds):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.histograms = {}  # (name, route, method): [bucket counts..., +Inf count, sum]
+        self.counters = {}  # (name, *labels): count
+        self.flushed = 0
+        self.saved = False
+
+    def observe(self, route, method, status, seconds, queries, sql_seconds, over_budget):
+        with self.lock:
+            self.check_fork()
+            for name, value in (('simradar_request_duration_seconds', seconds), ('simradar_request_queries', queries),
+                                ('simradar_request_sql_seconds', sql_seconds)):
+                buckets = HISTOGRAMS[name][1]
+                counts = self.histograms.setdefault((name, route, method), [0] * (len(buckets) + 2))
+                for number, bound in enumerate(buckets):
+                    if value <= bound:
+                        counts[number] += 1
+                counts[-2] += 1
+                counts[-1] += value
+            self.count('simradar_requests_total', route, method, status)
+            if over_budget:
+                self.count('simradar_query_budget_exceeded_total', route, method, status)
+            self.save_due()
+
+    def add(self, name, amount=1, labels=()):
+        """
+        Add amount to a counter, outside of the request metrics (e.g. the calendar cache).
+        """
+        with self.lock:
+            self.check_fork()
+            self.count(name, *labels, amount=amount)
+            self.save_due()
+
+    def check_fork(self):
+        if self.pid != os.getpid():
+            # forked worker, the counts of the parent are not its own
+            self.reset()
+
+    def save_due(self):
+        if time.monotonic() - self.flushed > self.flush_seconds:
+            self.save()
+
+    def count(self, name, *labels, amount=1):
+        key = (name, *labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with self.files_lock(fcntl and fcntl.LOCK_EX):
+            if not self.saved:
+                # first save of this process: files of workers that exited without retiring theirs,
+                # and an old file with the same pid, are not of a running worker
+                self.retire(lambda pid: pid == self.pid or not process_alive(pid))
+                self.saved = True
+            write_snapshot(os.path.join(self.directory, f'{self.pid}.json'), self.histograms, self.counters)
+        self.flushed = time.monotonic()
+
+    def exit(self):
+        """
+        Add the metrics of this process to RETIRED_FILE when it exits.
+        """
+        with self.lock:
+            if self.pid != os.getpid() or not (self.histograms or self.counters or self.saved):
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            with self.files_lock(fcntl and fcntl.LOCK_EX):
+                write_snapshot(os.path.join(self.directory, f'{self.pid}.json'), self.histograms, self.counters)
+                self.retire(lambda pid: pid == self.pid)
+
+    def retire(self, is_retired):
+        """
+        Add the files of the pids for which is_retired is true to RETIRED_FILE and remove them.
+        Called with the exclusive lock of the files.
+        """
+        retired_path = os.path.join(self.directory, RETIRED_FILE)
+        histograms, counters = read_snapshots([retired_path])
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if name.endswith('.json') and name[:-5].isdigit() and is_retired(int(name[:-5]))]
+        if not paths:
+            return
+        add_snapshots(histograms, counters, read_snapshots(paths))
+        write_snapshot(retired_path, histograms, counters)
+        for path in paths:
+            os.remove(path)
+
+    @contextmanager
+    def files_lock(self, operation):
+        """
+        Lock on the files of METRICS_DIR shared by the worker processes: exclusive to save and retire files,
+        shared to read them, so a file is never counted both alone and in RETIRED_FILE.
+        """
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def collect(self):
+        """
+        Metrics of all the workers: the saved files of the others and of the exited ones, and the current
+        ones of this process.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                self.save()
+        if not os.path.isdir(self.directory):
+            return {}, {}
+        with self.files_lock(fcntl and fcntl.LOCK_SH):
+            return read_snapshots([os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.json')])
+
+def process_alive(pid):
+    if os.name != 'posix':
+        return True  # os.kill would terminate it
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # a process of another user has the pid
+    return True
+
+def write_snapshot(path, histograms, counters):
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump({'histograms': [[*key, counts] for key, counts in histograms.items()],
+                   'counters': [[*key, count] for key, count in counters.items()]}, file)
+    os.replace(f'{path}.tmp', path)
+
+def read_snapshots(paths):
+    """
+    Sum of the saved metrics of the files, as (histograms, counters). Missing files are skipped.
+    """
+    histograms, counters = {}, {}
+    for path in paths:
+        try:
+            with open(path) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            continue
+        histograms_of_file = {tuple(key): counts for *key, counts in snapshot['histograms']}
+        counters_of_file = {tuple(key): count for *key, count in snapshot['counters']}
+        add_snapshots(histograms, counters, (histograms_of_file, counters_of_file))
+    return histograms, counters
+
+def add_snapshots(histograms, counters, snapshot):
+    for key, counts in snapshot[0].items():
+        total = histograms.setdefault(key, [0] * len(counts))
+        histograms[key] = [a + b for a, b in zip(total, counts)]
+    for key, count in snapshot[1].items():
+        counters[key] = counters.get(key, 0) + count
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus_text(histograms, counters):
+    """
+    Metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for (metric, route, method), counts in sorted(histograms.items()):
+            if metric != name:
+                continue
+            labels = f'route="{label(route)}",method="{method}"'
+            for bound, count in zip(buckets, counts):
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {counts[-2]}')
+            lines.append(f'{name}_sum{{{labels}}} {counts[-1]:.6g}')
+            lines.append(f'{name}_count{{{labels}}} {counts[-2]}')
+    for name, (help_text, label_names) in COUNTERS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for (metric, *values), count in sorted(counters.items()):
+            if metric == name:
+                labels = ','.join(f'{label_name}="{label(value)}"' for label_name, value in zip(label_names, values))
+                lines.append(f'{name}{{{labels}}} {count}' if labels else f'{name} {count}')
+    return '\n'.join(lines) + '\n'
+
+request_metrics = RequestMetrics(app.config.get('METRICS_DIR', 'metrics'), app.config.get('METRICS_FLUSH_SECONDS', 5))
+atexit.register(request_metrics.exit)
+
+# SQL statements of the request: counted when they start, timed when they end (statements of background jobs,
+# outside of a request, are not counted)
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_start'].pop()
+    if has_request_context() and 'request_start' in g:
+        g.request_queries += 1
+        g.request_sql_seconds += time.perf_counter() - started
+
+def failed_query(context):
+    # a failed statement does not reach after_cursor_execute
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+# the primary and the replicas
+for database_engine in engines:
+    event.listen(database_engine, 'before_cursor_execute', start_query)
+    event.listen(database_engine, 'after_cursor_execute', end_query)
+    event.listen(database_engine, 'handle_error', failed_query)
+
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    g.request_queries = 0
+    g.request_sql_seconds = 0.0
+
+@app.after_request
+def record_request(response):
+    if 'request_start' not in g:
+        return response
+    seconds = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    budget = app.config.get('METRICS_QUERY_BUDGET')
+    over_budget = bool(budget) and g.request_queries > budget
+    if over_budget:
+        app.logger.warning('Query budget exceeded: %s %s executed %d SQL statements (budget %d)',
+                           request.method, request.path, g.request_queries, budget)
+    slow = app.config.get('METRICS_SLOW_REQUEST_SECONDS')
+    if slow and seconds > slow:
+        app.logger.warning('Slow request: %s %s took %.3f s (%d SQL statements, %.3f s in SQL)',
+                           request.method, request.path, seconds, g.request_queries, g.request_sql_seconds)
+    request_metrics.observe(route, request.method, response.status_code, seconds, g.request_queries, g.request_sql_seconds, over_budget)
+    return response
+
+def metrics_text():
+    return prometheus_text(*request_metrics.collect())
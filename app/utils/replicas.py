@@ -0,0 +1,64 @@
+import random
+from flask import g, request, session, has_request_context
+from sqlalchemy import event, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import app
+from app.database import replica_engines, RoutingSession, primary_lsn
+
+# Requests of the read_only routes that can be answered by a replica
+READ_METHODS = ('GET', 'HEAD')
+
+def read_only(f):
+    """
+    Decorator for routes whose GET requests only read: they are answered from a replica when there is one.
+    A user who has just written reads from the primary until the replica has replayed the write.
+    """
+    f.read_only = True
+    return f
+
+def replica_caught_up(replica, lsn):
+    """
+    True if the replica has replayed the WAL of the primary up to lsn (the position after a write).
+    False if it has not, if it is not a replica or if it cannot be reached.
+    """
+    try:
+        with replica.connect() as connection:
+            return bool(connection.scalar(text('SELECT pg_last_wal_replay_lsn() >= CAST(:lsn AS pg_lsn)'), {'lsn': lsn}))
+    except SQLAlchemyError:
+        return False
+
+@app.before_request
+def choose_database():
+    g.db_replica = None
+    view = app.view_functions.get(request.endpoint)
+    if not replica_engines or request.method not in READ_METHODS or not getattr(view, 'read_only', False):
+        return
+    replica = random.choice(replica_engines)
+    # read-your-writes: position of the last write of this user, kept in its session cookie
+    lsn = session.get('db_lsn')
+    if lsn:
+        if not replica_caught_up(replica, lsn):
+            return
+        session.pop('db_lsn')
+    g.db_replica = replica
+
+@event.listens_for(RoutingSession, 'after_commit')
+def committed(db_session):
+    # commits of background jobs are not of the user of a request
+    if has_request_context():
+        g.db_committed = True
+        # the position of the primary is read again after this write (primary_lsn)
+        g.db_primary_lsn = None
+
+@app.after_request
+def remember_write(response):
+    """
+    After a request that committed, save in the session of the user the WAL position of the primary,
+    which the replicas must reach before answering the user.
+    """
+    if replica_engines and g.get('db_committed'):
+        lsn = primary_lsn()
+        if lsn:
+            session['db_lsn'] = lsn
+    return response
@@ -0,0 +1,149 @@
+import json
+import base64
+from sqlalchemy import select, func, or_, true, tuple_
+
+from app.database import db_session
+from app.models import Users, Groups, UserGroups
+
+# Rows returned per page by the roster API, and maximum a client can ask for
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Orders of the user listing: columns compared by the keyset, the id always breaks ties
+USER_SORTS = {
+    'surname': (Users.surname, Users.name),
+    'name': (Users.name, Users.surname),
+    'username': (Users.username,),
+}
+
+# Text of a user searched by substring (indexed with pg_trgm where available, see app/database/migrations.py)
+USER_SEARCH_TEXT = func.lower(Users.name + ' ' + Users.surname + ' ' + Users.username)
+
+def page_args(args, default_size=PAGE_SIZE):
+    """
+    Page number (from 1) and size of the query string arguments page and per_page.
+    """
+    try:
+        page = max(int(args.get('page', 1)), 1)
+        per_page = min(max(int(args.get('per_page', default_size)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        page, per_page = 1, default_size
+    return page, per_page
+
+def like_pattern(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def contains(column, text):
+    """
+    Case insensitive substring condition, with the LIKE wildcards of the text escaped.
+    """
+    return column.ilike(f'%{like_pattern(text)}%', escape='\\')
+
+def user_search_condition(search, mode='prefix'):
+    """
+    prefix: the name, the surname or the username starts with the search (uses the lower(column) indexes).
+    contains: the search appears anywhere in "name surname username".
+    """
+    text = like_pattern(search.lower())
+    if mode == 'contains':
+        return USER_SEARCH_TEXT.like(f'%{text}%')
+    return or_(*[func.lower(column).like(f'{text}%') for column in (Users.name, Users.surname, Users.username)])
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor, size):
+    """
+    Values of the last row of the previous page, None for the first page. Raises ValueError.
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError('Invalid cursor')
+    return values
+
+def user_page(search='', mode='prefix', sort='surname', descending=False, after=None, per_page=PAGE_SIZE):
+    """
+    Page of users ordered by sort, continuing after the cursor of the previous page (keyset pagination):
+    the database seeks the index to the last row read instead of skipping the previous pages.
+    Raises ValueError for an unknown sort or an invalid cursor.
+    """
+    if sort not in USER_SORTS:
+        raise ValueError('Invalid sort')
+    keys = USER_SORTS[sort] + (Users.id,)
+    last = decode_cursor(after, len(keys))
+
+    query = select(Users.id, Users.name, Users.surname, Users.username, Users.role_id)
+    if search:
+        query = query.where(user_search_condition(search, mode))
+    if last is not None:
+        query = query.where(tuple_(*keys) < tuple_(*last) if descending else tuple_(*keys) > tuple_(*last))
+    rows = db_session.execute(
+        query.order_by(*[key.desc() if descending else key for key in keys]).limit(per_page + 1)
+    ).all()
+
+    users = [{'id': user_id, 'name': name, 'surname': surname, 'username': username, 'role_id': role_id}
+             for user_id, name, surname, username, role_id in rows[:per_page]]
+    next_cursor = None
+    if len(rows) > per_page:
+        next_cursor = encode_cursor([users[-1][key.key] for key in keys])
+    return {'users': users, 'next': next_cursor}
+
+def group_page(search='', page=1, per_page=PAGE_SIZE):
+    """
+    Groups ordered by name with their number of members, counted by the database.
+    Two queries: the page and the total number of groups matching the search.
+    """
+    condition = contains(Groups.name, search) if search else true()
+    # rows left without user by deletions before delete_user removed them are not members
+    member_counts = select(UserGroups.group_id, func.count(UserGroups.user_id).label('members')).group_by(UserGroups.group_id).subquery()
+    rows = db_session.execute(
+        select(Groups.id, Groups.name, func.coalesce(member_counts.c.members, 0))
+        .outerjoin(member_counts, member_counts.c.group_id == Groups.id)
+        .where(condition)
+        .order_by(Groups.name, Groups.id)
+        .limit(per_page).offset((page - 1) * per_page)
+    ).all()
+    total = db_session.scalar(select(func.count()).select_from(Groups).where(condition))
+    return {
+        'groups': [{'id': group_id, 'name': name, 'members': members} for group_id, name, members in rows],
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+    }
+
+def member_page(group_id, page=1, per_page=PAGE_SIZE):
+    """
+    Members of a group ordered by surname and name, with one join query per page.
+    One row more than the page is read to know if there are more pages.
+    """
+    rows = db_session.execute(
+        select(Users.id, Users.name, Users.surname, Users.username)
+        .join(UserGroups, UserGroups.user_id == Users.id)
+        .where(UserGroups.group_id == group_id)
+        .order_by(Users.surname, Users.name, Users.id)
+        .limit(per_page + 1).offset((page - 1) * per_page)
+    ).all()
+    return {
+        'members': [{'id': user_id, 'name': name, 'surname': surname, 'username': username}
+                    for user_id, name, surname, username in rows[:per_page]],
+        'page': page,
+        'has_more': len(rows) > per_page,
+    }
+
+def user_options(search='', page=1, per_page=20):
+    """
+    Users matching the search in name, surname or username, in the format of select2 ajax results.
+    """
+    query = select(Users.id, Users.name, Users.surname, Users.username)
+    if search:
+        query = query.where(or_(contains(Users.name, search), contains(Users.surname, search), contains(Users.username, search)))
+    rows = db_session.execute(query.order_by(Users.surname, Users.name, Users.id).limit(per_page + 1).offset((page - 1) * per_page)).all()
+    return {
+        'results': [{'id': user_id, 'text': f'{name} {surname} ({username})'} for user_id, name, surname, username in rows[:per_page]],
+        'pagination': {'more': len(rows) > per_page},
+    }
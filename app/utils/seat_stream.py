@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import queue
+import select
+import threading
+from sqlalchemy import text
+
+from app import app
+from app.database import db_session, engine
+from app.utils.cache import ALL_GROUPS, NO_GROUP
+from app.utils.errorlog import log_error
+
+# PostgreSQL channel of the seat changes, shared by all the worker processes
+SEATS_CHANNEL = 'seat_changes'
+# Sent to the streams instead of a change when changes may have been lost: clients load the status again
+RESYNC = 'resync'
+
+def notify_seats(*event_ids):
+    """
+    Notify the seat counts of the events to the streams. Runs in the transaction of the change: PostgreSQL
+    delivers the notifications when it commits, and drops them if it is rolled back.
+    """
+    if event_ids:
+        db_session.execute(text(
+            "SELECT pg_notify(:channel, json_build_object("
+            "'id', id, 'occurrence_id', 's' || series_id || '-' || to_char(date, 'YYYYMMDD'), 'date', date, "
+            "'group_id', group_id, 'seats_taken', seats_taken, 'n_assistants', n_assistants, "
+            "'remaining', greatest(n_assistants - seats_taken, 0))::text) "
+            "FROM events WHERE id = ANY(:ids)"
+        ), {'channel': SEATS_CHANNEL, 'ids': [int(event_id) for event_id in event_ids]})
+
+def notify_deleted(group_id, event_id=None, occurrence_id=None, series_id=None, date=None):
+    """
+    Notify to the streams that an event, an occurrence or a whole series (without date) was deleted.
+    """
+    payload = {'id': event_id, 'occurrence_id': occurrence_id, 'series_id': series_id,
+               'date': date and date.isoformat(), 'group_id': group_id, 'deleted': True}
+    db_session.execute(text('SELECT pg_notify(:channel, :payload)'), {'channel': SEATS_CHANNEL, 'payload': json.dumps(payload)})
+
+class SeatBus():
+    """
+    Seat changes received by this worker process, handed to the queue of every open stream. A thread started
+    by the first stream LISTENs on its own connection to the primary (notifications are not replicated).
+    A stream that does not keep up, or a lost connection, sends a resync instead of the missed changes.
+    Each stream holds a thread of the worker while it is open, so at most max_streams are open at once.
+    """
+    def __init__(self, queue_size, max_streams):
+        self.queue_size = queue_size
+        self.max_streams = max_streams
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.pid = None
+
+    def subscribe(self):
+        """
+        Queue of the changes for a new stream, or None if max_streams are already open.
+        """
+        subscriber = queue.Queue(self.queue_size)
+        with self.lock:
+            if len(self.subscribers) >= self.max_streams:
+                return None
+            if self.pid != os.getpid():
+                # first stream of this process (gunicorn workers are forked)
+                self.pid = os.getpid()
+                threading.Thread(target=self.listen, daemon=True).start()
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, change):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(change)
+            except queue.Full:
+                with subscriber.mutex:
+                    subscriber.queue.clear()
+                subscriber.put_nowait(RESYNC)
+
+    def listen(self):
+        reconnecting = False
+        while True:
+            connection = None
+            try:
+                # detached from the pool: it is held as long as the process lives
+                connection = engine.raw_connection()
+                listener = connection.driver_connection
+                connection.detach()
+                listener.autocommit = True
+                listener.cursor().execute(f'LISTEN {SEATS_CHANNEL}')
+                if reconnecting:
+                    self.publish(RESYNC)
+                while True:
+                    if select.select([listener], [], [], 60)[0]:
+                        listener.poll()
+                        while listener.notifies:
+                            self.publish(json.loads(listener.notifies.pop(0).payload))
+            except Exception as e:
+                log_error(f'Seat notifications: {e}', e)
+                reconnecting = True
+                time.sleep(5)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+seat_bus = SeatBus(app.config.get('SEAT_STREAM_QUEUE_SIZE', 100), app.config.get('SEAT_STREAM_MAX_STREAMS', 40))
+
+def visible(change, start, end, group_keys):
+    group_key = NO_GROUP if change['group_id'] is None else change['group_id']
+    if ALL_GROUPS not in group_keys and group_key not in group_keys:
+        return False
+    # deleted series have no date
+    return change['date'] is None or str(start) <= change['date'] < str(end)
+
+def seat_events(subscriber, start, end, group_keys):
+    """
+    Server-sent events with the seat changes received by the subscriber (of seat_bus.subscribe) of the events of
+    the groups in the window [start, end). Comments keep the connection alive every SEAT_STREAM_HEARTBEAT_SECONDS,
+    and the stream ends after SEAT_STREAM_MAX_SECONDS to free the worker thread; the browser reconnects by itself.
+    The caller unsubscribes when the response is closed.
+    """
+    heartbeat = app.config.get('SEAT_STREAM_HEARTBEAT_SECONDS', 15)
+    finish = time.monotonic() + app.config.get('SEAT_STREAM_MAX_SECONDS', 300)
+    yield 'retry: 3000\n\n'
+    while time.monotonic() < finish:
+        try:
+            change = subscriber.get(timeout=heartbeat)
+        except queue.Empty:
+            yield ': keepalive\n\n'
+            continue
+        if change == RESYNC:
+            yield f'event: {RESYNC}\ndata: {{}}\n\n'
+        elif visible(change, start, end, group_keys):
+            yield f'data: {json.dumps(change)}\n\n'
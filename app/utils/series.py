@@ -0,0 +1,212 @@
+import re
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, union_all, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from app.database import db_session
+from app.models import Groups, Events, Series, SeriesExceptions
+from app.utils.seat_stream import notify_deleted
+
+FREQUENCIES = ('daily', 'weekly')
+
+# Fields of a series copied to its stored occurrences
+SERIES_FIELDS = ['title', 'description', 'start_time', 'end_time', 'n_assistants', 'color', 'group_id']
+
+# Fields of a series that decide the dates of its occurrences
+RULE_FIELDS = ['start_date', 'end_date', 'frequency', 'interval']
+
+# Id of an occurrence not stored as an event: s<series id>-<yyyymmdd>
+OCCURRENCE_ID = re.compile(r'^s(\d+)-(\d{8})$')
+
+def occurrence_id(series_id, date):
+    return f"s{series_id}-{date.strftime('%Y%m%d')}"
+
+def parse_occurrence_id(value):
+    """
+    (series id, date) of an occurrence id, None if value is not one.
+    """
+    match = OCCURRENCE_ID.match(str(value))
+    if not match:
+        return None
+    try:
+        return int(match.group(1)), datetime.strptime(match.group(2), '%Y%m%d').date()
+    except ValueError:
+        return None
+
+def parse_recurrence(frequency, interval, end_date, slots):
+    """
+    Validate the rule of the series of the time slots (one series per slot). Raises ValueError.
+    Returns a dict with frequency, interval and end_date.
+    """
+    if frequency not in FREQUENCIES:
+        raise ValueError('Repeat must be daily or weekly')
+    try:
+        interval = int(interval or 1)
+        end_date = datetime.strptime(end_date or '', '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError('A repeated event needs a number of days or weeks and an end date')
+    if interval < 1:
+        raise ValueError('A repeated event must repeat every 1 or more days or weeks')
+    if any(slot['date'] > end_date for slot in slots):
+        raise ValueError('The end date of a repeated event cannot be before its first date')
+    return {'frequency': frequency, 'interval': interval, 'end_date': end_date}
+
+class Occurrence():
+    """
+    Occurrence of a series that is not stored as an event, with the attributes of Events used by the calendar.
+    """
+    def __init__(self, series, date):
+        self.id = occurrence_id(series.id, date)
+        self.series_id = series.id
+        self.date = date
+        self.seats_taken = 0
+        for field in SERIES_FIELDS:
+            setattr(self, field, getattr(series, field))
+
+def series_dates(series, start, end):
+    """
+    Dates of the series between start (included) and end (excluded) following its rule, without removing exceptions.
+    """
+    first = max(series.start_date, start)
+    last = min(series.end_date, end - timedelta(days=1))
+    if first > last:
+        return []
+    step = series.interval * (7 if series.frequency == 'weekly' else 1)
+    # first occurrence on or after the start of the window
+    first += timedelta(days=-(first - series.start_date).days % step)
+    return [first + timedelta(days=days) for days in range(0, (last - first).days + 1, step)]
+
+def load_occurrences(series_filter, start, end):
+    """
+    Occurrences between start and end of the series matching the filter that are not stored as events
+    (those are loaded with the events), as a list of (Occurrence, group name).
+    Two queries whatever the number of occurrences: the series, and their exceptions and stored occurrences.
+    """
+    rows = db_session.query(Series, Groups.name).outerjoin(Groups, Groups.id == Series.group_id) \
+        .filter(series_filter, Series.start_date < end, Series.end_date >= start).all()
+    if not rows:
+        return []
+
+    series_ids = [series.id for series, _ in rows]
+    skip = set(db_session.execute(union_all(
+        select(SeriesExceptions.series_id, SeriesExceptions.date)
+        .where(SeriesExceptions.series_id.in_(series_ids), SeriesExceptions.date >= start, SeriesExceptions.date < end),
+        select(Events.series_id, Events.date)
+        .where(Events.series_id.in_(series_ids), Events.date >= start, Events.date < end)
+    )).all())
+
+    return [(Occurrence(series, date), group_name) for series, group_name in rows
+            for date in series_dates(series, start, end) if (series.id, date) not in skip]
+
+def get_occurrence(value):
+    """
+    Occurrence of an occurrence id not stored as an event, None if the series does not have it.
+    """
+    occurrence = parse_occurrence_id(value)
+    if occurrence is None or find_occurrence_event(*occurrence) is not None:
+        return None
+    series = db_session.get(Series, occurrence[0])
+    if series is None or not is_occurrence(series, occurrence[1]):
+        return None
+    return Occurrence(series, occurrence[1])
+
+def load_occurrences_by_id(occurrences, series_filter):
+    """
+    Occurrences not stored as events among the (series id, date) pairs, of the series matching the filter,
+    as a dict pair: Occurrence. Three queries whatever the number of pairs.
+    """
+    if not occurrences:
+        return {}
+    series_by_id = {series.id: series for series in Series.query.filter(Series.id.in_({series_id for series_id, _ in occurrences}), series_filter)}
+    skip = set(db_session.execute(union_all(
+        select(SeriesExceptions.series_id, SeriesExceptions.date).where(tuple_(SeriesExceptions.series_id, SeriesExceptions.date).in_(occurrences)),
+        select(Events.series_id, Events.date).where(tuple_(Events.series_id, Events.date).in_(occurrences))
+    )).all())
+    return {(series_id, date): Occurrence(series_by_id[series_id], date) for series_id, date in occurrences
+            if series_id in series_by_id and (series_id, date) not in skip
+            and date in series_dates(series_by_id[series_id], date, date + timedelta(days=1))}
+
+def find_occurrence_event(series_id, date):
+    return db_session.scalar(select(Events.id).where(Events.series_id == series_id, Events.date == date))
+
+def is_occurrence(series, date):
+    return date in series_dates(series, date, date + timedelta(days=1)) and db_session.scalar(
+        select(SeriesExceptions.id).where(SeriesExceptions.series_id == series.id, SeriesExceptions.date == date)) is None
+
+def materialize_occurrence(series_id, date):
+    """
+    Id of the event of an occurrence, storing it from the series if needed. Does not commit.
+    None if the series does not have an occurrence that date.
+    """
+    event_id = find_occurrence_event(series_id, date)
+    if event_id is not None:
+        return event_id
+    series = db_session.get(Series, series_id)
+    if series is None or not is_occurrence(series, date):
+        return None
+    # Concurrent requests storing the same occurrence get the same event (unique series_id, date)
+    event_id = db_session.scalar(
+        insert(Events).values(series_id=series_id, date=date, seats_taken=0, **{field: getattr(series, field) for field in SERIES_FIELDS})
+        .on_conflict_do_nothing(index_elements=['series_id', 'date'])
+        .returning(Events.id)
+    )
+    return event_id if event_id is not None else find_occurrence_event(series_id, date)
+
+def resolve_event_id(value, materialize=False):
+    """
+    Event id of an event id or occurrence id sent by the calendar. Occurrences not stored yet are stored
+    if materialize, otherwise None is returned for them (they have no participants).
+    """
+    occurrence = parse_occurrence_id(value)
+    if occurrence is None:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    if materialize:
+        return materialize_occurrence(*occurrence)
+    return find_occurrence_event(*occurrence)
+
+def add_series_exception(series_id, date):
+    """
+    Remove a date from a series. Does not commit.
+    """
+    db_session.execute(insert(SeriesExceptions).values(series_id=series_id, date=date)
+                       .on_conflict_do_nothing(index_elements=['series_id', 'date']))
+
+def update_series(series_id, **values):
+    """
+    Change the rule and fields of a series, and the fields of its stored occurrences, with one statement each.
+    Stored occurrences on a date of the old rule that the new rule does not generate are deleted if they have no
+    participants, and detached from the series (kept as single events with their sign-ups) otherwise.
+    The streams are notified of the deleted events. Does not commit.
+    Returns the group id the series had before, and the ids of the occurrences deleted and detached.
+    """
+    old_series = db_session.execute(
+        select(Series.group_id, Series.start_date, Series.end_date, Series.frequency, Series.interval).where(Series.id == series_id)
+    ).first()
+    db_session.execute(update(Series).where(Series.id == series_id).values(**values))
+    event_values = {field: value for field, value in values.items() if field in SERIES_FIELDS}
+    if event_values:
+        db_session.execute(update(Events).where(Events.series_id == series_id).values(**event_values)
+                           .execution_options(synchronize_session=False))
+    if old_series is None:
+        return None, [], []
+
+    # occurrences moved alone to another date are not on the old rule, and stay in the series
+    new_rule = Series(**{field: values.get(field, getattr(old_series, field)) for field in RULE_FIELDS})
+    removed = [event_id for event_id, date in db_session.execute(select(Events.id, Events.date).where(Events.series_id == series_id))
+               if date in series_dates(old_series, date, date + timedelta(days=1))
+               and date not in series_dates(new_rule, date, date + timedelta(days=1))]
+    deleted, detached = [], []
+    if removed:
+        # the seat count is checked by the DELETE itself, so a sign-up made meanwhile is detached instead
+        deleted = db_session.execute(delete(Events).where(Events.id.in_(removed), Events.seats_taken == 0)
+                                     .returning(Events.id, Events.group_id, Events.date)
+                                     .execution_options(synchronize_session=False)).all()
+        for row in deleted:
+            notify_deleted(row.group_id, event_id=row.id, date=row.date)
+        detached = list(db_session.scalars(update(Events).where(Events.id.in_(set(removed) - {row.id for row in deleted}))
+                                           .values(series_id=None).returning(Events.id)
+                                           .execution_options(synchronize_session=False)))
+    return old_series.group_id, [row.id for row in deleted], detached
@@ -0,0 +1,129 @@
+import uuid
+from datetime import date, time
+from sqlalchemy import select, update, delete
+from sqlalchemy.dialects.postgresql import insert
+
+from app.database import db_session
+from app.models import Events, Series
+from app.utils.seat_stream import notify_deleted
+
+class SlotsWithParticipants(ValueError):
+    """
+    Raised by update_event_batch when the events of the slots removed have participants and deleting them
+    was not confirmed. event_ids are those events.
+    """
+    def __init__(self, event_ids):
+        self.event_ids = sorted(event_ids)
+        super().__init__(f'{len(self.event_ids)} removed time slot(s) have participants. Confirm to delete them with their sign-ups.')
+
+def parse_event_fields(title, description, group_id, n_assistants, color):
+    """
+    Validate the fields shared by all the slots. Raises ValueError.
+    """
+    if not title:
+        raise ValueError('Title is required')
+    try:
+        n_assistants = int(n_assistants)
+    except (TypeError, ValueError):
+        raise ValueError('Maximum number of assistants must be a number')
+    if n_assistants < 0:
+        raise ValueError('Maximum number of assistants cannot be negative')
+    return {'title': title, 'description': description, 'group_id': int(group_id) if group_id else None,
+            'n_assistants': n_assistants, 'color': color}
+
+def parse_slots(dates, start_times, end_times, slot_ids=None):
+    """
+    Validate all the time slots before writing any of them. Raises ValueError with the first wrong slot.
+    slot_ids are the event ids of the slots when editing ('' for new slots).
+    Returns a list of dicts with id (None for new slots), date, start_time and end_time.
+    """
+    slot_ids = slot_ids if slot_ids is not None else [''] * len(dates)
+    if not dates or not len(dates) == len(start_times) == len(end_times) == len(slot_ids):
+        raise ValueError('Every time slot needs a date, a starting time and an ending time')
+
+    slots = []
+    for number, (slot_id, slot_date, start_time, end_time) in enumerate(zip(slot_ids, dates, start_times, end_times), 1):
+        try:
+            slot = {'id': int(slot_id) if slot_id else None, 'date': date.fromisoformat(slot_date),
+                    'start_time': time.fromisoformat(start_time), 'end_time': time.fromisoformat(end_time)}
+        except (TypeError, ValueError):
+            raise ValueError(f'Time slot {number}: invalid date or time')
+        if slot['start_time'] > slot['end_time']:
+            raise ValueError(f'Time slot {number}: start time cannot be greater than end time')
+        slots.append(slot)
+    return slots
+
+def slot_values(fields, slot):
+    return {**fields, 'date': slot['date'], 'start_time': slot['start_time'], 'end_time': slot['end_time']}
+
+def create_events(fields, slots, batch_id=None):
+    """
+    Insert an event per slot with a single statement, all of them in the same batch. Does not commit.
+    Returns the ids of the events in the order of the slots.
+    """
+    batch_id = batch_id or uuid.uuid4().hex
+    return list(db_session.scalars(
+        insert(Events).returning(Events.id, sort_by_parameter_order=True),
+        [{**slot_values(fields, slot), 'batch_id': batch_id, 'seats_taken': 0} for slot in slots]
+    ))
+
+def create_series(fields, slots, frequency, interval, end_date):
+    """
+    Insert a series per slot, repeated from the date of the slot, with a single statement. Does not commit.
+    Returns the ids of the series in the order of the slots.
+    """
+    return list(db_session.scalars(
+        insert(Series).returning(Series.id, sort_by_parameter_order=True),
+        [{**fields, 'start_date': slot['date'], 'end_date': end_date, 'frequency': frequency, 'interval': interval,
+          'start_time': slot['start_time'], 'end_time': slot['end_time']} for slot in slots]
+    ))
+
+def update_event_batch(event_id, fields, slots, delete_participants=False):
+    """
+    Edit all the events created together with the event (its batch): the fields are set in all of them and
+    the date and time of each one from its slot. Slots without id are added to the batch, and the events of
+    the batch without slot are deleted. One statement per kind of change. Does not commit.
+    Events with participants are only deleted with delete_participants, otherwise SlotsWithParticipants is
+    raised and the caller rolls back. The streams are notified of the deleted events.
+    Returns the ids of the batch in the order of the slots, the group ids the events had and the ids deleted,
+    or None if the event does not exist.
+    """
+    event = db_session.get(Events, event_id)
+    if event is None:
+        return None
+    batch_filter = Events.batch_id == event.batch_id if event.batch_id else Events.id == event.id
+    old_groups = dict(db_session.execute(select(Events.id, Events.group_id).where(batch_filter)).all())
+    # events created before batches existed start one
+    batch_id = event.batch_id or uuid.uuid4().hex
+
+    kept = [slot for slot in slots if slot['id'] in old_groups]
+    added = [slot for slot in slots if slot['id'] not in old_groups]
+    removed = set(old_groups) - {slot['id'] for slot in kept}
+
+    if kept:
+        # executemany of one UPDATE by primary key
+        db_session.execute(update(Events), [{**slot_values(fields, slot), 'id': slot['id'], 'batch_id': batch_id} for slot in kept])
+    deleted = []
+    if removed:
+        # their participants are deleted by the database. The seat count is checked by the DELETE itself,
+        # so a sign-up made since the form was loaded is not lost without confirmation
+        statement = delete(Events).where(Events.id.in_(removed))
+        if not delete_participants:
+            statement = statement.where(Events.seats_taken == 0)
+        deleted = db_session.execute(statement.returning(Events.id, Events.group_id, Events.date)
+                                     .execution_options(synchronize_session=False)).all()
+        if len(deleted) < len(removed):
+            raise SlotsWithParticipants(removed - {row.id for row in deleted})
+        for row in deleted:
+            notify_deleted(row.group_id, event_id=row.id, date=row.date)
+    added_ids = iter(create_events(fields, added, batch_id) if added else [])
+    return ([slot['id'] if slot['id'] in old_groups else next(added_ids) for slot in slots], set(old_groups.values()),
+            [row.id for row in deleted])
+
+def batch_slots(event):
+    """
+    Events of the batch of the event, ordered by date and time, to edit them together.
+    """
+    if not event.batch_id:
+        return [event]
+    return Events.query.filter_by(batch_id=event.batch_id).order_by(Events.date, Events.start_time).all()
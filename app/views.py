@@ -1,17 +1,25 @@
 from app import app
 
-import os
-from flask import flash, redirect, render_template, request, jsonify, send_file
+import hmac
+from flask import flash, redirect, render_template, request, jsonify, send_file, Response, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.security import check_password_hash, generate_password_hash
 from datetime import datetime
-import pandas as pd
-import io
-
-from app.models import Users, Roles, Groups, Events, UserEvents, UserGroups
-from app.utils import permission_admin, log_error_to_csv
-from app.database import db_session, init_db, engine
-
+import tempfile
+
+from app.models import Users, Groups, Events, UserEvents, UserGroups, Jobs, Series
+from app.utils import permission_admin, conditional_response, log_error, load_identity, invalidate_identity, read_users_file, import_users, add_users_to_group, summarize_import_report, register_job, submit_job, job_status, fail_orphaned_jobs
+from app.utils import calendar_cache, ALL_GROUPS, NO_GROUP
+from app.utils import load_occurrences, load_occurrences_by_id, get_occurrence, resolve_event_id, parse_occurrence_id, add_series_exception, update_series, parse_recurrence, FREQUENCIES
+from app.utils import metrics_text, read_only
+from app.utils import notify_seats, notify_deleted, seat_events, seat_bus
+from app.utils import page_args, group_page, member_page, user_options, user_page
+from app.utils import parse_event_fields, parse_slots, slot_values, create_events, create_series, update_event_batch, batch_slots, SlotsWithParticipants
+from app.utils import participant_rows, bulk_participant_rows, write_xlsx, write_bulk_xlsx, write_csv, stream_csv, PARTICIPANTS_HEADER, XLSX_MIMETYPE, CSV_MIMETYPE
+from app.database import db_session, check_db
+
+from sqlalchemy import select, exists, update, delete, or_, tuple_, true, false
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import SQLAlchemyError
 
 login_manager_app=LoginManager(app)
@@ -22,88 +30,193 @@ login_manager_app.login_message_category = "info"
 @login_manager_app.user_loader
 def load_user(user_id):
     try:
-        # Convert user_id to int and query the user
-        return Users.query.get(int(user_id))
+        # Convert user_id to int and get the user (from the identity cache if enabled)
+        return load_identity(int(user_id))
     except (ValueError, TypeError, SQLAlchemyError) as e:
         # If user_id is not an integer, return None
         flash(f'Database error: {e}', 'danger')
-        log_error_to_csv(f'Database error: {e}')
+        log_error(f'Database error: {e}')
         return None
 
-with app.app_context():
-    try:
-        init_db()
-        # Check if roles already exist
-        existing_roles = Roles.query.all()
-        if not existing_roles:
-            roles = ['admin', 'user']
-            for role in roles:
-                new_role = Roles(role=role)
-                db_session.add(new_role)
-            db_session.commit()
-        # Check if user already exist
-        existing_user = Users.query.all()
-        if not existing_user:
-            new_user = Users(name="admin", surname="admin", username="admin", hash=generate_password_hash("admin"), role_id=1)
-            db_session.add(new_user)
-            db_session.commit()
-    except (SQLAlchemyError, Exception) as e:
-        flash(f'Database error: {e}', 'danger')
-        log_error_to_csv(f'Database error: {e}')
-
-def generate_event_details(event, user_id):
+def generate_event_details(event, group_name):
     '''
-    Function used in the below route. Created to avoid repeating code.
+    Function used in the calendar feed. Created to avoid repeating code.
+    Details shared by all the users that see the event, see add_participation for the ones of each user.
+    event is an Events row or an Occurrence of a series not stored yet (its id is a string).
     '''
     return {
         'title': event.title,
         'groupId': event.group_id,
-        'groupName': Groups.query.filter_by(id=event.group_id).first().name if Groups.query.filter_by(id=event.group_id).first() else None,
+        'groupName': group_name,
         'start': f"{event.date.strftime('%Y-%m-%d')} {event.start_time}",
         'end': f"{event.date.strftime('%Y-%m-%d')} {event.end_time}",
         'modalId': event.id,
         'description': event.description,
         'n_assistants': event.n_assistants,
-        'backgroundColor': event.color if UserEvents.query.filter_by(event_id=event.id, user_id=user_id).first() else 'white',
-        'borderColor': event.color if UserEvents.query.filter_by(event_id=event.id, user_id=user_id).first() else 'lightgrey',
-        'textColor': 'black' if UserEvents.query.filter_by(event_id=event.id, user_id=user_id).first() else event.color
+        'color': event.color,
+        'seriesId': event.series_id
+    }
+
+def add_participation(details, participates):
+    '''
+    Colors of the event depending on whether the user is signed up.
+    '''
+    return {
+        **details,
+        'backgroundColor': details['color'] if participates else 'white',
+        'borderColor': details['color'] if participates else 'lightgrey',
+        'textColor': 'black' if participates else details['color']
+    }
+
+def group_keys_filter(group_keys, group_column):
+    '''
+    SQL condition on the group column (of Events or Series) for the group keys.
+    '''
+    if ALL_GROUPS in group_keys:
+        return true()
+    group_ids = [group_key for group_key in group_keys if group_key != NO_GROUP]
+    return or_(group_column.in_(group_ids), group_column == None if NO_GROUP in group_keys else false())
+
+def load_group_events(group_keys, start, end):
+    '''
+    Event details of the groups in the window, as a dict group key: list of events, with a single query
+    (events joined with their group name) plus the occurrences of the series of the groups.
+    Group keys are group ids, NO_GROUP or ALL_GROUPS.
+    '''
+    query = db_session.query(Events, Groups.name).outerjoin(Groups, Groups.id == Events.group_id) \
+        .filter(Events.date >= start, Events.date < end, group_keys_filter(group_keys, Events.group_id))
+    occurrences = load_occurrences(group_keys_filter(group_keys, Series.group_id), start, end)
+
+    events = {group_key: [] for group_key in group_keys}
+    for event, group_name in sorted(query.all() + occurrences, key=lambda row: (row[0].date, row[0].start_time)):
+        if ALL_GROUPS in group_keys:
+            group_key = ALL_GROUPS
+        else:
+            group_key = NO_GROUP if event.group_id is None else event.group_id
+        events[group_key].append(generate_event_details(event, group_name))
+    return events
+
+def parse_feed_date(value):
+    '''
+    Parse the start/end parameters sent by FullCalendar (ISO dates, optionally with time and offset).
+    '''
+    return datetime.strptime(value[:10], '%Y-%m-%d').date()
+
+def feed_group_keys(user_id, role_id):
+    """
+    Keys of the groups whose events the user sees: all for admins, the user groups and no group for users.
+    """
+    if role_id == 1:
+        return [ALL_GROUPS]
+    return calendar_cache.user_groups(user_id, lambda: [
+        group_id for (group_id,) in db_session.query(UserGroups.group_id).filter_by(user_id=user_id).distinct()
+    ]) + [NO_GROUP]
+
+def visible_events_filter(user_id, role_id, group_column=Events.group_id):
+    '''
+    SQL condition for the events (or series, with Series.group_id) a user can see: admins see all of them,
+    users see the events of their groups and the ones without group.
+    '''
+    if role_id == 1:
+        return true()
+    user_group_ids = select(UserGroups.group_id).where(UserGroups.user_id == user_id)
+    return or_(group_column.in_(user_group_ids), group_column == None)
+
+def seat_status(seats_taken, n_assistants, participates):
+    '''
+    Status of an event for a user, as sent by /api/events/status and the sign-up and withdrawal routes.
+    '''
+    return {
+        'seats_taken': seats_taken,
+        'n_assistants': n_assistants,
+        'remaining': max(n_assistants - seats_taken, 0),
+        'participates': bool(participates)
     }
 
+def event_status(event_id, user_id):
+    '''
+    Status of a stored event for a user, None if it does not exist.
+    '''
+    row = db_session.query(Events.seats_taken, Events.n_assistants,
+                           exists().where(UserEvents.event_id == Events.id, UserEvents.user_id == user_id)) \
+        .filter(Events.id == event_id).first()
+    return {'id': event_id, **seat_status(*row)} if row else None
+
 @app.route("/", methods=['GET'])
+@read_only
 @login_required
 def index():
     """
-    Show list of events with same group id as user or None group id.
+    Show the calendar. Events are loaded by the calendar itself from /api/events.
     """
+    titles = []
+    groups = []
+    # admins need the list of titles and groups for the export modals
+    if current_user.role_id == 1:
+        titles = [title for (title,) in db_session.query(Events.title).distinct().order_by(Events.title)]
+        groups = [(group.id, group.name) for group in Groups.query.order_by(Groups.name)]
+
+    return render_template("index.html", titles=titles, groups=groups, user_id=current_user.id)
+
+
+@app.route("/api/events", methods=['GET'])
+@read_only
+@login_required
+def api_events():
+    """
+    Calendar feed: events between start (included) and end (excluded) with same group id as user or None group id.
+    """
+    try:
+        start = parse_feed_date(request.args.get('start'))
+        end = parse_feed_date(request.args.get('end'))
+    except (TypeError, ValueError):
+        return jsonify({"message": "start and end must be dates in format YYYY-MM-DD"}), 400
+
     user_id = current_user.id
-    role_id = current_user.role_id
-    # if it is an admin, then show all events, no matter the group
-    if role_id == 1:
-        events = []
-        for event in Events.query.all():
-            events.append(generate_event_details(event, user_id))
-
-        return render_template("index.html", events=events, user_id=user_id)
-
-    else: # if user is not admin        
-        usergroups = UserGroups.query.filter_by(user_id=user_id).all()
-        events = []
-        event_ids = set() # to avoid repetitions
-        for usergroup in usergroups:
-            events_by_group = Events.query.filter((Events.group_id == usergroup.group_id)).all()
-            for event in events_by_group:
-                if event.id not in event_ids:
-                    events.append(generate_event_details(event, user_id))
-                    event_ids.add(event.id)
-        
-        # events that do not have a group
-        for event in Events.query.filter((Events.group_id == None)).all():
-            if event.id not in event_ids:
-                events.append(generate_event_details(event, user_id))
-                event_ids.add(event.id)
+    # Payloads are cached by group and window, and shared by all the users of the group
+    group_keys = feed_group_keys(user_id, current_user.role_id)
+
+    def build_response():
+        events_by_group = calendar_cache.group_events(group_keys, start, end, lambda missing: load_group_events(missing, start, end))
+
+        signed_up = calendar_cache.user_signups(user_id, start, end, lambda: {
+            event_id for (event_id,) in db_session.query(UserEvents.event_id).join(Events, Events.id == UserEvents.event_id)
+            .filter(UserEvents.user_id == user_id, Events.date >= start, Events.date < end)
+        })
 
-        return render_template("index.html", events=events, user_id=user_id)
+        events = sorted((event for group_events in events_by_group.values() for event in group_events), key=lambda event: event['start'])
+        return jsonify([add_participation(event, event['modalId'] in signed_up) for event in events])
+
+    # The feed only changes when the events of the groups or the sign-ups of the user change
+    etag_parts = ('events', start, end, user_id, group_keys,
+                  calendar_cache.versions(*[f'group:{group_key}' for group_key in group_keys], f'user:{user_id}'))
+    return conditional_response(etag_parts, build_response)
+
+
+@app.route('/api/cache/stats')
+@login_required
+@permission_admin
+def api_cache_stats():
+    """
+    Hits and misses of the calendar cache in all the worker processes (also served at /metrics).
+    """
+    return jsonify(calendar_cache.stats())
+
+
+@register_job('export_participants_by_title')
+def export_participants_by_title_job(context, title, file_format='xlsx'):
+    '''
+    Job that generates an excel (or csv) with all the participants of the events with a title,
+    one row per participant with the date and time of the event.
+    '''
+    rows = participant_rows(Events.title == title)
+    if file_format == 'csv':
+        with open(context.result_file(f'participants_{title}.csv'), 'w', newline='', encoding='utf-8') as file:
+            write_csv(rows, PARTICIPANTS_HEADER, file)
+    else:
+        write_xlsx(rows, PARTICIPANTS_HEADER, context.result_file(f'participants_{title}.xlsx'))
 
+    return {'message': f'Participants of {title} exported.'}
 
 @app.route('/export_participants_by_title', methods=['POST'])
 @login_required
@@ -111,63 +224,78 @@ def index():
 def export_participants_by_title():
     '''
     Export function that generates an excel with all the participants of an event.
+    The excel is generated in a background job, the calendar page polls it and downloads the result.
     '''
     # if no title is sent
     if not request.form.get('eventTitle'):
         flash("Must select a title.", "danger")
         return redirect("/")
 
-    title = request.form.get('eventTitle')
-    events_with_title = Events.query.filter_by(title=title).all()
-
-    
-    # Create a DataFrame with the participants' names for each event date and time
-    participants_data = {}
-    for event in events_with_title:
-        event_date = event.date.strftime('%d-%m-%Y')
-        event_time = f"{event.start_time.strftime('%H:%M')} - {event.end_time.strftime('%H:%M')}"
-        if (event_date, event_time) not in participants_data:
-            participants_data[(event_date, event_time)] = []
-        event_participants = UserEvents.query.filter_by(event_id=event.id).join(Users).all()
-        participants_data[(event_date, event_time)].extend([f"{participant.user.name} {participant.user.surname}" for participant in event_participants])
-    
-    # Manage the case where list of participants of each event do not have the same length
-    max_length = max(len(participants) for participants in participants_data.values())
-    for participants_list in participants_data.values():
-        while len(participants_list) < max_length:
-            participants_list.append('')
-    
-    # Create a DataFrame with the participants' names for each event date and time
-    participants_df = pd.DataFrame(participants_data)
-
-    # Create the Excel file in memory
-    excel_file = io.BytesIO()
-    participants_df.to_excel(excel_file)
-    excel_file.seek(0)  # Move the cursor to the start of the file
-
-    return send_file(excel_file, as_attachment=True, download_name=f'participants_{title}.xlsx', mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    job_id = submit_job('export_participants_by_title', current_user.id, title=request.form.get('eventTitle'),
+                        file_format=request.form.get('format', 'xlsx'))
+    return redirect(f"/?job={job_id}")
 
-@app.route('/export_participants/<int:event_id>')
+@register_job('export_participants_bulk')
+def export_participants_bulk_job(context, start=None, end=None, group_id=None, titles=None, sheet_per='title'):
+    '''
+    Job that generates one excel with the participants of all the events matching the filters:
+    a summary sheet and a sheet per title or per event.
+    '''
+    filters = []
+    if start:
+        filters.append(Events.date >= datetime.strptime(start, '%Y-%m-%d').date())
+    if end:
+        filters.append(Events.date <= datetime.strptime(end, '%Y-%m-%d').date())
+    if group_id == 'none':
+        filters.append(Events.group_id == None)
+    elif group_id:
+        filters.append(Events.group_id == int(group_id))
+    if titles:
+        filters.append(Events.title.in_(titles))
+
+    number_of_events = write_bulk_xlsx(bulk_participant_rows(*filters), context.result_file('participants.xlsx'), sheet_per)
+    return {'message': f'Participants of {number_of_events} events exported.'}
+
+@app.route('/export_participants_bulk', methods=['POST'])
+@login_required
+@permission_admin
+def export_participants_bulk():
+    '''
+    Export in one excel the participants of the events in a date range, of a group and/or with some titles.
+    Generated in a background job, like the export by title.
+    '''
+    job_id = submit_job('export_participants_bulk', current_user.id,
+                        start=request.form.get('start') or None, end=request.form.get('end') or None,
+                        group_id=request.form.get('group') or None, titles=request.form.getlist('titles[]'),
+                        sheet_per=request.form.get('sheet_per', 'title'))
+    return redirect(f"/?job={job_id}")
+
+@app.route('/export_participants/<event_id>')
+@read_only
 @login_required
 @permission_admin
 def export_participants(event_id):
-    # Logic to generate the Excel file
-    
-    # Assuming you have generated the Excel file and saved it as 'participants.xlsx'
-    participants = UserEvents.query.filter_by(event_id=event_id).join(Users).all()
-    
-    # Create a DataFrame with the participants' names
-    participants_df = pd.DataFrame([f"{participant.user.name} {participant.user.surname}" for participant in participants], columns=['Name'])
+    '''
+    Download the participants of an event as excel, or as csv with ?format=csv.
+    Occurrences of a series not stored as events have no participants.
+    '''
+    rows = participant_rows(Events.id == resolve_event_id(event_id))
 
-    # Create the Excel file in memory
-    excel_file = io.BytesIO()
-    participants_df.to_excel(excel_file)
+    if request.args.get('format') == 'csv':
+        # Sent while the rows are read from the database
+        return Response(stream_with_context(stream_csv(rows, PARTICIPANTS_HEADER)), mimetype=CSV_MIMETYPE,
+                        headers={'Content-Disposition': f'attachment; filename=participants_event_{event_id}.csv'})
+
+    # Rows are written to a temporary file, not kept in memory, and the file is sent by chunks
+    excel_file = tempfile.TemporaryFile()
+    write_xlsx(rows, PARTICIPANTS_HEADER, excel_file)
     excel_file.seek(0)  # Move the cursor to the start of the file
-    
-    return send_file(excel_file, as_attachment=True, download_name=f'participants_event_{event_id}.xlsx', mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+    return send_file(excel_file, as_attachment=True, download_name=f'participants_event_{event_id}.xlsx', mimetype=XLSX_MIMETYPE)
 
     
 @app.route("/create-event", methods=["GET", "POST"])
+@read_only
 @login_required
 @permission_admin
 def create_event():
@@ -179,358 +307,499 @@ def create_event():
         groups = [(group.id, group.name) for group in Groups.query.all()]
 
         event_id = request.args.get('event_id')
+        series_id = request.args.get('series_id')
         event = None
-        if event_id:
-            event = Events.query.get(event_id)  # Reemplaza con tu propia lógica
-        return render_template("create_event.html", groups=groups, event=event)
+        series = None
+        if series_id:
+            series = db_session.get(Series, int(series_id))
+        elif event_id:
+            # an occurrence of a series not stored yet, or an event
+            event = get_occurrence(event_id)
+            if event is None and resolve_event_id(event_id) is not None:
+                event = db_session.get(Events, resolve_event_id(event_id))
+
+        # time slots of the form: all the slots of the event when editing one that is not part of a series
+        if event is not None:
+            slots = [event] if event.series_id else batch_slots(event)
+        elif series is not None:
+            slots = [{'date': series.start_date, 'start_time': series.start_time, 'end_time': series.end_time}]
+        else:
+            slots = [None]
+        return render_template("create_event.html", groups=groups, event=event, series=series, slots=slots, frequencies=FREQUENCIES)
     
     else: #post
         event_id = request.form.get('event_id')
-        # Get data from event
-        title = request.form.get("title")
-        description = request.form.get("description") # if empty is ""
-        group_id = request.form.get("group") # if empty is None
-        n_assistants = request.form.get("n_assistants")
-        color = request.form.get("color")
-
-        for date, start_time, end_time in zip(request.form.getlist("dates[]"), request.form.getlist("start_times[]"), request.form.getlist("end_times[]")):
-            date = datetime.strptime(date,'%Y-%m-%d').date()
-
-            if start_time > end_time:
-                flash('Start time cannot be greater than end time', 'danger')
-                break
-
-            if event_id:
-                # Update the event in the database
-                try:
-                    existing_event = Events.query.filter_by(id=event_id).first()
-                    if existing_event:
-                        existing_event.title = title
-                        existing_event.description = description
-                        existing_event.date = date
-                        existing_event.start_time = start_time
-                        existing_event.end_time = end_time
-                        existing_event.group_id = group_id
-                        existing_event.n_assistants = n_assistants
-                        existing_event.color = color
-                        db_session.commit()
-                except (SQLAlchemyError, Exception) as e:
-                    flash(f'Database error: {e}', 'danger')
-                    log_error_to_csv(f'Database error: {e}')
-            else:
-                # Update DDBB
-                try:
-                    new_event = Events(title=title, description=description, date=date, start_time=start_time, end_time=end_time, group_id=group_id, n_assistants=n_assistants, color=color)
-                    # Add the event to the database
-                    db_session.add(new_event)
+        series_id = request.form.get('series_id')
+        # Recurrence: each time slot becomes a series repeated from its date until the end date
+        repeat = request.form.get("repeat", "none")
+
+        # All the slots are validated before writing any of them
+        try:
+            fields = parse_event_fields(request.form.get("title"), request.form.get("description"), request.form.get("group"),
+                                        request.form.get("n_assistants"), request.form.get("color"))
+            slots = parse_slots(request.form.getlist("dates[]"), request.form.getlist("start_times[]"), request.form.getlist("end_times[]"),
+                                request.form.getlist("slot_ids[]") if event_id else None)
+            if series_id or repeat in FREQUENCIES:
+                recurrence = parse_recurrence(repeat, request.form.get("interval"), request.form.get("until"), slots)
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect("/")
+
+        # Everything is written in one transaction, with one statement per kind of change
+        try:
+            if series_id:
+                # Update the whole series, its stored occurrences included
+                old_group_id, deleted_ids, detached_ids = update_series(int(series_id), **fields, **recurrence, start_date=slots[0]['date'],
+                                                                        start_time=slots[0]['start_time'], end_time=slots[0]['end_time'])
+                db_session.commit()
+                calendar_cache.invalidate_events(old_group_id, fields['group_id'])
+                if deleted_ids:
+                    flash(f"{len(deleted_ids)} occurrence(s) no longer in the series deleted.", "info")
+                if detached_ids:
+                    flash(f"{len(detached_ids)} occurrence(s) no longer in the series kept as single events, they have participants.", "warning")
+            elif event_id:
+                # an occurrence of a series is stored to edit it
+                existing_event = Events.query.filter_by(id=resolve_event_id(event_id, materialize=True)).first()
+                if existing_event is None:
+                    flash("Event not found", "danger")
+                elif existing_event.series_id:
+                    # Occurrences of a series are edited alone
+                    old_group_id = existing_event.group_id
+                    if existing_event.date != slots[0]['date']:
+                        # the series must not show the occurrence on its original date again
+                        add_series_exception(existing_event.series_id, existing_event.date)
+                    for field, value in slot_values(fields, slots[0]).items():
+                        setattr(existing_event, field, value)
+                    db_session.flush()
+                    notify_seats(existing_event.id)
                     db_session.commit()
-                except (SQLAlchemyError, Exception) as e:
-                    flash(f'Database error: {e}', 'danger')
-                    log_error_to_csv(f'Database error: {e}')
+                    calendar_cache.invalidate_events(old_group_id, fields['group_id'])
+                    calendar_cache.invalidate_participants(existing_event.id)
+                else:
+                    # All the time slots created with the event are edited together. The slots removed with
+                    # participants are only deleted if the admin confirmed it in the form
+                    event_ids, old_group_ids, deleted_ids = update_event_batch(existing_event.id, fields, slots,
+                                                                               request.form.get('delete_participants') == '1')
+                    notify_seats(*event_ids)
+                    db_session.commit()
+                    calendar_cache.invalidate_events(*old_group_ids, fields['group_id'])
+                    calendar_cache.invalidate_participants(*event_ids, *deleted_ids)
+                    flash(f"{len(event_ids)} time slot(s) saved.", "success")
+                    if deleted_ids:
+                        flash(f"{len(deleted_ids)} time slot(s) deleted.", "info")
+            elif repeat in FREQUENCIES:
+                # A single row per slot for all its occurrences, expanded when the calendar is loaded
+                series_ids = create_series(fields, slots, **recurrence)
+                db_session.commit()
+                calendar_cache.invalidate_events(fields['group_id'])
+                flash(f"{len(series_ids)} repeated event(s) created.", "success")
+            else:
+                event_ids = create_events(fields, slots)
+                db_session.commit()
+                calendar_cache.invalidate_events(fields['group_id'])
+                flash(f"{len(event_ids)} event(s) created.", "success")
+        except SlotsWithParticipants as e:
+            db_session.rollback()
+            flash(str(e), 'danger')
+        except (SQLAlchemyError, Exception) as e:
+            db_session.rollback()
+            flash(f'Database error: {e}', 'danger')
+            log_error(f'Database error: {e}')
 
         return redirect("/")
 
 
+@app.route("/api/events/batch", methods=["POST", "PUT"])
+@login_required
+@permission_admin
+def api_events_batch():
+    """
+    Create (POST) or edit (PUT, with event_id) the time slots of an event in one transaction.
+    JSON with title, description, group_id, n_assistants, color and slots (list of id, date, start_time, end_time;
+    id only when editing, slots without id are added and the ones missing are deleted).
+    The missing ones with participants are only deleted with delete_participants true, otherwise nothing is saved (409).
+    Returns the ids of the events in the order of the slots.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        fields = parse_event_fields(data.get('title'), data.get('description'), data.get('group_id'), data.get('n_assistants'), data.get('color'))
+        slots = data.get('slots') or []
+        slots = parse_slots([slot.get('date') for slot in slots], [slot.get('start_time') for slot in slots],
+                            [slot.get('end_time') for slot in slots], [slot.get('id') for slot in slots])
+    except (ValueError, AttributeError) as e:
+        return jsonify({"message": str(e)}), 400
+
+    try:
+        if request.method == 'POST':
+            event_ids = create_events(fields, slots)
+            old_group_ids = set()
+        else:
+            result = update_event_batch(data.get('event_id'), fields, slots, data.get('delete_participants') is True)
+            if result is None:
+                return jsonify({"message": "No se encontró el evento"}), 404
+            event_ids, old_group_ids, deleted_ids = result
+            notify_seats(*event_ids)
+        db_session.commit()
+        calendar_cache.invalidate_events(*old_group_ids, fields['group_id'])
+        if old_group_ids:
+            calendar_cache.invalidate_participants(*event_ids, *deleted_ids)
+        return jsonify({"ids": event_ids}), 201 if request.method == 'POST' else 200
+    except SlotsWithParticipants as e:
+        db_session.rollback()
+        return jsonify({"message": "Hay participantes inscritos en los horarios eliminados", "events": e.event_ids}), 409
+    except (SQLAlchemyError, Exception) as e:
+        db_session.rollback()
+        log_error(f'Database error: {e}')
+        return jsonify({"message": "Error al guardar los eventos"}), 500
+
+
 @app.route("/add_user_event", methods=['POST'])
 @login_required
 def add_user_event():
 
     user_id = request.json.get('user_id')  
-    event_id = request.json.get('event_id')
-    
-    # Verify if there is already a log with same user_id and event_id
-    existing_log = UserEvents.query.filter_by(user_id=user_id, event_id=event_id).first()
     
-    if existing_log:
-        return jsonify({"message": "El log ya existe"})
-    
-    new_user_event = UserEvents(user_id=user_id, event_id=event_id)
     try:
-        db_session.add(new_user_event)
+        # Occurrences of a series are stored as events when they get their first participant
+        event_id = resolve_event_id(request.json.get('event_id'), materialize=True)
+        if event_id is None:
+            return jsonify({"message": "No se encontró el evento"}), 404
+
+        # Reserve a seat only if the event is not full. The check and the increment are a single
+        # statement, so concurrent sign-ups cannot overbook the event
+        reserved = db_session.execute(
+            update(Events)
+            .where(Events.id == event_id, Events.seats_taken < Events.n_assistants)
+            .values(seats_taken=Events.seats_taken + 1)
+            .returning(Events.group_id, Events.seats_taken, Events.n_assistants)
+            .execution_options(synchronize_session=False)
+        ).first()
+        # Responses carry the status of the event, which the calendar updates without reloading
+        if not reserved:
+            # read before the rollback, which also undoes an occurrence stored by this request: the page
+            # knows that one by its occurrence id
+            status = event_status(event_id, user_id)
+            db_session.rollback()
+            if status is None:
+                return jsonify({"message": "No se encontró el evento"}), 404
+            if parse_occurrence_id(request.json.get('event_id')):
+                status['id'] = request.json.get('event_id')
+            if status['participates']:
+                return jsonify({"message": "El log ya existe", "event": status})
+            return jsonify({"message": "El evento está completo", "event": status}), 409
+
+        # The unique index on (user_id, event_id) skips the log if it already exists, even when
+        # the same user signs up twice at the same time; then the seat is released by the rollback
+        signed_up = db_session.execute(
+            insert(UserEvents).values(user_id=user_id, event_id=event_id)
+            .on_conflict_do_nothing(index_elements=['user_id', 'event_id'])
+            .returning(UserEvents.id)
+        ).first()
+        if not signed_up:
+            # like above, the status is built before the rollback, without the seat it releases
+            status = {'id': event_id, **seat_status(reserved.seats_taken - 1, reserved.n_assistants, True)}
+            db_session.rollback()
+            if parse_occurrence_id(request.json.get('event_id')):
+                status['id'] = request.json.get('event_id')
+            return jsonify({"message": "El log ya existe", "event": status})
+        notify_seats(event_id)
         db_session.commit()
-        return jsonify({"message": "Evento de usuario agregado exitosamente"})
+        calendar_cache.invalidate_signups(user_id)
+        calendar_cache.invalidate_seats(event_id, reserved.group_id)
+        if parse_occurrence_id(request.json.get('event_id')):
+            # the calendar shows the stored event instead of the occurrence
+            calendar_cache.invalidate_events(reserved.group_id)
+        return jsonify({"message": "Evento de usuario agregado exitosamente",
+                        "event": {'id': event_id, **seat_status(reserved.seats_taken, reserved.n_assistants, True)}})
     except (SQLAlchemyError, Exception) as e:
         db_session.rollback()
         flash(f'Database error: {e}', 'danger')
-        log_error_to_csv(f'Database error: {e}')
-        return jsonify({"message": "Error al agregar el evento de usuario"})
+        log_error(f'Database error: {e}')
+        return jsonify({"message": "Error al agregar el evento de usuario"}), 500
 
 @app.route('/delete_user_event', methods=['DELETE'])
 @login_required
 def delete_user_event():
     user_id = request.json.get('user_id')  
-    event_id = request.json.get('event_id')
-    
-    # Buscar el log en la base de datos
-    log_to_delete = UserEvents.query.filter_by(user_id=user_id, event_id=event_id).first()
+    event_id = resolve_event_id(request.json.get('event_id'))
     
-    if log_to_delete:
-        try:
-            db_session.delete(log_to_delete)
+    try:
+        # The seat is released only by the withdrawal that deletes the sign-up: concurrent withdrawals
+        # of the same sign-up wait for each other and only one of them finds the row
+        deleted = db_session.execute(
+            delete(UserEvents)
+            .where(UserEvents.user_id == user_id, UserEvents.event_id == event_id)
+            .returning(UserEvents.event_id)
+            .execution_options(synchronize_session=False)
+        ).first()
+        if deleted:
+            released = db_session.execute(
+                update(Events)
+                .where(Events.id == event_id, Events.seats_taken > 0)
+                .values(seats_taken=Events.seats_taken - 1)
+                .returning(Events.group_id, Events.seats_taken, Events.n_assistants)
+                .execution_options(synchronize_session=False)
+            ).first()
+            notify_seats(event_id)
             db_session.commit()
-            return jsonify({"message": "Log eliminado exitosamente"})
-        except (SQLAlchemyError, Exception) as e:
+            calendar_cache.invalidate_signups(user_id)
+            calendar_cache.invalidate_seats(event_id, released and released.group_id)
+            status = {'id': event_id, **seat_status(released.seats_taken, released.n_assistants, False)} if released else event_status(event_id, user_id)
+            return jsonify({"message": "Log eliminado exitosamente", "event": status})
+        else:
             db_session.rollback()
-            flash(f'Database error: {e}', 'danger')
-            log_error_to_csv(f'Database error: {e}')
-            return jsonify({"message": "Error al eliminar el log"})
-    else:
-        return jsonify({"message": "No se encontró el log"})
+            return jsonify({"message": "No se encontró el log"})
+    except (SQLAlchemyError, Exception) as e:
+        db_session.rollback()
+        flash(f'Database error: {e}', 'danger')
+        log_error(f'Database error: {e}')
+        return jsonify({"message": "Error al eliminar el log"})
 
 
-@app.route('/get_participants/<int:event_id>')
+@app.route('/get_participants/<event_id>')
+@read_only
 @login_required
 def get_participants(event_id):
-    participants = db_session.query(Users).join(UserEvents, Users.id == UserEvents.user_id).filter(UserEvents.event_id == event_id).all()
+    # occurrences of a series not stored yet have no participants
+    event_id = resolve_event_id(event_id)
 
-    return jsonify([{'id': participant.id, 'name': participant.name, 'surname': participant.surname} for participant in participants])
+    def build_response():
+        if event_id is None:
+            return jsonify([])
+        participants = db_session.query(Users).join(UserEvents, Users.id == UserEvents.user_id).filter(UserEvents.event_id == event_id).all()
+        return jsonify([{'id': participant.id, 'name': participant.name, 'surname': participant.surname} for participant in participants])
 
+    return conditional_response(('participants', event_id, event_id and calendar_cache.version(f'event:{event_id}')), build_response)
 
-@app.route('/get_participation_status/<int:event_id>/<int:user_id>')
+
+@app.route('/get_participation_status/<event_id>/<int:user_id>')
+@read_only
 @login_required
 def get_participation_status(event_id, user_id):
-    user_event = UserEvents.query.filter_by(event_id=event_id, user_id=user_id).first()
-    return jsonify({'participates': user_event is not None})
+    event_id = resolve_event_id(event_id)
+
+    def build_response():
+        user_event = UserEvents.query.filter_by(event_id=event_id, user_id=user_id).first() if event_id is not None else None
+        return jsonify({'participates': user_event is not None})
 
+    return conditional_response(('participation', event_id, user_id, event_id and calendar_cache.version(f'event:{event_id}')), build_response)
+
+
+@app.route('/api/events/status')
+@read_only
+@login_required
+def api_events_status():
+    """
+    Batched seat counts, remaining capacity and participation of the current user.
+    Events are selected by ids (?ids=1,2,s3-20240105) or by date window (?start=&end=), like the calendar feed.
+    Occurrences of series not stored as events have no seats taken.
+    """
+    user_id = current_user.id
+    participates = exists().where(UserEvents.event_id == Events.id, UserEvents.user_id == user_id)
+    query = db_session.query(Events.id, Events.series_id, Events.date, Events.n_assistants, Events.seats_taken, participates) \
+        .filter(visible_events_filter(user_id, current_user.role_id))
+    series_filter = visible_events_filter(user_id, current_user.role_id, Series.group_id)
+    group_keys = feed_group_keys(user_id, current_user.role_id)
+    event_ids = []
+    occurrence_ids = {}
+
+    # The ETag uses the stamps of the events (ids) or of the events and seats of the visible groups (window),
+    # plus the sign-ups of the user. Group stamps change too when an occurrence is stored
+    try:
+        if request.args.get('ids'):
+            for value in request.args.get('ids').split(','):
+                occurrence = parse_occurrence_id(value)
+                if occurrence:
+                    occurrence_ids[occurrence] = value
+                else:
+                    event_ids.append(int(value))
+            query = query.filter(or_(Events.id.in_(event_ids),
+                                     tuple_(Events.series_id, Events.date).in_(list(occurrence_ids)) if occurrence_ids else false()))
+            etag_parts = ('status', event_ids, list(occurrence_ids.values()), user_id, group_keys,
+                          calendar_cache.versions(*[f'event:{event_id}' for event_id in event_ids],
+                                                  *[f'group:{group_key}' for group_key in group_keys], f'user:{user_id}'))
+            load_unstored = lambda: load_occurrences_by_id(list(occurrence_ids), series_filter).values()
+        else:
+            start = parse_feed_date(request.args.get('start'))
+            end = parse_feed_date(request.args.get('end'))
+            query = query.filter(Events.date >= start, Events.date < end)
+            etag_parts = ('status', start, end, user_id, group_keys,
+                          calendar_cache.versions(*[f'{name}:{group_key}' for group_key in group_keys for name in ('group', 'seats')],
+                                                  f'user:{user_id}'))
+            load_unstored = lambda: [occurrence for occurrence, _ in load_occurrences(series_filter, start, end)]
+    except (TypeError, ValueError):
+        return jsonify({"message": "Send ids=1,2,s3-20240105 or start and end dates in format YYYY-MM-DD"}), 400
+
+    def build_response():
+        status = {}
+        for event_id, series_id, date, n_assistants, seats_taken, participates in query.all():
+            # stored occurrences asked by their occurrence id are answered with it
+            key = event_id if event_id in event_ids else occurrence_ids.get((series_id, date), event_id)
+            status[str(key)] = seat_status(seats_taken, n_assistants, participates)
+        for occurrence in load_unstored():
+            status[occurrence.id] = seat_status(0, occurrence.n_assistants, False)
+        return jsonify(status)
+
+    return conditional_response(etag_parts, build_response)
+
+
+@app.route('/api/events/stream')
+@login_required
+def api_events_stream():
+    """
+    Server-sent events with the seat counts of the events of a date window (?start=&end=) whenever they change,
+    and the events deleted, for all the users that see them. See app/utils/seat_stream.py.
+    """
+    try:
+        start = parse_feed_date(request.args.get('start'))
+        end = parse_feed_date(request.args.get('end'))
+    except (TypeError, ValueError):
+        return jsonify({"message": "start and end must be dates in format YYYY-MM-DD"}), 400
+    group_keys = feed_group_keys(current_user.id, current_user.role_id)
+    subscriber = seat_bus.subscribe()
+    if subscriber is None:
+        # every stream thread of this worker is busy: the page polls the seat status instead
+        return jsonify({"message": "Demasiadas conexiones abiertas"}), 503, {'Retry-After': str(app.config.get('SEAT_STREAM_POLL_SECONDS', 30))}
+    # The stream does not use the database: the session (and its connection) is released when the request ends,
+    # before the stream starts. The subscription ends when the response is closed, even if it never started
+    response = Response(seat_events(subscriber, start, end, group_keys), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(lambda: seat_bus.unsubscribe(subscriber))
+    return response
 
 @app.route("/manage-groups", methods=["GET", "POST"])
+@read_only
 @login_required
 @permission_admin
 def manage_groups():
     if request.method == "GET":
-        all_users = [(user.id, user.name, user.surname, user.username) for user in Users.query.all()]
-
-        groups = Groups.query.all()
-        groups_with_users = []
-
-        for group in groups:
-            usergroups = UserGroups.query.filter_by(group_id=group.id).all()
-            users = []
-            
-            for usergroup in usergroups:
-                user = Users.query.filter_by(id=usergroup.user_id).first()
-                users.append(user)
-            groups_with_users.append({'group': group, 'users': users})
-        return render_template("manage_groups.html", all_users=all_users, groups_with_users=groups_with_users)
+        # Groups, members and users of the pickers are loaded by the page from the roster API
+        return render_template("manage_groups.html")
     
     else: #post
-        users_file = request.files["fileUpload"]
-        
-        existing_group = Groups.query.filter_by(name=request.form.get("name")).first()
-        if existing_group:
-            group_id = existing_group.id
-
-            # Get the list of selected users
-            selected_users = request.form.getlist('users[]')
-
-            # Create UserGroup log for each user added
-            for user_id in selected_users:
-                if not UserGroups.query.filter_by(user_id=user_id, group_id=group_id).first():
-                    user_group_log = UserGroups(user_id=user_id, group_id=group_id)
-                    db_session.add(user_group_log)
-                    try:
-                        db_session.commit()
-                    except (SQLAlchemyError, Exception) as e:
-                        db_session.rollback()
-                        flash(f'Database error: {e}', 'danger')
-                        log_error_to_csv(f'Database error: {e}')
-
-            if users_file:
-                excel_data = users_file.read()
-                users_df = pd.read_excel(io.BytesIO(excel_data))
-                
-                for index, row in users_df.iterrows():
-                    try:
-                        name = row['Nom']
-                        surname = row['Primer cognom'] + ' ' + row['Segon cognom']
-                        username = row['Correu']
-                        hash = str(row['Nif'])
-                        role_id = 2
-                    except KeyError:
-                        flash("Invalid excel file format. Please check the column names.", 'danger')
-                        return redirect('/manage-groups')
-                    
-                    existing_user = Users.query.filter_by(username=username).first()
-                    # Check that the user is new
-                    if existing_user is None:
-                        new_user = Users(name=name, surname=surname, username=username, hash=generate_password_hash(hash), role_id=role_id)
-                        db_session.add(new_user)
-                        try:
-                            db_session.commit()
-                        except (SQLAlchemyError, Exception) as e:
-                            db_session.rollback()
-                            flash(f'Database error: {e}', 'danger')
-                            log_error_to_csv(f'Database error: {e}')
-                        user_group_log = UserGroups(user_id=new_user.id, group_id=group_id)
-                        db_session.add(user_group_log)
-                        try:
-                            db_session.commit()
-                        except (SQLAlchemyError, Exception) as e:
-                            db_session.rollback()
-                            flash(f'Database error: {e}', 'danger')
-                            log_error_to_csv(f'Database error: {e}')
-                    else:
-                        if not UserGroups.query.filter_by(user_id=existing_user.id, group_id=group_id).first():
-                            user_group_log = UserGroups(user_id=existing_user.id, group_id=group_id)
-                            db_session.add(user_group_log)
-                            try:
-                                db_session.commit()
-                            except (SQLAlchemyError, Exception) as e:
-                                db_session.rollback()
-                                flash(f'Database error: {e}', 'danger')
-                                log_error_to_csv(f'Database error: {e}')
-        
-        else:
-            name = request.form.get("name")
-            new_group = Groups(name=name)
-            db_session.add(new_group)
+        name = request.form.get("name")
+        selected_users = [int(user_id) for user_id in request.form.getlist('users[]')]
+        users_file = request.files.get("fileUpload")
+        if users_file:
+            # The file is checked before saving anything. The background job creates the group and adds the
+            # selected users and the excel users in a single transaction, the page polls its progress
             try:
-                db_session.commit()
-            except (SQLAlchemyError, Exception) as e:
-                db_session.rollback()
-                flash(f'Database error: {e}', 'danger')
-                log_error_to_csv(f'Database error: {e}')
-            group_id = new_group.id
-
-            # Get the list of selected users
-            selected_users = request.form.getlist('users[]')
-
-            # Create UserGroup log for each user added
-            for user_id in selected_users:
-                if not UserGroups.query.filter_by(user_id=user_id, group_id=group_id).first():
-                    user_group_log = UserGroups(user_id=user_id, group_id=group_id)
-                    db_session.add(user_group_log)
-                    try:
-                        db_session.commit()
-                    except (SQLAlchemyError, Exception) as e:
-                        db_session.rollback()
-                        flash(f'Database error: {e}', 'danger')
-                        log_error_to_csv(f'Database error: {e}')
-
-            if users_file:
-                excel_data = users_file.read()
-                users_df = pd.read_excel(io.BytesIO(excel_data))
-
-                for index, row in users_df.iterrows():
-                    try:
-                        name = row['Nom']
-                        surname = row['Primer cognom'] + ' ' + row['Segon cognom']
-                        username = row['Correu']
-                        hash = str(row['Nif'])
-                        role_id = 2
-                    except KeyError:
-                        flash("Invalid excel file format. Please check the column names.", 'danger')
-                        # Delete the group that was just created
-                        db_session.delete(new_group)
-                        try:
-                            db_session.commit()
-                        except (SQLAlchemyError, Exception) as e:
-                            db_session.rollback()
-                            flash(f'Database error: {e}', 'danger')
-                            log_error_to_csv(f'Database error: {e}')
-                        return redirect('/manage-groups')
-                    existing_user = Users.query.filter_by(username=username).first()
-                    # Check that the user is new
-                    if existing_user is None:
-                        new_user = Users(name=name, surname=surname, username=username, hash=generate_password_hash(hash), role_id=role_id)
-                        db_session.add(new_user)
-                        try:
-                            db_session.commit()
-                        except (SQLAlchemyError, Exception) as e:
-                            db_session.rollback()
-                            flash(f'Database error: {e}', 'danger')
-                            log_error_to_csv(f'Database error: {e}')
-                        user_group_log = UserGroups(user_id=new_user.id, group_id=group_id)
-                        db_session.add(user_group_log)
-                        try:
-                            db_session.commit()
-                        except (SQLAlchemyError, Exception) as e:
-                            db_session.rollback()
-                            flash(f'Database error: {e}', 'danger')
-                            log_error_to_csv(f'Database error: {e}')
-                    else:
-                        if not UserGroups.query.filter_by(user_id=existing_user.id, group_id=group_id).first():
-                            user_group_log = UserGroups(user_id=existing_user.id, group_id=group_id)
-                            db_session.add(user_group_log)
-                            try:
-                                db_session.commit()
-                            except (SQLAlchemyError, Exception) as e:
-                                db_session.rollback()
-                                flash(f'Database error: {e}', 'danger')
-                                log_error_to_csv(f'Database error: {e}')
-        
+                users_df = read_users_file(users_file.read())
+            except ValueError as e:
+                flash(str(e), 'danger')
+                return redirect('/manage-groups')
+            job_id = submit_job('import_users', current_user.id, users_df=users_df, group_name=name, user_ids=selected_users)
+            flash("Importing the excel, the group is saved when the import finishes.", "info")
+            return redirect(f"/manage-groups?job={job_id}")
+
+        try:
+            group = Groups.query.filter_by(name=name).first()
+            if group is None:
+                group = Groups(name=name)
+                db_session.add(group)
+                db_session.flush()
+
+            added = add_users_to_group(selected_users, group.id)
+            db_session.commit()
+            calendar_cache.invalidate_user_groups(*added)
+        except (SQLAlchemyError, Exception) as e:
+            db_session.rollback()
+            flash(f'Database error: {e}', 'danger')
+            log_error(f'Database error: {e}')
+            return redirect('/manage-groups')
+
         flash("Group created successfully!", "success")
         return redirect("/manage-groups")
 
+@app.route('/api/groups')
+@read_only
+@login_required
+@permission_admin
+def api_groups():
+    """
+    Page of groups with their number of members, filtered by name with ?q=.
+    """
+    page, per_page = page_args(request.args)
+    return jsonify(group_page(request.args.get('q', '').strip(), page, per_page))
+
+@app.route('/api/groups/<int:group_id>/members')
+@read_only
+@login_required
+@permission_admin
+def api_group_members(group_id):
+    """
+    Page of members of a group, loaded when the group is opened.
+    """
+    page, per_page = page_args(request.args)
+    return jsonify(member_page(group_id, page, per_page))
+
+@app.route('/api/users')
+@read_only
+@login_required
+@permission_admin
+def api_users():
+    """
+    Page of users for manage-users. ?q= searches by prefix (?mode=prefix) or substring (?mode=contains),
+    ?sort= surname, name or username, ?order=desc, and ?after= the cursor returned by the previous page.
+    """
+    _, per_page = page_args(request.args)
+    try:
+        return jsonify(user_page(request.args.get('q', '').strip(), request.args.get('mode', 'prefix'),
+                                 request.args.get('sort', 'surname'), request.args.get('order') == 'desc',
+                                 request.args.get('after'), per_page))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+@app.route('/api/users/options')
+@read_only
+@login_required
+@permission_admin
+def api_user_options():
+    """
+    Users matching ?q= for the user pickers (select2 ajax format).
+    """
+    page, per_page = page_args(request.args, default_size=20)
+    return jsonify(user_options(request.args.get('q', '').strip(), page, per_page))
+
 @app.route('/add-user-group', methods=['POST'])
 @login_required
 @permission_admin
 def add_user_group():
-    users_file = request.files["fileUpload"]
-        
+    users_file = request.files.get("fileUpload")
+
     existing_group = Groups.query.filter_by(name=request.form.get("name")).first()
     if existing_group:
         group_id = existing_group.id
 
         # Get the list of selected users
-        selected_users = request.form.getlist('users[]')
+        selected_users = [int(user_id) for user_id in request.form.getlist('users[]')]
+        if users_file:
+            # The file is checked before saving anything. The background job adds the selected users and the
+            # excel users in a single transaction, the page polls its progress
+            try:
+                users_df = read_users_file(users_file.read())
+            except ValueError as e:
+                flash(str(e), 'danger')
+                return redirect('/manage-groups')
+            job_id = submit_job('import_users', current_user.id, users_df=users_df, group_id=group_id, user_ids=selected_users)
+            return redirect(f"/manage-groups?job={job_id}")
 
-        # Create UserGroup log for each user added if not already in the group
-        for user_id in selected_users:
-            if not UserGroups.query.filter_by(user_id=user_id, group_id=group_id).first():
-                user_group_log = UserGroups(user_id=user_id, group_id=group_id)
-                db_session.add(user_group_log)
-                try:
-                    db_session.commit()
-                    flash("User added to group.", "success")
-                except (SQLAlchemyError, Exception) as e:
-                    db_session.rollback()
-                    flash(f'Database error: {e}', 'danger')
-                    log_error_to_csv(f'Database error: {e}')
-            else:
-                flash("User is already in the group.", "info")
+        try:
+            # Create UserGroup log for each user added if not already in the group
+            added = add_users_to_group(selected_users, group_id)
+            db_session.commit()
+            calendar_cache.invalidate_user_groups(*added)
+        except (SQLAlchemyError, Exception) as e:
+            db_session.rollback()
+            flash(f'Database error: {e}', 'danger')
+            log_error(f'Database error: {e}')
+            return redirect('/manage-groups')
+
+        if added:
+            flash(f"{len(added)} user(s) added to group.", "success")
+        if len(added) < len(set(selected_users)):
+            flash(f"{len(set(selected_users)) - len(added)} user(s) already in the group.", "info")
 
-        if users_file:
-            excel_data = users_file.read()
-            users_df = pd.read_excel(io.BytesIO(excel_data))
-            
-            for index, row in users_df.iterrows():
-                try:
-                    name = row['Nom']
-                    surname = row['Primer cognom'] + ' ' + row['Segon cognom']
-                    username = row['Correu']
-                    hash = str(row['Nif'])
-                    role_id = 2
-                except KeyError:
-                    flash("Invalid excel file format. Please check the column names.", 'danger')
-                    return redirect('/manage-groups')
-
-                existing_user = Users.query.filter_by(username=username).first()
-                # Check that the user is new or not already in the group
-                if existing_user is None:
-                    new_user = Users(name=name, surname=surname, username=username, hash=generate_password_hash(hash), role_id=role_id)
-                    db_session.add(new_user)
-                    try:
-                        db_session.commit()
-                        user_group_log = UserGroups(user_id=new_user.id, group_id=group_id)
-                        db_session.add(user_group_log)
-                        db_session.commit()
-                    except (SQLAlchemyError, Exception) as e:
-                        db_session.rollback()
-                        flash(f'Database error: {e}', 'danger')
-                        log_error_to_csv(f'Database error: {e}')
-                elif not UserGroups.query.filter_by(user_id=existing_user.id, group_id=group_id).first():
-                    user_group_log = UserGroups(user_id=existing_user.id, group_id=group_id)
-                    db_session.add(user_group_log)
-                    try:
-                        db_session.commit()
-                    except (SQLAlchemyError, Exception) as e:
-                        db_session.rollback()
-                        flash(f'Database error: {e}', 'danger')
-                        log_error_to_csv(f'Database error: {e}')
-                else:
-                    flash(f"User {username} is already in the group.", "info")
-                    
     return redirect("/manage-groups")
 
 @app.route('/delete_user_group', methods=['DELETE'])
@@ -547,12 +816,13 @@ def delete_user_group():
         try:
             db_session.delete(log_to_delete)
             db_session.commit()
+            calendar_cache.invalidate_user_groups(user_id)
             flash("User deleted from group.", "warning")
             return jsonify({"message": "Log eliminado exitosamente"})
         except (SQLAlchemyError, Exception) as e:
             db_session.rollback()
             flash(f'Database error: {e}', 'danger')
-            log_error_to_csv(f'Database error: {e}')
+            log_error(f'Database error: {e}')
     else:
         return jsonify({"message": "No se encontró el log"})
 
@@ -564,14 +834,20 @@ def delete_group():
         group_id = request.json.get('group_id')
         
         # Delete the logs in UserGroups table that contain the group_id
+        member_ids = [user_id for (user_id,) in db_session.query(UserGroups.user_id).filter_by(group_id=group_id)]
         UserGroups.query.filter_by(group_id=group_id).delete()
         
         # Buscar el log en la base de datos
         group_to_delete = Groups.query.filter_by(id=group_id).first()
         
         if group_to_delete:
+            # the series of the group are left without group, like its events
+            db_session.execute(update(Series).where(Series.group_id == group_id).values(group_id=None))
             db_session.delete(group_to_delete)
             db_session.commit()
+            # the events of the group are left without group
+            calendar_cache.invalidate_user_groups(*member_ids)
+            calendar_cache.invalidate_events(group_id, None)
     
             flash("Group deleted.", "warning")
     
@@ -581,76 +857,95 @@ def delete_group():
     except (SQLAlchemyError, Exception) as e:
         db_session.rollback()
         flash(f'Database error: {e}', 'danger')
-        log_error_to_csv(f'Database error: {e}')
+        log_error(f'Database error: {e}')
 
 @app.route('/delete_event', methods=['DELETE'])
 @login_required
 @permission_admin
 def delete_event():
     try:
-        event_id = request.json.get('event_id')
+        occurrence = get_occurrence(request.json.get('event_id'))
+        if occurrence:
+            # Occurrences of a series that are not stored are removed from the series
+            add_series_exception(occurrence.series_id, occurrence.date)
+            notify_deleted(occurrence.group_id, occurrence_id=occurrence.id, date=occurrence.date)
+            db_session.commit()
+            calendar_cache.invalidate_events(occurrence.group_id)
+            return jsonify({"message": "Log eliminado exitosamente", "deleted": occurrence.id})
+
+        event_id = resolve_event_id(request.json.get('event_id'))
         
-        # Delete the logs in UserEvents table that contain the event_id
+        # Delete the logs in UserEvents table that contain the event_id (its seats_taken counter goes with the event)
         UserEvents.query.filter_by(event_id=event_id).delete()
         
         # Buscar el log en la base de datos
         event_to_delete = Events.query.filter_by(id=event_id).first()
         
         if event_to_delete:
+            group_id = event_to_delete.group_id
+            if event_to_delete.series_id:
+                # otherwise the series would show the occurrence again
+                add_series_exception(event_to_delete.series_id, event_to_delete.date)
+            notify_deleted(group_id, event_id=event_id, date=event_to_delete.date)
             db_session.delete(event_to_delete)
             db_session.commit()
+            calendar_cache.invalidate_events(group_id)
+            calendar_cache.invalidate_participants(event_id)
     
-            flash("Event deleted.", "warning")
-    
-            return jsonify({"message": "Log eliminado exitosamente"})
+            return jsonify({"message": "Log eliminado exitosamente", "deleted": event_id})
         else:
             return jsonify({"message": "No se encontró el log"})
     except (SQLAlchemyError, Exception) as e:
         db_session.rollback()
         flash(f'Database error: {e}', 'danger')
-        log_error_to_csv(f'Database error: {e}')
+        log_error(f'Database error: {e}')
+
+        
+@app.route('/delete_series', methods=['DELETE'])
+@login_required
+@permission_admin
+def delete_series():
+    try:
+        series_id = request.json.get('series_id')
+        # Its exceptions and stored occurrences (with their participants) are deleted by the database
+        group_id = db_session.execute(delete(Series).where(Series.id == series_id).returning(Series.group_id)).first()
+        if group_id:
+            notify_deleted(group_id[0], series_id=series_id)
+            db_session.commit()
+            calendar_cache.invalidate_events(group_id[0])
+            return jsonify({"message": "Log eliminado exitosamente", "deleted_series": series_id})
+        else:
+            db_session.rollback()
+            return jsonify({"message": "No se encontró el log"})
+    except (SQLAlchemyError, Exception) as e:
+        db_session.rollback()
+        flash(f'Database error: {e}', 'danger')
+        log_error(f'Database error: {e}')
+        return jsonify({"message": "Error al eliminar la serie"}), 500
 
         
 @app.route("/manage-users", methods=["GET","POST"])
+@read_only
 @login_required
 @permission_admin
 def manage_users():
     if request.method == "GET":
-    
-        all_users = Users.query.all()
-        return render_template("manage_users.html", all_users=all_users)
+        # users are loaded page by page from /api/users
+        return render_template("manage_users.html")
     else:
-        users_file = request.files["fileUpload"]
+        users_file = request.files.get("fileUpload")
         if users_file:
-            excel_data = users_file.read()
-            users_df = pd.read_excel(io.BytesIO(excel_data))
-            
-            for index, row in users_df.iterrows():
-                try:
-                    name = row['Nom']
-                    surname = row['Primer cognom'] + ' ' + row['Segon cognom']
-                    username = row['Correu']
-                    hash = str(row['Nif'])
-                    role_id = 2
-                except KeyError:
-                    flash("Invalid excel file format. Please check the column names.", 'danger')
-                    return redirect('/manage-users')
-
-                existing_user = Users.query.filter_by(username=username).first()
-                # Check that the user is new or not already in the group
-                if existing_user is None:
-                    new_user = Users(name=name, surname=surname, username=username, hash=generate_password_hash(hash), role_id=role_id)
-                    db_session.add(new_user)
-                    try:
-                        db_session.commit()
-                    except (SQLAlchemyError, Exception) as e:
-                        db_session.rollback()
-                        flash(f'Database error: {e}', 'danger')
-                        log_error_to_csv(f'Database error: {e}')
-                        
+            # The file is checked here, the users are imported in a background job and the page polls its progress
+            try:
+                users_df = read_users_file(users_file.read())
+            except ValueError as e:
+                flash(str(e), 'danger')
+                return redirect('/manage-users')
+            job_id = submit_job('import_users', current_user.id, users_df=users_df)
+            return redirect(f"/manage-users?job={job_id}")
+
         return redirect("/manage-users")
-        
-        
+
 
 @app.route('/delete_user', methods=['DELETE'])
 @login_required
@@ -663,14 +958,35 @@ def delete_user():
     
     if log_to_delete:
         try:
+            # Delete the logs in UserEvents and release the seats of the ones actually deleted, so a withdrawal
+            # running at the same time does not release the same seat twice
+            event_ids = db_session.scalars(
+                delete(UserEvents)
+                .where(UserEvents.user_id == user_id)
+                .returning(UserEvents.event_id)
+                .execution_options(synchronize_session=False)
+            ).all()
+            released = db_session.execute(
+                update(Events)
+                .where(Events.id.in_(event_ids), Events.seats_taken > 0)
+                .values(seats_taken=Events.seats_taken - 1)
+                .returning(Events.id, Events.group_id)
+                .execution_options(synchronize_session=False)
+            ).all() if event_ids else []
+            # the memberships are deleted too, the relationship would leave them without user
+            db_session.execute(delete(UserGroups).where(UserGroups.user_id == user_id).execution_options(synchronize_session=False))
             db_session.delete(log_to_delete)
+            notify_seats(*[event_id for event_id, _ in released])
             db_session.commit()
+            invalidate_identity(user_id)
+            for event_id, group_id in released:
+                calendar_cache.invalidate_seats(event_id, group_id)
             flash("User deleted.", "warning")
             return jsonify({"message": "Log eliminado exitosamente"})
         except (SQLAlchemyError, Exception) as e:
             db_session.rollback()
             flash(f'Database error: {e}', 'danger')
-            log_error_to_csv(f'Database error: {e}')
+            log_error(f'Database error: {e}')
     else:
         return jsonify({"message": "No se encontró el log"})
 
@@ -692,16 +1008,70 @@ def edit_user_data():
             user.username = username
             user.role_id = role_id
             db_session.commit()
+            invalidate_identity(user_id)
+            # names are shown in the participant lists of the events of the user
+            calendar_cache.invalidate_participants(*[event_id for (event_id,) in db_session.query(UserEvents.event_id).filter_by(user_id=user_id)])
             flash("User data updated successfully!", "success")
         else:
             flash("User not found", "danger")
     except (SQLAlchemyError, Exception) as e:
         db_session.rollback()
         flash(f'Database error: {e}', 'danger')
-        log_error_to_csv(f'Database error: {e}')
+        log_error(f'Database error: {e}')
     
     return redirect("/manage-users")
 
+@register_job('import_users')
+def import_users_job(context, users_df, group_id=None, group_name=None, user_ids=()):
+    '''
+    Job that imports the users of an excel file (read by read_users_file) and adds them to the group if given.
+    group_name creates the group if it does not exist yet, and user_ids are other users added to the group.
+    Everything is committed at once: if the import fails, neither the group nor its users are saved.
+    '''
+    if group_name is not None:
+        group = Groups.query.filter_by(name=group_name).first()
+        if group is None:
+            group = Groups(name=group_name)
+            db_session.add(group)
+            db_session.flush()
+        group_id = group.id
+    added = add_users_to_group(user_ids, group_id) if group_id is not None else set()
+    report = import_users(users_df, group_id, progress=context.progress)
+    db_session.commit()
+    calendar_cache.invalidate_user_groups(*added, *[row['user_id'] for row in report if row['status'] in ('created', 'added')])
+    message = summarize_import_report(report)
+    if added:
+        message = f'{len(added)} selected user(s) added to group. {message}'
+    return {'message': message, 'report': [row for row in report if row['status'] == 'rejected']}
+
+@app.route('/jobs/<int:job_id>')
+@login_required
+@permission_admin
+def get_job(job_id):
+    """
+    Status and progress of a background job.
+    """
+    job = Jobs.query.filter_by(id=job_id).first()
+    if job is None:
+        return jsonify({"message": "No se encontró el job"}), 404
+    if job.status in ('queued', 'running') and fail_orphaned_jobs(job_id):
+        # its worker process is gone, the page stops polling
+        db_session.refresh(job)
+    return jsonify(job_status(job))
+
+@app.route('/jobs/<int:job_id>/result')
+@login_required
+@permission_admin
+def get_job_result(job_id):
+    """
+    Download the file generated by a background job.
+    """
+    job = Jobs.query.filter_by(id=job_id).first()
+    if job is None or job.status != 'done' or not job.result_path:
+        flash("The file is not available.", "danger")
+        return redirect("/")
+    return send_file(job.result_path, as_attachment=True, download_name=job.result_name)
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     """Log user in"""
@@ -777,7 +1147,7 @@ def register():
                 except (SQLAlchemyError, Exception) as e:
                     db_session.rollback()
                     flash(f'Database error: {e}', 'danger')
-                    log_error_to_csv(f'Database error: {e}')
+                    log_error(f'Database error: {e}')
             else:
                 flash("Username already exists.", "danger")
                 return render_template("register.html")
@@ -812,15 +1182,44 @@ def password():
         # Commit the changes to the database
         try:
             db_session.commit()
+            invalidate_identity(current_user.id)
             flash("Password changed successfully!", "success")
         except (SQLAlchemyError, Exception) as e:
             db_session.rollback()
             flash(f'Database error: {e}', 'danger')
-            log_error_to_csv(f'Database error: {e}')
+            log_error(f'Database error: {e}')
 
         # Redirect user to home page
         return redirect("/")
     
+@app.route('/metrics')
+def metrics():
+    """
+    Latency, SQL statements and SQL time per route (Prometheus text format), for admins or for the scraper
+    with the METRICS_TOKEN bearer token.
+    """
+    token = app.config.get('METRICS_TOKEN')
+    if not (token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')):
+        if not current_user.is_authenticated:
+            return login_manager_app.unauthorized()
+        if current_user.role_id != 1:
+            flash("Access denied.", "danger")
+            return redirect("/")
+    return Response(metrics_text(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/ready')
+def ready():
+    """
+    Readiness check for the load balancer or the process manager. Warms the connection pool of the worker
+    the first time (workers start without connecting to the database).
+    """
+    try:
+        check_db()
+    except SQLAlchemyError as e:
+        log_error(f'Database error: {e}')
+        return jsonify({"status": "unavailable"}), 503
+    return jsonify({"status": "ready"})
+
 # close all db sessions
 @app.teardown_appcontext
 def shutdown_session(exception=None):
@@ -0,0 +1,139 @@
+"""
+Synthetic data for the benchmarks: users, groups, memberships, events and sign-ups at a configurable scale,
+written with bulk inserts in the database of DB_URL. The same --seed always generates the same data.
+
+Benchmark rows are recognisable (users @bench.local, groups "Bench group n", events "Bench ..."), and
+running the generator again replaces them without touching the rest of the database. Use a local database.
+
+    flask --app run init-db
+    python -m benchmarks.generate --users 10000 --groups 500 --events 20000
+"""
+import sys
+import time
+import random
+import argparse
+from datetime import date, time as day_time, timedelta
+from sqlalchemy import delete, select, func, text
+from sqlalchemy.dialects.postgresql import insert
+from werkzeug.security import generate_password_hash
+
+from app.database import db_session, engine, seed_db
+from app.models import Users, Groups, UserGroups, Events, UserEvents
+
+BENCH_DOMAIN = '@bench.local'
+BENCH_PASSWORD = 'bench'
+ADMIN_USERNAME = f'admin{BENCH_DOMAIN}'
+GROUP_PREFIX = 'Bench group '
+EVENT_PREFIX = 'Bench '
+# Titles of the events (exports by title read all the events of one of them)
+TOPICS = ['Airway', 'Trauma', 'Sepsis', 'Cardiac arrest', 'Neonatal', 'Obstetrics', 'Burns', 'Triage',
+          'Ventilation', 'Ultrasound', 'Paediatrics', 'Anaesthesia', 'Toxicology', 'Stroke', 'Teamwork']
+COLORS = ['#3788d8', '#d83737', '#37d85a', '#d8b837', '#8e37d8']
+CHUNK = 5000 # rows per INSERT statement
+
+def chunks(rows):
+    for start in range(0, len(rows), CHUNK):
+        yield rows[start:start + CHUNK]
+
+def insert_rows(model, rows, returning=None):
+    ids = []
+    for chunk in chunks(rows):
+        if returning is None:
+            db_session.execute(insert(model), chunk)
+        else:
+            ids += db_session.scalars(insert(model).returning(returning, sort_by_parameter_order=True), chunk).all()
+    return ids
+
+def remove_bench_data():
+    """
+    Delete the rows of a previous run (memberships and sign-ups are deleted by the database).
+    """
+    db_session.execute(delete(Events).where(Events.title.like(f'{EVENT_PREFIX}%')))
+    db_session.execute(delete(Groups).where(Groups.name.like(f'{GROUP_PREFIX}%')))
+    db_session.execute(delete(Users).where(Users.username.like(f'%{BENCH_DOMAIN}')))
+
+def generate(users, groups, events, groups_per_user=2, fill=0.6, days=180, start=date(2025, 1, 6), seed=1):
+    """
+    Write the data, replacing the one of a previous run. Returns the number of rows written by table.
+    """
+    rng = random.Random(seed)
+    # one hash for every user, hashing thousands of passwords would take minutes
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    remove_bench_data()
+
+    user_ids = insert_rows(Users, [{'name': f'Name{number}', 'surname': f'Surname{number % 997} Second{number}',
+                                    'username': f'user{number}{BENCH_DOMAIN}', 'hash': password_hash, 'role_id': 2}
+                                   for number in range(users)], Users.id)
+    insert_rows(Users, [{'name': 'Bench', 'surname': 'Admin', 'username': ADMIN_USERNAME, 'hash': password_hash, 'role_id': 1}])
+    group_ids = insert_rows(Groups, [{'name': f'{GROUP_PREFIX}{number}'} for number in range(groups)], Groups.id)
+
+    members = {group_id: [] for group_id in group_ids}
+    for user_id in user_ids:
+        for group_id in rng.sample(group_ids, min(groups_per_user, len(group_ids))):
+            members[group_id].append(user_id)
+    insert_rows(UserGroups, [{'user_id': user_id, 'group_id': group_id} for group_id, group_members in members.items() for user_id in group_members])
+
+    event_rows = []
+    for _ in range(events):
+        start_hour = rng.randint(8, 18)
+        event_rows.append({
+            'title': f'{EVENT_PREFIX}{rng.choice(TOPICS)}', 'description': 'Synthetic event',
+            'date': start + timedelta(days=rng.randrange(days)),
+            'start_time': day_time(start_hour), 'end_time': day_time(start_hour + 2),
+            'n_assistants': rng.randint(5, 30), 'color': rng.choice(COLORS),
+            # a few events without group are seen by everybody
+            'group_id': rng.choice(group_ids) if rng.random() > 0.02 else None,
+            'seats_taken': 0,
+        })
+    event_ids = insert_rows(Events, event_rows, Events.id)
+
+    signups = []
+    for event_id, event in zip(event_ids, event_rows):
+        candidates = members[event['group_id']] if event['group_id'] else user_ids
+        taken = rng.sample(candidates, min(int(event['n_assistants'] * fill * rng.uniform(0.5, 1.5)), event['n_assistants'], len(candidates)))
+        signups += [{'user_id': user_id, 'event_id': event_id} for user_id in taken]
+    insert_rows(UserEvents, signups)
+    db_session.execute(text('UPDATE events SET seats_taken = counts.taken FROM '
+                            '(SELECT event_id, count(*) AS taken FROM userevents GROUP BY event_id) AS counts '
+                            'WHERE events.id = counts.event_id AND events.title LIKE :prefix'), {'prefix': f'{EVENT_PREFIX}%'})
+    db_session.commit()
+
+    # statistics of the planner for the new rows
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(text('ANALYZE'))
+    return {'users': len(user_ids) + 1, 'groups': len(group_ids),
+            'memberships': sum(len(group_members) for group_members in members.values()),
+            'events': len(event_ids), 'signups': len(signups)}
+
+def bench_scale():
+    """
+    Number of benchmark users, groups and events in the database (stored with the route baselines).
+    """
+    return {
+        'users': db_session.scalar(select(func.count()).select_from(Users).where(Users.username.like(f'%{BENCH_DOMAIN}'))),
+        'groups': db_session.scalar(select(func.count()).select_from(Groups).where(Groups.name.like(f'{GROUP_PREFIX}%'))),
+        'events': db_session.scalar(select(func.count()).select_from(Events).where(Events.title.like(f'{EVENT_PREFIX}%'))),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=500)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--groups-per-user', type=int, default=2)
+    parser.add_argument('--fill', type=float, default=0.6, help='average fraction of the seats taken')
+    parser.add_argument('--days', type=int, default=180, help='days the events are spread over')
+    parser.add_argument('--start', type=date.fromisoformat, default=date(2025, 1, 6), help='first day of the events')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    seed_db()  # roles
+    started = time.perf_counter()
+    written = generate(args.users, args.groups, args.events, args.groups_per_user, args.fill, args.days, args.start, args.seed)
+    print(', '.join(f'{count} {table}' for table, count in written.items()) + f' written in {time.perf_counter() - started:.1f} s')
+    print(f'Admin: {ADMIN_USERNAME}, users: user<n>{BENCH_DOMAIN}, password: {BENCH_PASSWORD}')
+    db_session.remove()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
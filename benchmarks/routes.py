@@ -0,0 +1,239 @@
+"""
+Timed runs of the hot routes through the Flask test client, against the data of benchmarks.generate.
+Every scenario reports the median and 95th percentile time and the SQL statements it executed (also the ones
+of the background job it starts). Results are compared with routes_baseline.json: a scenario regresses when
+its median time is over the baseline by more than --tolerance, or when it executes more statements.
+
+    python -m benchmarks.generate
+    python -m benchmarks.routes                  # exit 1 on a regression
+    python -m benchmarks.routes --save-baseline  # record the current numbers as the baseline
+    python -m benchmarks.routes -k feed          # only the scenarios with feed in their name
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import statistics
+from datetime import timedelta
+from sqlalchemy import event, select, func, delete
+
+from app import app
+from app.database import db_session, engines
+from app.models import Users, Groups, UserGroups, Events
+from app.utils import calendar_cache
+from app.utils.imports import hash_workers
+from benchmarks.generate import BENCH_DOMAIN, BENCH_PASSWORD, ADMIN_USERNAME, EVENT_PREFIX, GROUP_PREFIX, bench_scale
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routes_baseline.json')
+IMPORT_DOMAIN = f'.import{BENCH_DOMAIN}'
+
+class QueryCounter():
+    """
+    SQL statements executed by the requests (run in the main thread by the test client) and by the threads of
+    the background jobs. Not counted, as their number depends on the timing: the polls of the main thread while
+    it is waiting for a job, and the statements of the other threads of the process (job heartbeat, seat
+    notifications).
+    """
+    def __init__(self):
+        self.count = 0
+        self.waiting = threading.local()
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self.increment)
+
+    def increment(self, *args):
+        thread = threading.current_thread()
+        if thread is threading.main_thread():
+            if not getattr(self.waiting, 'active', False):
+                self.count += 1
+        elif thread.name.startswith('job_'):  # threads of the job executor, see app/utils/jobs.py
+            self.count += 1
+
+query_counter = QueryCounter()
+
+def login(username):
+    client = app.test_client()
+    response = client.post('/login', data={'username': username, 'password': BENCH_PASSWORD})
+    if response.status_code != 302:
+        raise SystemExit(f'Cannot log in as {username}, run python -m benchmarks.generate first')
+    return client
+
+def check(response, *statuses):
+    if response.status_code not in (statuses or (200,)):
+        raise RuntimeError(f'{response.request.method} {response.request.path}: {response.status_code}')
+    return response
+
+def wait_job(client, response):
+    """
+    Wait for the background job the response redirected to (/?job=<id>) to finish.
+    """
+    job_id = check(response, 302).location.split('job=')[1]
+    query_counter.waiting.active = True
+    try:
+        while True:
+            job = check(client.get(f'/jobs/{job_id}')).get_json()
+            if job['status'] == 'done':
+                return job
+            if job['status'] == 'failed':
+                raise RuntimeError(f"Job {job_id} failed: {job['message']}")
+            time.sleep(0.02)
+    finally:
+        query_counter.waiting.active = False
+
+def users_excel(run, size):
+    from openpyxl import Workbook
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(['Nom', 'Primer cognom', 'Segon cognom', 'Correu', 'Nif'])
+    for number in range(size):
+        sheet.append([f'Imported{number}', 'Bench', 'Import', f'run{run}.{number}{IMPORT_DOMAIN}', f'{number:08d}X'])
+    file = io.BytesIO()
+    workbook.save(file)
+    return file.getvalue()
+
+def context():
+    """
+    Clients and ids used by the scenarios: the busiest group, one of its members, the event with most
+    participants and a 5 week window (month view of the calendar) where the benchmark events start.
+    """
+    group_id = db_session.scalar(select(UserGroups.group_id).join(Groups, Groups.id == UserGroups.group_id)
+                                 .where(Groups.name.like(f'{GROUP_PREFIX}%')).group_by(UserGroups.group_id)
+                                 .order_by(func.count().desc(), UserGroups.group_id).limit(1))
+    if group_id is None:
+        raise SystemExit('No benchmark data, run python -m benchmarks.generate first')
+    username = db_session.scalar(select(Users.username).join(UserGroups, UserGroups.user_id == Users.id)
+                                 .where(UserGroups.group_id == group_id).order_by(Users.id).limit(1))
+    event_id, title = db_session.execute(select(Events.id, Events.title).where(Events.title.like(f'{EVENT_PREFIX}%'))
+                                         .order_by(Events.seats_taken.desc(), Events.id).limit(1)).one()
+    start = db_session.scalar(select(func.min(Events.date)).where(Events.title.like(f'{EVENT_PREFIX}%')))
+    db_session.remove()
+    return {
+        'admin': login(ADMIN_USERNAME), 'user': login(username), 'group_id': group_id, 'event_id': event_id,
+        'title': title, 'window': f'start={start}&end={start + timedelta(weeks=5)}',
+        'start': str(start), 'end': str(start + timedelta(weeks=5)),
+    }
+
+def feed(client, ctx, cold):
+    if cold:
+        calendar_cache.cache.clear()
+    return check(client.get(f"/api/events?{ctx['window']}"))
+
+def import_users(ctx, run):
+    wait_job(ctx['admin'], ctx['admin'].post('/manage-users', data={'fileUpload': (io.BytesIO(users_excel(run, 200)), 'users.xlsx')},
+                                             content_type='multipart/form-data'))
+
+def remove_imported_users():
+    db_session.execute(delete(Users).where(Users.username.like(f'%{IMPORT_DOMAIN}')))
+    db_session.commit()
+    db_session.remove()
+
+# name: (runs, function(ctx, run)). Each run is timed separately
+SCENARIOS = {
+    'index_admin': (20, lambda ctx, run: check(ctx['admin'].get('/'))),
+    'index_user': (20, lambda ctx, run: check(ctx['user'].get('/'))),
+    'feed_user_cold': (20, lambda ctx, run: feed(ctx['user'], ctx, cold=True)),
+    'feed_user_warm': (20, lambda ctx, run: feed(ctx['user'], ctx, cold=False)),
+    'feed_admin_cold': (10, lambda ctx, run: feed(ctx['admin'], ctx, cold=True)),
+    'events_status_user': (20, lambda ctx, run: check(ctx['user'].get(f"/api/events/status?{ctx['window']}"))),
+    'get_participants': (20, lambda ctx, run: check(ctx['user'].get(f"/get_participants/{ctx['event_id']}"))),
+    'export_participants_xlsx': (10, lambda ctx, run: check(ctx['admin'].get(f"/export_participants/{ctx['event_id']}"))),
+    'export_participants_by_title': (3, lambda ctx, run: wait_job(ctx['admin'], ctx['admin'].post(
+        '/export_participants_by_title', data={'eventTitle': ctx['title']}))),
+    'export_participants_bulk': (3, lambda ctx, run: wait_job(ctx['admin'], ctx['admin'].post(
+        '/export_participants_bulk', data={'start': ctx['start'], 'end': ctx['end']}))),
+    'manage_groups': (20, lambda ctx, run: check(ctx['admin'].get('/manage-groups'))),
+    'api_groups': (20, lambda ctx, run: check(ctx['admin'].get('/api/groups'))),
+    'api_group_members': (20, lambda ctx, run: check(ctx['admin'].get(f"/api/groups/{ctx['group_id']}/members"))),
+    'api_users': (20, lambda ctx, run: check(ctx['admin'].get('/api/users'))),
+    'api_users_search': (20, lambda ctx, run: check(ctx['admin'].get('/api/users?q=surname12'))),
+    'import_users_200': (2, import_users),
+}
+
+def run_scenario(name, ctx, runs):
+    function = SCENARIOS[name][1]
+    function(ctx, 0)  # warm up (connections, templates, lazy imports)
+    times, queries = [], []
+    for run in range(1, runs + 1):
+        before = query_counter.count
+        started = time.perf_counter()
+        function(ctx, run)
+        times.append((time.perf_counter() - started) * 1000)
+        queries.append(query_counter.count - before)
+    times.sort()
+    return {
+        'median_ms': round(statistics.median(times), 2),
+        'p95_ms': round(times[min(len(times) - 1, int(len(times) * 0.95))], 2),
+        'queries': int(statistics.median(queries)),
+    }
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, result in results.items():
+        expected = baseline['scenarios'].get(name)
+        if expected is None:
+            continue
+        if result['median_ms'] > expected['median_ms'] * (1 + tolerance):
+            found.append(f"{name}: {result['median_ms']} ms (baseline {expected['median_ms']} ms, tolerance {tolerance:.0%})")
+        if result['queries'] > expected['queries']:
+            found.append(f"{name}: {result['queries']} SQL statements (baseline {expected['queries']})")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='keyword', default='', help='only the scenarios with this text in their name')
+    parser.add_argument('--runs', type=int, help='runs of every scenario (default: its own number)')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='fraction over the baseline median allowed')
+    parser.add_argument('--save-baseline', action='store_true', help=f'write the results to {os.path.basename(BASELINE_FILE)}')
+    args = parser.parse_args()
+
+    app.config['METRICS_SLOW_REQUEST_SECONDS'] = None
+    app.config['METRICS_QUERY_BUDGET'] = None
+    scale = bench_scale()
+    # imports hash the passwords in a pool of this size, their times are only comparable with the same size
+    workers = hash_workers()
+    ctx = context()
+    results = {}
+    try:
+        for name, (runs, _) in SCENARIOS.items():
+            if args.keyword in name:
+                results[name] = run_scenario(name, ctx, args.runs or runs)
+                result = results[name]
+                print(f"{name:32} median {result['median_ms']:9.2f} ms  p95 {result['p95_ms']:9.2f} ms  {result['queries']:4} SQL")
+    finally:
+        remove_imported_users()
+
+    if args.save_baseline:
+        baseline = {'scale': scale, 'scenarios': {}}
+        if os.path.exists(BASELINE_FILE):
+            with open(BASELINE_FILE) as file:
+                baseline = json.load(file)
+        baseline['scale'] = scale
+        baseline['hash_workers'] = workers
+        baseline['scenarios'].update(results)
+        with open(BASELINE_FILE, 'w') as file:
+            json.dump(baseline, file, indent=4)
+            file.write('\n')
+        print(f'Baseline saved to {BASELINE_FILE}')
+        return 0
+
+    if not os.path.exists(BASELINE_FILE):
+        print('No baseline to compare with, save one with --save-baseline')
+        return 0
+    with open(BASELINE_FILE) as file:
+        baseline = json.load(file)
+    if baseline['scale'] != scale:
+        print(f"The baseline was recorded with {baseline['scale']}, the database has {scale}: times are not comparable")
+    if baseline.get('hash_workers', workers) != workers:
+        print(f"The baseline was recorded with {baseline.get('hash_workers')} hashing processes, this run has {workers}: "
+              f"import times are not comparable (see IMPORT_HASH_WORKERS and WEB_CONCURRENCY)")
+    for name in results.keys() - baseline['scenarios'].keys():
+        print(f'{name} has no baseline, record it with --save-baseline -k {name}')
+    found = regressions(results, baseline, args.tolerance)
+    for regression in found:
+        print(f'REGRESSION {regression}')
+    return 1 if found else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+"""
+Sign-up rush: hundreds of students signing up to the same few events the moment registration opens.
+Every client is a thread with its own session following the click path of the calendar page:
+log in, load the calendar (page, seat stream, feed and seat status), open the modal of an event with free
+seats (participants) and sign up; the page updates the event with the response, without reloading the calendar.
+The seat stream is held open until the client finishes, like the open calendar of a browser. A stream refused
+with 503 (all the stream threads of the worker busy) is not an error: the page polls the seat status instead.
+The client waits a random think time between steps.
+
+It reports throughput, latency percentiles and errors by step, the outcome of the sign-ups, and the
+capacity violations afterwards: events with more participants than n_assistants, or whose seats_taken
+does not match their participants. Runs against a server on a local database with the data of benchmarks.generate:
+
+    python -m benchmarks.generate
+    python -m benchmarks.rush --start-server --workers 4 --threads 50 --clients 300
+    python -m benchmarks.rush --url http://127.0.0.1:8000 --clients 300   # server already running
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import statistics
+import threading
+import subprocess
+from datetime import date, time as day_time, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from sqlalchemy import select, delete, func
+
+from app.database import db_session
+from app.models import Users, Groups, UserGroups, Events, UserEvents
+from app.utils import calendar_cache
+from benchmarks.generate import BENCH_DOMAIN, BENCH_PASSWORD, EVENT_PREFIX, GROUP_PREFIX
+
+RUSH_GROUP = f'{GROUP_PREFIX}rush'
+RUSH_TITLE = f'{EVENT_PREFIX}rush'
+USER_ID = re.compile(r"showEventModal\(info\.event, '(\d+)'\)")
+STREAM_STEP = 'seat stream'
+
+def failed(step, status):
+    """
+    True if the request failed. A stream refused with 503 is the expected answer of a busy worker.
+    """
+    return status is None or (status >= 500 and not (step == STREAM_STEP and status == 503))
+
+def prepare(clients, events, seats, day):
+    """
+    Group with the users of the clients and the events they compete for, replacing the ones of a previous rush.
+    Returns the usernames and the ids of the events.
+    """
+    db_session.execute(delete(Events).where(Events.title == RUSH_TITLE))
+    db_session.execute(delete(Groups).where(Groups.name == RUSH_GROUP))
+    users = db_session.execute(select(Users.id, Users.username).where(Users.username.like(f'%{BENCH_DOMAIN}'), Users.role_id == 2)
+                               .order_by(Users.id).limit(clients)).all()
+    if len(users) < clients:
+        raise SystemExit(f'{len(users)} benchmark users, run python -m benchmarks.generate --users {clients} or more')
+    group = Groups(name=RUSH_GROUP)
+    db_session.add(group)
+    db_session.flush()
+    db_session.add_all([UserGroups(user_id=user_id, group_id=group.id) for user_id, _ in users])
+    rush_events = [Events(title=RUSH_TITLE, description='Registration rush', date=day, start_time=day_time(9 + number % 8),
+                          end_time=day_time(10 + number % 8), n_assistants=seats, seats_taken=0, color='#d83737', group_id=group.id)
+                   for number in range(events)]
+    db_session.add_all(rush_events)
+    db_session.commit()
+    # the server may have cached the calendar of these users
+    calendar_cache.invalidate_events(group.id)
+    calendar_cache.invalidate_user_groups(*[user_id for user_id, _ in users])
+    event_ids = [event.id for event in rush_events]
+    db_session.remove()
+    return [username for _, username in users], event_ids
+
+def capacity_violations(event_ids):
+    """
+    Events whose participants exceed n_assistants or do not match seats_taken.
+    """
+    participants = func.count(UserEvents.id)
+    rows = db_session.execute(select(Events.id, Events.n_assistants, Events.seats_taken, participants)
+                              .outerjoin(UserEvents, UserEvents.event_id == Events.id)
+                              .where(Events.id.in_(event_ids)).group_by(Events.id)).all()
+    db_session.remove()
+    return [f'event {event_id}: {count} participants, n_assistants {n_assistants}, seats_taken {seats_taken}'
+            for event_id, n_assistants, seats_taken, count in rows if count > n_assistants or count != seats_taken], rows
+
+class Recorder():
+    """
+    Latency and status of every request by step of the click path, and outcome of every sign-up.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # step: [(seconds, status or None if the connection failed)]
+        self.signups = {}  # outcome: count
+
+    def request(self, session, step, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            # a stream is timed until its headers are received
+            response = session.request(method, url, timeout=60, allow_redirects=False, stream=step == STREAM_STEP, **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, None
+        with self.lock:
+            self.requests.setdefault(step, []).append((time.perf_counter() - started, status))
+        return response
+
+    def signup(self, outcome):
+        with self.lock:
+            self.signups[outcome] = self.signups.get(outcome, 0) + 1
+
+def client(base_url, username, window, event_ids, recorder, delay, think):
+    """
+    Click path of one student.
+    """
+    time.sleep(delay)
+    session = requests.Session()
+    recorder.request(session, 'login', 'POST', f'{base_url}/login', data={'username': username, 'password': BENCH_PASSWORD})
+
+    def load_calendar():
+        page = recorder.request(session, 'calendar page', 'GET', f'{base_url}/')
+        # opened by the calendar with the feed, and held on its own connection
+        stream = recorder.request(session, STREAM_STEP, 'GET', f'{base_url}/api/events/stream?{window}')
+        recorder.request(session, 'calendar feed', 'GET', f'{base_url}/api/events?{window}')
+        status = recorder.request(session, 'seat status', 'GET', f'{base_url}/api/events/status?{window}')
+        return page, stream, status.json() if status is not None and status.status_code == 200 else {}
+
+    page, stream, status = load_calendar()
+    try:
+        sign_up(base_url, session, page, status, event_ids, recorder, think)
+    finally:
+        if stream is not None:
+            stream.close()
+
+def sign_up(base_url, session, page, status, event_ids, recorder, think):
+    """
+    Rest of the click path, with the calendar loaded.
+    """
+    match = USER_ID.search(page.text) if page is not None and page.status_code == 200 else None
+    if match is None:
+        recorder.signup('not logged in')
+        return
+    time.sleep(random.uniform(0, think))
+
+    # the sign-up button is only shown for events with free seats
+    free = [event_id for event_id in event_ids if status.get(str(event_id), {}).get('remaining', 0) > 0]
+    if not free:
+        recorder.signup('no free seats shown')
+        return
+    event_id = random.choice(free)
+    recorder.request(session, 'participants', 'GET', f'{base_url}/get_participants/{event_id}')
+    time.sleep(random.uniform(0, think))
+
+    response = recorder.request(session, 'sign up', 'POST', f'{base_url}/add_user_event', json={'user_id': int(match.group(1)), 'event_id': event_id})
+    if response is None or response.status_code >= 500:
+        recorder.signup('error')
+    elif response.status_code == 409:
+        recorder.signup('full')
+    elif response.status_code == 200:
+        recorder.signup('signed up')
+    else:
+        recorder.signup(f'status {response.status_code}')
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def report(recorder, seconds, violations, rows):
+    all_requests = [request for step in recorder.requests.values() for request in step]
+    errors = sum(1 for step, step_requests in recorder.requests.items() for _, status in step_requests if failed(step, status))
+    print(f'{len(all_requests)} requests in {seconds:.1f} s: {len(all_requests) / seconds:.1f} requests/s, '
+          f'{errors} errors ({errors / max(len(all_requests), 1):.1%})')
+    print(f"{'step':16} {'requests':>8} {'errors':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for step, step_requests in recorder.requests.items():
+        times = sorted(seconds * 1000 for seconds, _ in step_requests)
+        step_errors = sum(1 for _, status in step_requests if failed(step, status))
+        print(f'{step:16} {len(times):8} {step_errors:7} {statistics.median(times):9.1f} {percentile(times, 0.9):9.1f} '
+              f'{percentile(times, 0.99):9.1f} {times[-1]:9.1f}')
+    signed_up = recorder.signups.get('signed up', 0)
+    print('Sign-ups: ' + ', '.join(f'{count} {outcome}' for outcome, count in sorted(recorder.signups.items()))
+          + f' ({signed_up / seconds:.1f} sign-ups/s)')
+    print(f'Seats: {sum(row[3] for row in rows)} taken of {sum(row[1] for row in rows)} in {len(rows)} events')
+    for violation in violations:
+        print(f'CAPACITY VIOLATION {violation}')
+    return errors / max(len(all_requests), 1)
+
+def start_server(port, workers, threads):
+    # threaded workers, as in production: every open seat stream holds a thread
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--worker-class', 'gthread', '--workers', str(workers),
+                               '--threads', str(threads), '--bind', f'127.0.0.1:{port}', 'run:app'],
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              env={**os.environ, 'WEB_CONCURRENCY': str(workers)})
+    for _ in range(100):
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/ready', timeout=1).status_code == 200:
+                return server
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise SystemExit('The server did not start')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='server to load (ignored with --start-server)')
+    parser.add_argument('--start-server', action='store_true', help='start gunicorn for the run')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers with --start-server')
+    parser.add_argument('--threads', type=int, default=50, help='threads of each gunicorn worker with --start-server')
+    parser.add_argument('--port', type=int, default=8765, help='port of the server started with --start-server')
+    parser.add_argument('--clients', type=int, default=300, help='students in the rush')
+    parser.add_argument('--events', type=int, default=5, help='events they compete for')
+    parser.add_argument('--seats', type=int, default=30, help='n_assistants of each event')
+    parser.add_argument('--ramp', type=float, default=5, help='seconds over which the clients arrive')
+    parser.add_argument('--think', type=float, default=1, help='maximum seconds a client waits between steps')
+    parser.add_argument('--date', type=date.fromisoformat, default=date.today() + timedelta(days=7), help='date of the events')
+    parser.add_argument('--max-error-rate', type=float, default=0.01, help='exit with 1 over this fraction of errors')
+    args = parser.parse_args()
+
+    usernames, event_ids = prepare(args.clients, args.events, args.seats, args.date)
+    window = f'start={args.date.replace(day=1)}&end={(args.date.replace(day=28) + timedelta(days=10)).replace(day=1)}'
+    server = start_server(args.port, args.workers, args.threads) if args.start_server else None
+    base_url = f'http://127.0.0.1:{args.port}' if server else args.url.rstrip('/')
+    recorder = Recorder()
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as executor:
+            futures = [executor.submit(client, base_url, username, window, event_ids, recorder, random.uniform(0, args.ramp), args.think)
+                       for username in usernames]
+        seconds = time.perf_counter() - started
+        for future in futures:
+            if future.exception() is not None:
+                recorder.signup(f'client error ({type(future.exception()).__name__})')
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    violations, rows = capacity_violations(event_ids)
+    error_rate = report(recorder, seconds, violations, rows)
+    return 1 if violations or error_rate > args.max_error_rate else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
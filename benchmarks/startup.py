@@ -0,0 +1,94 @@
+"""
+Startup benchmark: time to import the application and memory of the process after it, as a gunicorn
+worker pays them when it boots. Each run is a new interpreter. The application does not connect to the
+database when it is imported, so no database is needed.
+
+    python -m benchmarks.startup                  # compare with the baseline, exit 1 on a regression
+    python -m benchmarks.startup --save-baseline  # record the current numbers as the baseline
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_baseline.json')
+
+# Modules only needed by the excel imports and exports, they must not be loaded when a worker starts
+LAZY_MODULES = ['pandas', 'numpy', 'openpyxl']
+
+# Run in the child interpreter: prints import time (seconds), max RSS (KB) and the lazy modules loaded
+MEASURE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import app
+seconds = time.perf_counter() - start
+print(json.dumps({
+    'import_seconds': seconds,
+    'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'loaded': [module for module in %r if module in sys.modules],
+}))
+''' % LAZY_MODULES
+
+def measure_once():
+    env = dict(os.environ)
+    # the engine is created but never connected
+    env.setdefault('DB_URL', 'postgresql://localhost/startup_benchmark')
+    env.setdefault('SECRET_KEY', 'startup-benchmark')
+    output = subprocess.run([sys.executable, '-c', MEASURE], cwd=ROOT, env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def measure(runs):
+    """
+    Median import time and RSS of the runs, and the lazy modules loaded by any of them.
+    """
+    results = [measure_once() for _ in range(runs)]
+    return {
+        'import_seconds': round(statistics.median(result['import_seconds'] for result in results), 3),
+        'rss_kb': int(statistics.median(result['rss_kb'] for result in results)),
+        'loaded': sorted({module for result in results for module in result['loaded']}),
+    }
+
+def regressions(current, baseline, tolerance):
+    """
+    Descriptions of the numbers worse than the baseline by more than tolerance (fraction), and of the lazy
+    modules loaded at startup.
+    """
+    found = [f'{module} is imported when the application starts' for module in current['loaded']]
+    for key in ('import_seconds', 'rss_kb'):
+        if baseline and current[key] > baseline[key] * (1 + tolerance):
+            found.append(f'{key}: {current[key]} (baseline {baseline[key]}, tolerance {tolerance:.0%})')
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='interpreters started (the median is used)')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='fraction over the baseline allowed')
+    parser.add_argument('--save-baseline', action='store_true', help=f'write the results to {os.path.basename(BASELINE_FILE)}')
+    args = parser.parse_args()
+
+    current = measure(args.runs)
+    print(f"import: {current['import_seconds']:.3f} s, max RSS: {current['rss_kb'] / 1024:.1f} MB, "
+          f"lazy modules loaded: {', '.join(current['loaded']) or 'none'}")
+
+    if args.save_baseline:
+        with open(BASELINE_FILE, 'w') as file:
+            json.dump({'import_seconds': current['import_seconds'], 'rss_kb': current['rss_kb']}, file, indent=4)
+            file.write('\n')
+        print(f'Baseline saved to {BASELINE_FILE}')
+        return 0
+
+    baseline = None
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as file:
+            baseline = json.load(file)
+        print(f"baseline: {baseline['import_seconds']:.3f} s, {baseline['rss_kb'] / 1024:.1f} MB")
+    found = regressions(current, baseline, args.tolerance)
+    for regression in found:
+        print(f'REGRESSION {regression}')
+    return 1 if found else 0
+
+if __name__ == '__main__':
+    sys.exit(main())